@@ -0,0 +1,398 @@
+import os
+import sys
+from pathlib import Path
+import json
+import shutil
+import time
+import pickle
+import resource
+import argparse
+import textwrap
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import networkx as nx
+from matchms import Spectrum
+from matchms.exporting import save_as_mgf
+
+from spectral_db_loader import load_clean_spectral_db
+from spectral_db_loader import spectral_db_to_arrays
+from spectral_db_loader import save_columnar_spectral_db
+from spectral_lib_matcher import spectral_matching
+from library_shards import split_spectral_db, load_sharded_spectral_db, sharded_spectral_matching
+from molecular_networking import generate_mn
+sys.path.append(os.path.join(Path(__file__).parents[2], 'src'))
+from spectrum_cache import load_spectrum_arrays, spectra_from_arrays
+from peak_preprocessing import query_spectrum_arrays
+from precursor_index import build_precursor_index, query_precursor_index
+
+LIBRARY_FORMATS = ['pkl', 'mgf', 'columnar', 'sharded']
+
+
+def synthetic_families(n_families, n_peaks, precursor_distribution, mz_range, rng):
+    """Draw the precursor m/z and fragments of synthetic structures
+
+    Args:
+        n_families (int): Number of structures
+        n_peaks (float): Mean number of fragments of a structure
+        precursor_distribution (str): 'uniform', 'normal' (centered on mz_range) or 'clustered' (around 10 m/z values)
+        mz_range (tuple): Range of the precursor m/z
+        rng (np.random.Generator): Random generator
+
+    Returns:
+        tuple: Precursor m/z (np.ndarray) and fragment m/z (list of np.ndarray) of each structure
+    """
+
+    low, high = mz_range
+    if precursor_distribution == 'uniform':
+        precursor_mz = rng.uniform(low, high, n_families)
+    elif precursor_distribution == 'normal':
+        precursor_mz = np.clip(rng.normal((low + high) / 2, (high - low) / 6, n_families), low, high)
+    elif precursor_distribution == 'clustered':
+        centers = rng.uniform(low, high, 10)
+        precursor_mz = np.clip(centers[rng.integers(10, size=n_families)] + rng.normal(0, 2, n_families), low, high)
+    else:
+        raise ValueError('precursor_distribution parameter must be uniform, normal or clustered')
+    fragments = [np.sort(rng.uniform(50, mz, max(1, rng.poisson(n_peaks)))) for mz in precursor_mz]
+    return np.round(precursor_mz, 4), fragments
+
+
+def synthetic_spectra(families, n_spectra, rng, library=False, keep_fraction=0.8, noise_fraction=0.2, mz_jitter=0.002):
+    """Draw spectra of synthetic structures
+
+    Each spectrum keeps a random part of the fragments of its structure, with jittered m/z and random \
+        intensities, plus noise peaks.
+
+    Args:
+        families (tuple): Output of synthetic_families()
+        n_spectra (int): Number of spectra
+        rng (np.random.Generator): Random generator
+        library (bool, optional): Library spectra (normalized, with a short InChIKey as compound_name) \
+            instead of query spectra (with scans). Defaults to False.
+        keep_fraction (float, optional): Probability of keeping each fragment. Defaults to 0.8.
+        noise_fraction (float, optional): Number of noise peaks relative to the number of fragments. Defaults to 0.2.
+        mz_jitter (float, optional): Standard deviation in Da of the fragment and precursor m/z. Defaults to 0.002.
+
+    Returns:
+        list: matchms spectra objects
+    """
+
+    precursor_mz, fragments = families
+    spectra = []
+    for i, family in enumerate(rng.integers(len(precursor_mz), size=n_spectra)):
+        frag = fragments[family]
+        frag = frag[rng.random(len(frag)) < keep_fraction]
+        noise = rng.uniform(50, precursor_mz[family], rng.binomial(len(fragments[family]), noise_fraction))
+        mz = np.unique(np.round(np.concatenate([frag + rng.normal(0, mz_jitter, len(frag)), noise]), 4))
+        intensities = rng.exponential(1.0, len(mz))
+        pepmass = float(np.round(precursor_mz[family] + rng.normal(0, mz_jitter), 4))
+        if library:
+            metadata = {'compound_name': f'SYNTH{family:09d}', 'precursor_mz': pepmass, 'pepmass': (pepmass, None)}
+            intensities = intensities / intensities.max() if len(mz) else intensities
+        else:
+            metadata = {'scans': str(i + 1), 'feature_id': str(i + 1), 'pepmass': (pepmass, None)}
+        spectra.append(Spectrum(mz=mz.astype(float), intensities=intensities.astype(float), metadata=metadata))
+    return spectra
+
+
+def prepare_data(data_path, data_params, library_formats, n_shards):
+    """Write the synthetic query spectra and library in the requested formats, reused while data_params do not change
+
+    Args:
+        data_path (str): Directory of the benchmark data
+        data_params (dict): Parameters of the synthetic data
+        library_formats (list): Library formats to write (see LIBRARY_FORMATS)
+        n_shards (int): Number of shards of the sharded library
+
+    Returns:
+        dict: Paths of the query spectra ('queries') and of each library format
+    """
+
+    paths = {'queries': os.path.join(data_path, 'queries.mgf'), 'pkl': os.path.join(data_path, 'library.pkl'),
+             'mgf': os.path.join(data_path, 'library.mgf'), 'columnar': os.path.join(data_path, 'library_columnar'),
+             'sharded': os.path.join(data_path, f'library_sharded_{n_shards}')}
+    params_path = os.path.join(data_path, 'data_params.json')
+    if os.path.isfile(params_path):
+        with open(params_path) as f:
+            if json.load(f) != data_params:
+                for file in os.listdir(data_path):
+                    if os.path.isfile(os.path.join(data_path, file)):
+                        os.remove(os.path.join(data_path, file))
+    if not (os.path.isfile(paths['queries']) and os.path.isfile(paths['pkl'])):
+        os.makedirs(data_path, exist_ok=True)
+        rng = np.random.default_rng(data_params['seed'])
+        families = synthetic_families(data_params['n_families'], data_params['n_peaks'],
+                                      data_params['precursor_distribution'], data_params['mz_range'], rng)
+        library = synthetic_spectra(families, data_params['n_library'], rng, library=True)
+        queries = synthetic_spectra(families, data_params['n_queries'], rng)
+        save_as_mgf(queries, paths['queries'])
+        with open(paths['pkl'], 'wb') as f:
+            pickle.dump(library, f)
+        with open(params_path, 'w') as f:
+            json.dump(data_params, f, indent=2)
+        # Library formats derived from a previous library
+        for library_format in ['mgf', 'columnar', 'sharded']:
+            if os.path.exists(paths[library_format]):
+                if os.path.isdir(paths[library_format]):
+                    shutil.rmtree(paths[library_format])
+                else:
+                    os.remove(paths[library_format])
+
+    if 'mgf' in library_formats and not os.path.isfile(paths['mgf']):
+        with open(paths['pkl'], 'rb') as f:
+            save_as_mgf(pickle.load(f), paths['mgf'])
+    if 'columnar' in library_formats and not os.path.isdir(paths['columnar']):
+        save_columnar_spectral_db(spectral_db_to_arrays(load_clean_spectral_db(paths['pkl'])), paths['columnar'], source=paths['pkl'])
+    if 'sharded' in library_formats and not os.path.isdir(paths['sharded']):
+        split_spectral_db(paths['pkl'], paths['sharded'], n_shards)
+    return paths
+
+
+def load_queries(queries_path):
+    """Load the query spectra as nb_indifile.py does, as arrays (see query_spectrum_arrays())"""
+    return query_spectrum_arrays(load_spectrum_arrays(queries_path), n_required=1)
+
+
+def load_query_spectra(queries_path):
+    """Load the query spectra as nb_indifile.py does for the molecular networking, as matchms spectra"""
+    return [spectrum.to_matchms() for spectrum in spectra_from_arrays(load_queries(queries_path))]
+
+
+def _peak_rss_mb():
+    """Peak resident set size (MB) of this process and of its largest waited-for child process"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+
+def run_matching(paths, library_format, output_path, matching_params):
+    """Load the library and the query spectra and match them, in a fresh process (see run_isolated())
+
+    Returns:
+        dict: Loading and matching times (s) and peak RSS (MB)
+    """
+
+    baseline_rss, _ = _peak_rss_mb()
+    start = time.perf_counter()
+    if library_format == 'sharded':
+        library = load_sharded_spectral_db(paths['sharded'])
+    else:
+        library = load_clean_spectral_db(paths[library_format])
+        if not isinstance(library, dict):
+            library = spectral_db_to_arrays(library)
+    spectra_query = load_queries(paths['queries'])
+    loaded = time.perf_counter()
+    if library_format == 'sharded':
+        sharded_spectral_matching(spectra_query, library, output_file_path=output_path,
+                                  shards_folder_path=os.path.join(os.path.dirname(output_path), 'shards'), **matching_params)
+    else:
+        spectral_matching(spectra_query, library, output_file_path=output_path, **matching_params)
+    done = time.perf_counter()
+    peak_rss, peak_worker_rss = _peak_rss_mb()
+    return {'load_s': loaded - start, 'match_s': done - loaded, 'baseline_rss_mb': baseline_rss,
+            'peak_rss_mb': peak_rss, 'peak_worker_rss_mb': peak_worker_rss}
+
+
+def run_networking(paths, graphml_path, metadata_path, networking_params):
+    """Load the query spectra and generate their molecular network, in a fresh process (see run_isolated())
+
+    Returns:
+        dict: Loading and networking times (s) and peak RSS (MB)
+    """
+
+    baseline_rss, _ = _peak_rss_mb()
+    start = time.perf_counter()
+    spectra_query = load_query_spectra(paths['queries'])
+    loaded = time.perf_counter()
+    generate_mn(spectra_query, graphml_path, metadata_path, **networking_params)
+    done = time.perf_counter()
+    peak_rss, peak_worker_rss = _peak_rss_mb()
+    return {'load_s': loaded - start, 'match_s': done - loaded, 'baseline_rss_mb': baseline_rss,
+            'peak_rss_mb': peak_rss, 'peak_worker_rss_mb': peak_worker_rss}
+
+
+def run_isolated(function, *args):
+    """Run a benchmark function in a new (spawned) process, so that its peak RSS is its own"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def compare_hits(hits_path, reference_path):
+    """Compare the spectral hits of a run with those of a reference run
+
+    Args:
+        hits_path (str): Spectral matching results of the run
+        reference_path (str): Spectral matching results of the reference run
+
+    Returns:
+        dict: Number of reference hits found (recall), of hits not in the reference, largest score \
+            difference on the common hits, and whether the hit sets are identical
+    """
+
+    def read_hits(path):
+        df = pd.read_csv(path, sep='\t', index_col=0)
+        if len(df.columns) == 0:
+            return pd.Series(dtype=np.float64)
+        return df.set_index(['feature_id', 'reference_id'])['msms_score']
+
+    hits, reference = read_hits(hits_path), read_hits(reference_path)
+    common = hits.index.intersection(reference.index)
+    max_score_diff = float((hits[common] - reference[common]).abs().max()) if len(common) else 0.0
+    return {'recall': len(common) / len(reference) if len(reference) else 1.0,
+            'n_extra_hits': len(hits) - len(common),
+            'max_score_diff': max_score_diff,
+            'same_hits': len(common) == len(hits) == len(reference) and max_score_diff < 1e-6}
+
+
+def compare_networks(graphml_path, reference_graphml_path):
+    """Compare the edges of a molecular network with those of a reference network
+
+    Returns:
+        dict: Share of the reference edges found (recall), number of edges not in the reference, \
+            largest weight difference on the common edges, and whether the edge sets are identical
+    """
+
+    def read_edges(path):
+        graph = nx.read_graphml(path)
+        return {frozenset((s, t)): w for s, t, w in graph.edges(data='weight')}
+
+    edges, reference = read_edges(graphml_path), read_edges(reference_graphml_path)
+    common = edges.keys() & reference.keys()
+    max_score_diff = max((abs(edges[e] - reference[e]) for e in common), default=0.0)
+    return {'recall': len(common) / len(reference) if reference else 1.0,
+            'n_extra_hits': len(edges) - len(common),
+            'max_score_diff': max_score_diff,
+            'same_hits': len(common) == len(edges) == len(reference) and max_score_diff < 1e-6}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            This script benchmarks spectral matching (spectral_lib_matcher.spectral_matching) and molecular networking
+            (molecular_networking.generate_mn) on synthetic spectra. It runs offline and does not use user.yml.
+            Every combination of the given backends, library formats, n_jobs, chunk sizes and prescreen thresholds is run
+            in a fresh process, the first one being the reference of the others.
+             --------------------------------
+                Outputs (in the output directory):
+                - data/: the synthetic query spectra and library, reused while the data parameters do not change
+                - runs/<run name>/: the results of each run
+                - benchmark_results.tsv: for each run, the loading and matching times, throughput (candidate pairs
+                  within the precursor m/z tolerance and queries per second), peak RSS, and the recall and equality
+                  of its hits compared to the reference run (and to the same run of --reference, if given)
+            '''))
+    parser.add_argument('-o', '--output_path', required=True, help='The path to the directory where the benchmark is written')
+    parser.add_argument('--reference', help='Output directory of a previous benchmark, whose runs of the same name are compared')
+    parser.add_argument('--n_queries', type=int, default=2000, help='Number of query spectra')
+    parser.add_argument('--n_library', type=int, default=20000, help='Number of library spectra')
+    parser.add_argument('--n_families', type=int, default=5000, help='Number of structures the spectra are drawn from')
+    parser.add_argument('--n_peaks', type=float, default=30, help='Mean number of fragments of a structure')
+    parser.add_argument('--precursor_distribution', default='uniform', choices=['uniform', 'normal', 'clustered'],
+                        help='Distribution of the precursor m/z of the structures')
+    parser.add_argument('--mz_range', type=float, nargs=2, default=[100.0, 1000.0], help='Range of the precursor m/z')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data')
+    parser.add_argument('--parent_mz_tol', type=float, default=0.01)
+    parser.add_argument('--msms_mz_tol', type=float, default=0.01)
+    parser.add_argument('--min_score', type=float, default=0.2)
+    parser.add_argument('--min_peaks', type=int, default=6)
+    parser.add_argument('--top_k', type=int, default=None)
+    parser.add_argument('--backend', nargs='+', default=['cosine'], choices=['cosine', 'fragment_index'])
+    parser.add_argument('--library_format', nargs='+', default=['columnar'], choices=LIBRARY_FORMATS)
+    parser.add_argument('--n_shards', type=int, default=4, help='Number of shards of the sharded library format')
+    parser.add_argument('--n_jobs', type=int, nargs='+', default=[1])
+    parser.add_argument('--chunk_size', type=int, nargs='+', default=[1000])
+    parser.add_argument('--prescreen_threshold', type=float, nargs='+', default=None,
+                        help='Prescreen thresholds to run, in addition to runs without prescreen')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times each run is repeated, the fastest is reported')
+    parser.add_argument('--networking', action='store_true', help='Also benchmark the molecular networking of the query spectra')
+    parser.add_argument('--mn_msms_mz_tol', type=float, default=0.01)
+    parser.add_argument('--mn_score_cutoff', type=float, default=0.7)
+    parser.add_argument('--mn_top_n', type=int, default=15)
+    parser.add_argument('--mn_max_links', type=int, default=10)
+    parser.add_argument('--mn_approximate', action='store_true',
+                        help='Also run the approximate molecular networking, compared with the exact network')
+    parser.add_argument('--mn_lsh_bands', type=int, default=128)
+    parser.add_argument('--mn_lsh_rows', type=int, default=2)
+    args = parser.parse_args()
+
+    output_path = os.path.normpath(args.output_path)
+    data_params = {key: getattr(args, key) for key in ['n_queries', 'n_library', 'n_families', 'n_peaks',
+                                                        'precursor_distribution', 'mz_range', 'seed']}
+    paths = prepare_data(os.path.join(output_path, 'data'), data_params, args.library_format, args.n_shards)
+
+    # Candidate pairs: the query and library spectra within the precursor m/z tolerance
+    query_precursor_mz = load_queries(paths['queries'])['precursor_mz']
+    library_precursor_mz = spectral_db_to_arrays(load_clean_spectral_db(paths['pkl']))['precursor_mz']
+    n_pairs = len(query_precursor_index(build_precursor_index(library_precursor_mz), query_precursor_mz, args.parent_mz_tol)[0])
+
+    runs = []
+    for backend, library_format, n_jobs, chunk_size, prescreen_threshold in itertools.product(
+            args.backend, args.library_format, args.n_jobs, args.chunk_size, [None] + (args.prescreen_threshold or [])):
+        name = f'{backend}_{library_format}_jobs{n_jobs}_chunk{chunk_size}'
+        if prescreen_threshold is not None:
+            name += f'_prescreen{prescreen_threshold:g}'
+        matching_params = {'parent_mz_tol': args.parent_mz_tol, 'msms_mz_tol': args.msms_mz_tol, 'min_cos': args.min_score,
+                           'min_peaks': args.min_peaks, 'backend': backend, 'n_jobs': n_jobs, 'chunk_size': chunk_size,
+                           'top_k': args.top_k, 'prescreen_threshold': prescreen_threshold}
+        runs.append({'run': name, 'task': 'matching', 'backend': backend, 'library_format': library_format, 'n_jobs': n_jobs,
+                     'chunk_size': chunk_size, 'prescreen_threshold': prescreen_threshold, 'matching_params': matching_params})
+    if args.networking:
+        for n_jobs in args.n_jobs:
+            runs.append({'run': f'networking_jobs{n_jobs}', 'task': 'networking', 'n_jobs': n_jobs, 'approximate': False})
+        if args.mn_approximate:
+            for n_jobs in args.n_jobs:
+                runs.append({'run': f'networking_lsh_jobs{n_jobs}', 'task': 'networking', 'n_jobs': n_jobs, 'approximate': True})
+
+    results = []
+    matching_reference = None
+    networking_reference = None
+    for run in runs:
+        run_path = os.path.join(output_path, 'runs', run['run'])
+        os.makedirs(run_path, exist_ok=True)
+        print(f"Running {run['run']}")
+        timings = []
+        for _ in range(args.repeat):
+            if run['task'] == 'matching':
+                result_path = os.path.join(run_path, 'hits.tsv')
+                timings.append(run_isolated(run_matching, paths, run['library_format'], result_path, run['matching_params']))
+            else:
+                result_path = os.path.join(run_path, 'mn.graphml')
+                networking_params = {'mn_msms_mz_tol': args.mn_msms_mz_tol, 'mn_score_cutoff': args.mn_score_cutoff,
+                                     'mn_top_n': args.mn_top_n, 'mn_max_links': args.mn_max_links, 'n_jobs': run['n_jobs'],
+                                     'approximate': run['approximate'], 'lsh_bands': args.mn_lsh_bands, 'lsh_rows': args.mn_lsh_rows}
+                timings.append(run_isolated(run_networking, paths, result_path, os.path.join(run_path, 'mn_metadata.tsv'), networking_params))
+        result = {key: value for key, value in run.items() if key != 'matching_params'}
+        result.update(min(timings, key=lambda t: t['match_s']))
+
+        if run['task'] == 'matching':
+            result['n_pairs'] = n_pairs
+            result['pairs_per_s'] = n_pairs / result['match_s']
+            result['queries_per_s'] = len(query_precursor_mz) / result['match_s']
+            if matching_reference is None:
+                matching_reference = result_path
+            result.update(compare_hits(result_path, matching_reference))
+        else:
+            result['n_pairs'] = len(query_precursor_mz) * (len(query_precursor_mz) - 1) // 2
+            result['pairs_per_s'] = result['n_pairs'] / result['match_s']
+            result['queries_per_s'] = len(query_precursor_mz) / result['match_s']
+            if networking_reference is None:
+                networking_reference = result_path
+            result.update(compare_networks(result_path, networking_reference))
+        if args.reference is not None:
+            reference_path = os.path.join(args.reference, 'runs', run['run'], os.path.basename(result_path))
+            if os.path.isfile(reference_path):
+                compare = compare_hits if run['task'] == 'matching' else compare_networks
+                result.update({key + '_vs_reference': value for key, value in compare(result_path, reference_path).items()})
+        results.append(result)
+
+    results = pd.DataFrame(results)
+    results.to_csv(os.path.join(output_path, 'benchmark_results.tsv'), sep='\t', index=False)
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(results.drop(columns=['baseline_rss_mb', 'n_pairs'], errors='ignore').round(3).to_string(index=False))
+    print(f"Results of the benchmark were written in {os.path.join(output_path, 'benchmark_results.tsv')}")
+
+
+if __name__ == '__main__':
+    main()
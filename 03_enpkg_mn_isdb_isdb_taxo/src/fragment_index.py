@@ -0,0 +1,147 @@
+import numba
+import numpy as np
+
+
+def build_fragment_index(spectral_db_arrays):
+    """Build an inverted index from fragment m/z to library spectra
+
+    All library peaks are sorted by m/z, so that the library spectra sharing a fragment with a query \
+        are found with a binary search on each query peak.
+
+    Args:
+        spectral_db_arrays (dict): Array representation of the spectral db (output of spectral_db_to_arrays())
+
+    Returns:
+        dict: Sorted peak m/z ('mz'), peak intensities normalized by the norm of their spectrum ('intensities'), \
+            index of the spectrum of each peak ('spectrum') and library precursor m/z ('precursor_mz')
+    """
+
+    offsets = np.asarray(spectral_db_arrays['offsets'])
+    intensities = np.asarray(spectral_db_arrays['intensities'], dtype=np.float64)
+    n_peaks = np.diff(offsets)
+    spectrum = np.repeat(np.arange(len(n_peaks), dtype=np.int64), n_peaks)
+    norms = np.sqrt(np.bincount(spectrum, weights=intensities ** 2, minlength=len(n_peaks)))
+
+    order = np.argsort(np.asarray(spectral_db_arrays['mz']), kind='stable')
+    return {'mz': np.asarray(spectral_db_arrays['mz'], dtype=np.float64)[order],
+            'intensities': (intensities / norms[spectrum])[order],
+            'spectrum': spectrum[order],
+            'precursor_mz': np.asarray(spectral_db_arrays['precursor_mz'], dtype=np.float64)}
+
+
+@numba.njit(nogil=True)
+def _search_fragment_index(index_mz, index_intensities, index_spectrum, library_precursor_mz,
+                           query_mz, query_intensities, query_offsets, query_precursor_mz,
+                           tolerance, precursor_tolerance, min_score, min_peaks):
+    """Accumulate the fragment matches of each query over the index and keep the library spectra above the bounds"""
+    n_library = library_precursor_mz.shape[0]
+    score = np.zeros(n_library, dtype=np.float64)
+    count = np.zeros(n_library, dtype=np.int64)
+    peak_best = np.zeros(n_library, dtype=np.float64)
+    peak_stamp = np.full(n_library, -1, dtype=np.int64)
+    touched_query = np.empty(n_library, dtype=np.int64)
+    touched_peak = np.empty(n_library, dtype=np.int64)
+
+    size = 1024
+    hits_query = np.empty(size, dtype=np.int64)
+    hits_library = np.empty(size, dtype=np.int64)
+    n_hits = 0
+
+    for q in range(query_offsets.shape[0] - 1):
+        start, end = query_offsets[q], query_offsets[q + 1]
+        norm = np.sqrt(np.sum(query_intensities[start:end] ** 2))
+        n_touched_query = 0
+        for p in range(start, end):
+            n_touched_peak = 0
+            k = np.searchsorted(index_mz, query_mz[p] - tolerance)
+            while k < index_mz.shape[0] and index_mz[k] <= query_mz[p] + tolerance:
+                s = index_spectrum[k]
+                if precursor_tolerance < 0 or abs(library_precursor_mz[s] - query_precursor_mz[q]) <= precursor_tolerance:
+                    product = query_intensities[p] / norm * index_intensities[k]
+                    # A query peak contributes once per library spectrum, with its best matching peak
+                    if peak_stamp[s] != p:
+                        peak_stamp[s] = p
+                        peak_best[s] = product
+                        touched_peak[n_touched_peak] = s
+                        n_touched_peak += 1
+                    elif product > peak_best[s]:
+                        peak_best[s] = product
+                k += 1
+            for t in range(n_touched_peak):
+                s = touched_peak[t]
+                if count[s] == 0:
+                    touched_query[n_touched_query] = s
+                    n_touched_query += 1
+                score[s] += peak_best[s]
+                count[s] += 1
+        for t in np.sort(touched_query[:n_touched_query]):
+            if score[t] > min_score and count[t] > min_peaks:
+                if n_hits == size:
+                    size *= 2
+                    hits_query = np.concatenate((hits_query, np.empty(size - n_hits, dtype=np.int64)))
+                    hits_library = np.concatenate((hits_library, np.empty(size - n_hits, dtype=np.int64)))
+                hits_query[n_hits] = q
+                hits_library[n_hits] = t
+                n_hits += 1
+            score[t] = 0.0
+            count[t] = 0
+    return hits_query[:n_hits], hits_library[:n_hits]
+
+
+def search_fragment_index(fragment_index, query_mz, query_intensities, query_offsets, query_precursor_mz,
+                          msms_mz_tol, min_cos, min_peaks, parent_mz_tol=None):
+    """Find the library spectra that can match each query by walking only the query peaks through the fragment index
+
+    For every library spectrum, each query peak adds the product with its best matching fragment. This is an \
+        upper bound of the greedy cosine score and of its number of matched peaks, so no pair passing min_cos \
+        and min_peaks with CosineGreedy is missed. The pairs returned should be rescored exactly.
+
+    Args:
+        fragment_index (dict): Output of build_fragment_index()
+        query_mz, query_intensities, query_offsets (np.ndarray): Peak arrays of the query spectra
+        query_precursor_mz (np.ndarray): Precursor m/z of the query spectra
+        msms_mz_tol (float): m/z tolerance in Da for matching fragments
+        min_cos (float): minimal cosine score
+        min_peaks (int): minimum number of matching fragments
+        parent_mz_tol (float, optional): Precursor m/z tolerance in Da (identity search). \
+            If None, all library spectra are searched (analog search).
+
+    Returns:
+        tuple: Query indices (np.ndarray) and library indices (np.ndarray) of the candidate pairs
+    """
+
+    # The bound is compared with a small margin so that rounding cannot discard a pair at the threshold
+    return _search_fragment_index(fragment_index['mz'], fragment_index['intensities'], fragment_index['spectrum'],
+                                  fragment_index['precursor_mz'],
+                                  np.asarray(query_mz, dtype=np.float64), np.asarray(query_intensities, dtype=np.float64),
+                                  np.asarray(query_offsets, dtype=np.int64), np.asarray(query_precursor_mz, dtype=np.float64),
+                                  float(msms_mz_tol), -1.0 if parent_mz_tol is None else float(parent_mz_tol),
+                                  float(min_cos) - 1e-9, int(min_peaks))
+
+
+def build_network_index(mz, offsets, precursor_mz, block_size):
+    """Build an inverted index from fragment m/z and neutral loss to spectra, for each block of spectra
+
+    Used by molecular networking to find the spectra of a block sharing a fragment or a neutral loss \
+        (precursor m/z - fragment m/z) with a given spectrum, as the modified cosine matches both.
+
+    Args:
+        mz (np.ndarray): Concatenated peak m/z of the spectra (see similarity_kernels.spectra_to_peak_arrays())
+        offsets (np.ndarray): Offsets of the peaks of each spectrum in mz
+        precursor_mz (np.ndarray): Precursor m/z of each spectrum
+        block_size (int): Number of spectra per block
+
+    Returns:
+        dict: Fragment m/z ('mz') and neutral losses ('loss') sorted within each block, with the index of \
+            their spectrum ('mz_spectrum', 'loss_spectrum'). The entries of the block of spectra start:end are \
+            offsets[start]:offsets[end].
+    """
+
+    n_peaks = np.diff(offsets)
+    spectrum = np.repeat(np.arange(len(n_peaks), dtype=np.int64), n_peaks)
+    loss = precursor_mz[spectrum] - mz
+    block = spectrum // block_size
+    mz_order = np.lexsort((mz, block))
+    loss_order = np.lexsort((loss, block))
+    return {'mz': mz[mz_order], 'mz_spectrum': spectrum[mz_order],
+            'loss': loss[loss_order], 'loss_spectrum': spectrum[loss_order]}
@@ -0,0 +1,251 @@
+import os
+import sys
+from pathlib import Path
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+from spectral_db_loader import load_clean_spectral_db
+from spectral_db_loader import spectral_db_to_arrays
+from spectral_db_loader import save_columnar_spectral_db
+from spectral_db_loader import load_columnar_spectral_db
+from spectral_lib_matcher import spectral_matching
+from peak_preprocessing import spectra_to_query_arrays, select_spectra
+from matching_cache import spectral_db_hash, cache_key, is_cached, write_cache_key
+sys.path.append(os.path.join(Path(__file__).parents[2], 'src'))
+from table_io import read_table, write_table
+
+
+def is_sharded_spectral_db(path_to_db):
+    """Check whether a spectral db path is a sharded spectral db (see split_spectral_db())"""
+    return type(path_to_db) is str and os.path.isfile(os.path.join(path_to_db, 'shards.json'))
+
+
+def _take_spectra(spectral_db_arrays, idx):
+    """Array representation of a subset of the spectra of a spectral db"""
+    offsets = np.asarray(spectral_db_arrays['offsets'])
+    starts = offsets[idx]
+    n_peaks = offsets[idx + 1] - starts
+    new_offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+    np.cumsum(n_peaks, out=new_offsets[1:])
+    positions = np.repeat(starts - new_offsets[:-1], n_peaks) + np.arange(new_offsets[-1])
+    return {'mz': np.asarray(spectral_db_arrays['mz'])[positions],
+            'intensities': np.asarray(spectral_db_arrays['intensities'])[positions],
+            'offsets': new_offsets,
+            'precursor_mz': np.asarray(spectral_db_arrays['precursor_mz'])[idx],
+            'short_inchikey': np.asarray(spectral_db_arrays['short_inchikey'])[idx]}
+
+
+def split_spectral_db(path_to_db, output_path, n_shards):
+    """Split a spectral db into shards of consecutive precursor m/z ranges
+
+    The input files are converted one at a time and each shard is then gathered from their memory-mapped \
+        arrays, so neither step needs the whole library in memory. Each shard is a columnar spectral db \
+        with a reference_id.npy array holding the reference_id of its spectra in the unsplit library, \
+        so that sharded and unsharded matching report the same reference_id.
+
+    Args:
+        path_to_db (str or list): Path to the .mgf or .pkl file, list of .mgf files or directory of a columnar spectral db
+        output_path (str): Directory to write the sharded spectral db to
+        n_shards (int): Number of shards, of about the same number of spectra
+    """
+
+    paths = path_to_db if type(path_to_db) is list else [path_to_db]
+    parts_path = os.path.join(output_path, 'parts')
+
+    parts = []
+    for i, path in enumerate(paths):
+        spectral_db = load_clean_spectral_db(path)
+        if not isinstance(spectral_db, dict):
+            part_path = os.path.join(parts_path, f'part_{i:03d}')
+            save_columnar_spectral_db(spectral_db_to_arrays(spectral_db), part_path, source=path)
+            spectral_db = load_columnar_spectral_db(part_path)
+        parts.append(spectral_db)
+        del spectral_db
+
+    # Shard boundaries at the quantiles of the precursor m/z, spectra without precursor m/z go to the last shard
+    precursor_mz = np.concatenate([np.asarray(part['precursor_mz']) for part in parts])
+    sorted_mz = np.sort(precursor_mz[~np.isnan(precursor_mz)])
+    bounds = np.unique(sorted_mz[(np.arange(1, int(n_shards)) * len(sorted_mz)) // int(n_shards)]) if len(sorted_mz) else np.zeros(0)
+    if len(bounds) and not (precursor_mz < bounds[0]).any():
+        # The lowest precursor m/z is repeated beyond the first quantile, the first shard would be empty
+        bounds = bounds[1:]
+    shard_of = np.searchsorted(bounds, precursor_mz, side='right')
+    first_reference_id = np.cumsum([1] + [len(part['precursor_mz']) for part in parts])
+
+    shards = []
+    for k in range(len(bounds) + 1):
+        pieces = []
+        reference_ids = []
+        for part, part_shard_of, first in zip(parts, np.split(shard_of, first_reference_id[1:-1] - 1), first_reference_id):
+            idx = np.flatnonzero(part_shard_of == k)
+            pieces.append(_take_spectra(part, idx))
+            reference_ids.append(first + idx)
+        shard = {key: np.concatenate([piece[key] for piece in pieces]) for key in ['mz', 'intensities', 'precursor_mz', 'short_inchikey']}
+        shard['offsets'] = np.concatenate([[0]] + [piece['offsets'][1:] + n for piece, n in
+                                                   zip(pieces, np.cumsum([0] + [len(piece['mz']) for piece in pieces[:-1]]))])
+        shard_path = f'shard_{k:03d}'
+        save_columnar_spectral_db(shard, os.path.join(output_path, shard_path), source=path_to_db)
+        np.save(os.path.join(output_path, shard_path, 'reference_id.npy'), np.concatenate(reference_ids).astype(np.int64))
+        shards.append({'path': shard_path,
+                       'precursor_mz_from': float(bounds[k - 1]) if k > 0 else None,
+                       'precursor_mz_to': float(bounds[k]) if k < len(bounds) else None,
+                       'n_spectra': int(len(shard['precursor_mz']))})
+
+    del parts
+    shutil.rmtree(parts_path, ignore_errors=True)
+    manifest = {'format_version': 1, 'n_spectra': int(len(precursor_mz)), 'source': path_to_db, 'shards': shards}
+    with open(os.path.join(output_path, 'shards.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f'''
+    A total of {manifest['n_spectra']} spectra were split into {len(shards)} shards in {output_path}
+    ''')
+
+
+def load_sharded_spectral_db(path_to_db):
+    """Read the manifest of a sharded spectral db, the shards themselves are opened when matching
+
+    Args:
+        path_to_db (str): Directory of the sharded spectral db
+
+    Returns:
+        dict: The manifest, with the absolute 'path' of each shard
+    """
+
+    with open(os.path.join(path_to_db, 'shards.json')) as f:
+        manifest = json.load(f)
+    for shard in manifest['shards']:
+        shard['path'] = os.path.join(path_to_db, shard['path'])
+
+    print(f'''
+    A total of {manifest['n_spectra']} clean spectra were found in the {len(manifest['shards'])} shards of the spectral library
+    ''')
+    return manifest
+
+
+def route_queries(shard, query_precursor_mz, parent_mz_tol):
+    """Select the queries whose precursor m/z window overlaps the precursor m/z range of a shard
+
+    Args:
+        shard (dict): A shard of the manifest (output of load_sharded_spectral_db())
+        query_precursor_mz (np.ndarray): Precursor m/z of the query spectra
+        parent_mz_tol (float): Precursor m/z tolerance in Da, or None to send all queries (analog search)
+
+    Returns:
+        np.ndarray: Mask of the queries to match against the shard
+    """
+
+    if parent_mz_tol is None:
+        return np.ones(len(query_precursor_mz), dtype=bool)
+    # Same small margin as query_precursor_index(), which then applies the exact tolerance
+    tolerance = float(parent_mz_tol) + 1e-6
+    routed = ~np.isnan(query_precursor_mz)
+    if shard['precursor_mz_from'] is not None:
+        routed &= query_precursor_mz + tolerance >= shard['precursor_mz_from']
+    if shard['precursor_mz_to'] is not None:
+        routed &= query_precursor_mz - tolerance < shard['precursor_mz_to']
+    return routed
+
+
+def merge_shard_hits(shard_results_paths, output_file_path, top_k=None, collapse_structures=False, table_format='tsv'):
+    """Merge the hits of the shards (or of successive parts of a library) into one spectral matching result file
+
+    Args:
+        shard_results_paths (list): Paths of the spectral matching results of each shard, read from Parquet if available
+        output_file_path (str): Path to write the merged results
+        top_k (int, optional): Number of best hits to keep per feature_id. Defaults to None (all hits are kept).
+        collapse_structures (bool, optional): Keep only the best hit of each structure (short InChIKey) \
+            for each feature_id. Defaults to False.
+        table_format (str, optional): Write the merged results in 'tsv', 'parquet' or 'both'. Defaults to 'tsv'.
+    """
+
+    hits = []
+    for path in shard_results_paths:
+        df = read_table(path, index_col=0)
+        if len(df.columns):
+            hits.append(df)
+    if len(hits) == 0:
+        write_table(pd.DataFrame(), output_file_path, table_format)
+        return
+    df = pd.concat(hits).sort_values(['feature_id', 'msms_score', 'reference_id'], ascending=[True, False, True], kind='stable')
+    if collapse_structures:
+        # A structure can have spectra in several shards (e.g. different adducts)
+        structure = df['short_inchikey'].where(df['short_inchikey'].notna(), 'reference_' + df['reference_id'].astype(str))
+        df = df[~pd.DataFrame({'feature_id': df['feature_id'], 'structure': structure}).duplicated()]
+    if top_k is not None:
+        df = df.groupby('feature_id', sort=False).head(int(top_k))
+    write_table(df.reset_index(drop=True), output_file_path, table_format)
+
+
+def sharded_spectral_matching(spectrums_query, sharded_db, parent_mz_tol, msms_mz_tol, min_cos, min_peaks,
+        output_file_path, shards_folder_path, shards=None, cache_key_parts=None, use_cache=True, table_format='tsv', **matching_params):
+    """Performs spectra matching against a sharded spectral db, one shard at a time
+
+    Each query is only matched against the shards its precursor m/z window overlaps (all shards for an \
+        analog search). The hits of each shard are written in shards_folder_path and reused while their cache \
+        key is unchanged, so shards can also be matched by separate processes or hosts sharing the file system \
+        (see the shards parameter) and merged by the last run.
+
+    Args:
+        spectrums_query (list or dict): List of matchms spectra objects to query, or their array representation \
+            (output of query_spectrum_arrays())
+        sharded_db (dict): Manifest of the sharded spectral db (output of load_sharded_spectral_db())
+        parent_mz_tol (float): Precursor m/z tolerance in Da for matching
+        msms_mz_tol (float): m/z tolerance in Da for matching fragments
+        min_cos (float): minimal cosine score
+        min_peaks (int): minimum number of matching fragments
+        output_file_path (str): path to write the merged results
+        shards_folder_path (str): Directory of the results of each shard
+        shards (list, optional): Numbers of the shards to match in this run, the others are expected to be \
+            matched by another run. Defaults to None (all shards).
+        cache_key_parts (dict, optional): Inputs and parameters of the matching (see cache_key()), \
+            completed with the hash of each shard. Defaults to None (shard results are not reused).
+        use_cache (bool, optional): Reuse the shard results matching their cache key. Defaults to True.
+        table_format (str, optional): Write the merged results in 'tsv', 'parquet' or 'both', \
+            the results of each shard are always written in .tsv. Defaults to 'tsv'.
+        **matching_params: Other parameters of spectral_matching()
+
+    Returns:
+        bool: True if all the shards were matched and merged in output_file_path, \
+            False if some shards left to other runs are not matched yet
+    """
+
+    analog_search = matching_params.get('analog_search', False) and matching_params.get('backend') == 'fragment_index'
+    if not isinstance(spectrums_query, dict):
+        spectrums_query = spectra_to_query_arrays(spectrums_query)
+    query_precursor_mz = spectrums_query['precursor_mz']
+    os.makedirs(shards_folder_path, exist_ok=True)
+
+    shard_results_paths = []
+    complete = True
+    for k, shard in enumerate(sharded_db['shards']):
+        shard_name = os.path.basename(shard['path'])
+        shard_results_path = os.path.join(shards_folder_path, shard_name + '.tsv')
+        shard_cache_path = os.path.join(shards_folder_path, shard_name + '_cache.json')
+        shard_results_paths.append(shard_results_path)
+        key = cache_key(**cache_key_parts, shard_hash=spectral_db_hash(shard['path'])) if cache_key_parts is not None else None
+        if key is not None and use_cache and is_cached([shard_results_path], shard_cache_path, key):
+            continue
+        if shards is not None and k not in shards:
+            complete = False
+            continue
+
+        routed = route_queries(shard, query_precursor_mz, None if analog_search else parent_mz_tol)
+        print(f'Matching {routed.sum()} query spectra against {shard_name}')
+        if not routed.any():
+            pd.DataFrame().to_csv(shard_results_path, sep='\t')
+        else:
+            spectral_matching(select_spectra(spectrums_query, routed), load_columnar_spectral_db(shard['path']),
+                              parent_mz_tol, msms_mz_tol, min_cos, min_peaks, shard_results_path,
+                              reference_ids=np.load(os.path.join(shard['path'], 'reference_id.npy'), mmap_mode='r'), **matching_params)
+            if not os.path.exists(shard_results_path):
+                pd.DataFrame().to_csv(shard_results_path, sep='\t')
+        if key is not None:
+            write_cache_key(shard_cache_path, key)
+
+    if complete:
+        merge_shard_hits(shard_results_paths, output_file_path, top_k=matching_params.get('top_k'),
+                         collapse_structures=matching_params.get('collapse_structures', False), table_format=table_format)
+    return complete
@@ -0,0 +1,157 @@
+import os
+import json
+import hashlib
+
+
+def file_hash(path):
+    """Compute the SHA-256 of a file content
+
+    Args:
+        path (str): Path to the file
+
+    Returns:
+        str: Hexadecimal digest
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _memoized_file_hash(path):
+    """SHA-256 of a file, memoized in a <path>.sha256 sidecar valid as long as the file size and mtime do not change"""
+    stat = os.stat(path)
+    sidecar_path = path + '.sha256'
+    try:
+        with open(sidecar_path) as f:
+            sidecar = json.load(f)
+        if sidecar['size'] == stat.st_size and sidecar['mtime_ns'] == stat.st_mtime_ns:
+            return sidecar['sha256']
+    except (OSError, ValueError, KeyError):
+        pass
+    sha256 = file_hash(path)
+    try:
+        with open(sidecar_path, 'w') as f:
+            json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}, f)
+    except OSError:
+        pass
+    return sha256
+
+
+def spectral_db_hash(path_to_db):
+    """Compute a content hash of a spectral db
+
+    Hashes of large library files are memoized next to them, so the library is only read again when it changes.
+
+    Args:
+        path_to_db (str or list): Path to the .mgf or .pkl file, list of .mgf files or directory of a columnar \
+            or sharded spectral db
+
+    Returns:
+        str: Hexadecimal digest
+    """
+
+    if type(path_to_db) is list:
+        paths = path_to_db
+    elif os.path.isfile(os.path.join(path_to_db, 'shards.json')):
+        # Sharded spectral db: the manifest and the content of each shard
+        with open(os.path.join(path_to_db, 'shards.json')) as f:
+            shards = json.load(f)['shards']
+        digest = hashlib.sha256(_memoized_file_hash(os.path.join(path_to_db, 'shards.json')).encode())
+        for shard in shards:
+            digest.update(spectral_db_hash(os.path.join(path_to_db, shard['path'])).encode())
+        return digest.hexdigest()
+    elif os.path.isdir(path_to_db):
+        paths = [os.path.join(path_to_db, file) for file in sorted(os.listdir(path_to_db))
+                 if file.endswith('.npy') or file == 'spectral_db.json']
+    else:
+        paths = [path_to_db]
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(_memoized_file_hash(path).encode())
+    return digest.hexdigest()
+
+
+def cache_key(**parts):
+    """Build a cache key from the inputs and parameters a result depends on
+
+    Args:
+        **parts: Content hashes and parameters (JSON serializable)
+
+    Returns:
+        dict: The parts and their combined 'key'
+    """
+
+    key = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+    return {'key': key, 'parts': parts}
+
+
+def is_cached(result_paths, cache_path, key):
+    """Check whether results were computed with the given cache key
+
+    Args:
+        result_paths (list): Paths of the result files, which must all exist
+        cache_path (str): Path to the cache key file written with the results
+        key (dict): Output of cache_key()
+
+    Returns:
+        bool: True if the results can be reused
+    """
+
+    if not all(os.path.exists(path) for path in result_paths):
+        return False
+    try:
+        with open(cache_path) as f:
+            return json.load(f)['key'] == key['key']
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def write_cache_key(cache_path, key):
+    """Record the cache key of freshly computed results
+
+    Args:
+        cache_path (str): Path to the cache key file
+        key (dict): Output of cache_key()
+    """
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path, 'w') as f:
+        json.dump(key, f, indent=2, sort_keys=True, default=str)
+
+
+def cached_library_version(result_paths, cache_path, key, library_history):
+    """Find the previous library version cached spectral matching results were computed against
+
+    The results can be brought up to date by matching only the library spectra added since that version, \
+        when all their other inputs and parameters are unchanged.
+
+    Args:
+        result_paths (list): Paths of the result files, which must all exist
+        cache_path (str): Path to the cache key file written with the results
+        key (dict): Cache key of the results against the current library (output of cache_key()), \
+            with a 'spectral_db_hash' part
+        library_history (list): Previous versions of the library (output of columnar_spectral_db_history())
+
+    Returns:
+        int or None: Number of library spectra the results were computed against, None if the results \
+            cannot be completed
+    """
+
+    if not library_history or not all(os.path.exists(path) for path in result_paths):
+        return None
+    try:
+        with open(cache_path) as f:
+            cached_parts = json.load(f)['parts']
+    except (OSError, ValueError, KeyError):
+        return None
+    parts = key['parts']
+    if {k: v for k, v in cached_parts.items() if k != 'spectral_db_hash'} != \
+            json.loads(json.dumps({k: v for k, v in parts.items() if k != 'spectral_db_hash'}, default=str)):
+        return None
+    for version in library_history:
+        if version['spectral_db_hash'] == cached_parts.get('spectral_db_hash'):
+            return version['n_spectra']
+    return None
@@ -1,22 +1,288 @@
 import os
+import sys
+from pathlib import Path
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-from matchms import calculate_scores
-from matchms.similarity import ModifiedCosine
-from matchms.networking import SimilarityNetwork
 import networkx as nx
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from query_dedup import representative_spectra
+from similarity_kernels import spectra_to_peak_arrays, prefix_peaks, modified_cosine_top_n, modified_cosine_pairs, \
+    modified_cosine_neighbours, keep_top_n_pairs
+from fragment_index import build_network_index
+from spectrum_lsh import lsh_candidate_pairs
+sys.path.append(os.path.join(Path(__file__).parents[2], 'src'))
+from table_io import write_table
 
-def connected_component_subgraphs(G):
-            for c in nx.connected_components(G):
-                yield G.subgraph(c)
-             
-def sorted_connected_component_subgraphs(G):
-            for c in sorted(nx.connected_components(G), key=len, reverse=True):
-                yield G.subgraph(c)
-                
-def generate_mn(spectra_query, mn_graphml_ouput_path, mn_ci_ouput_path, mn_msms_mz_tol, mn_score_cutoff, mn_top_n, mn_max_links):
+# Peak arrays and parameters of the ongoing top_n_neighbours() or approximate_top_n_neighbours() call, 
+# inherited by the forked workers
+_networking_context = {}
+
+
+def _tile_spectra(tile):
+    """Spectra whose neighbours are scored in a tile: its rows, then its columns if they are not the rows"""
+    row_start, row_end, col_start, col_end = tile
+    if col_start == row_start:
+        return np.arange(row_start, row_end)
+    return np.concatenate([np.arange(row_start, row_end), np.arange(col_start, col_end)])
+
+
+def _score_tile(tile):
+    """Score one tile of the pairs of the ongoing top_n_neighbours() call
+
+    Returns:
+        tuple: Indices and scores of the top_n neighbours of the spectra of the tile (see _tile_spectra()) \
+            among the other spectra of the tile
+    """
+
+    context = _networking_context
+    index = context['index']
+    n_tile_spectra = len(_tile_spectra(tile))
+    top_idx = np.full((n_tile_spectra, context['top_n']), -1, dtype=np.int64)
+    top_scores = np.zeros((n_tile_spectra, context['top_n']), dtype=np.float64)
+    # Index entries of the spectra of the columns
+    start, end = context['offsets'][tile[2]], context['offsets'][tile[3]]
+    modified_cosine_top_n(context['mz'], context['intensities'], context['offsets'], context['precursor_mz'],
+                          context['norms'], context['prefix'], index['mz'][start:end], index['mz_spectrum'][start:end],
+                          index['loss'][start:end], index['loss_spectrum'][start:end], *tile, context['mz_tol'],
+                          context['min_score'], top_idx, top_scores)
+    return top_idx, top_scores
+
+
+def _merge_top_n(top_idx, top_scores, spectra, tile_idx, tile_scores):
+    """Merge the neighbours found in a tile into the top_n neighbours of its spectra (ties go to the highest index)"""
+    top_n = top_idx.shape[1]
+    candidates_idx = np.concatenate([top_idx[spectra], tile_idx], axis=1)
+    candidates_scores = np.concatenate([top_scores[spectra], tile_scores], axis=1)
+    order = np.lexsort((candidates_idx, candidates_scores), axis=1)[:, ::-1][:, :top_n]
+    top_idx[spectra] = np.take_along_axis(candidates_idx, order, axis=1)
+    top_scores[spectra] = np.take_along_axis(candidates_scores, order, axis=1)
+
+
+def top_n_neighbours(spectra, mz_tol, top_n, min_score=0.0, n_jobs=1, block_size=500):
+    """Find the top_n neighbours of each spectrum by modified cosine score
+
+    The upper triangle of the score matrix is split into tiles of block_size x block_size pairs. Each tile \
+        only keeps the best top_n neighbours of its spectra, which are merged into those of the other tiles, \
+        so that memory scales with n_spectra * top_n instead of n_spectra ** 2. Only the pairs that may score \
+        >= min_score are scored: those sharing a fragment or a neutral loss with the strongest peaks of a spectrum \
+        (see similarity_kernels.prefix_peaks()) and whose Cauchy-Schwarz bound reaches min_score.
+
+    Args:
+        spectra (list): A list of matchms spectra objects
+        mz_tol (float): Tolerance in Da for MS/MS fragments matching
+        top_n (int): Number of neighbours kept per spectrum
+        min_score (float, optional): Minimal score of the neighbours kept. Defaults to 0.0 (all pairs with a score).
+        n_jobs (int, optional): Number of processes scoring tiles concurrently. The workers are forked \
+            and share the peak arrays. Defaults to 1.
+        block_size (int, optional): Number of spectra per side of a tile. Defaults to 500.
+
+    Returns:
+        tuple: (n_spectra, top_n) indices (np.ndarray, -1 for empty slots) and scores (np.ndarray) \
+            of the neighbours of each spectrum
+    """
+
+    mz, intensities, offsets = spectra_to_peak_arrays(spectra)
+    n_spectra = len(spectra)
+    norms = np.sqrt(np.bincount(np.repeat(np.arange(n_spectra), np.diff(offsets)), weights=intensities ** 2,
+                                minlength=n_spectra))
+    top_idx = np.full((n_spectra, top_n), -1, dtype=np.int64)
+    top_scores = np.zeros((n_spectra, top_n), dtype=np.float64)
+    blocks = [(start, min(start + block_size, n_spectra)) for start in range(0, n_spectra, block_size)]
+    tiles = [rows + columns for k, rows in enumerate(blocks) for columns in blocks[k:]]
+
+    precursor_mz = np.array([s.get('precursor_mz') for s in spectra], dtype=np.float64)
+
+    _networking_context.update({'mz': mz, 'intensities': intensities, 'offsets': offsets, 'norms': norms,
+        'precursor_mz': precursor_mz, 'prefix': prefix_peaks(intensities, offsets, norms, float(min_score)),
+        'index': build_network_index(mz, offsets, precursor_mz, block_size),
+        'mz_tol': float(mz_tol), 'min_score': float(min_score), 'top_n': int(top_n)})
+    if int(n_jobs) > 1 and len(tiles) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        # Forked workers inherit _networking_context: the peak arrays are shared, not pickled.
+        # The kernel is compiled on an empty tile first, so that the workers do not each compile it.
+        _score_tile((0, 0, 0, 0))
+        executor = ProcessPoolExecutor(max_workers=min(int(n_jobs), len(tiles)),
+                                       mp_context=multiprocessing.get_context('fork'))
+        results = executor.map(_score_tile, tiles)
+    else:
+        executor = None
+        results = map(_score_tile, tiles)
+    try:
+        for tile, (tile_idx, tile_scores) in zip(tiles, results):
+            _merge_top_n(top_idx, top_scores, _tile_spectra(tile), tile_idx, tile_scores)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        _networking_context.clear()
+    return top_idx, top_scores
+
+
+def _score_pairs(chunk):
+    """Score one chunk of the candidate pairs of the ongoing approximate_top_n_neighbours() call
+
+    Returns:
+        tuple: Spectra (np.ndarray, np.ndarray) and scores (np.ndarray) of the pairs scoring >= min_score
+    """
+
+    context = _networking_context
+    idx_1, idx_2 = chunk
+    scores = modified_cosine_pairs(context['mz'], context['intensities'], context['offsets'], context['precursor_mz'],
+                                   context['norms'], idx_1, idx_2, context['mz_tol'], context['min_score'])
+    kept = (scores > 0) & (scores >= context['min_score'])
+    return idx_1[kept], idx_2[kept], scores[kept]
+
+
+def _candidate_recall(idx_1, idx_2, sample_size, seed=0):
+    """Share of the pairs scoring >= min_score of a random sample of spectra that are among the candidate pairs
+
+    The pairs of the sampled spectra are found exactly, as by top_n_neighbours().
+
+    Returns:
+        tuple: Estimated recall (float, NaN if the sampled spectra have no such pair) and number of sampled pairs
+    """
+
+    context = _networking_context
+    n_spectra = len(context['offsets']) - 1
+    sample = np.random.default_rng(seed).choice(n_spectra, min(int(sample_size), n_spectra), replace=False)
+    index = build_network_index(context['mz'], context['offsets'], context['precursor_mz'], max(n_spectra, 1))
+    rows, neighbours, _ = modified_cosine_neighbours(np.sort(sample), context['mz'], context['intensities'],
+        context['offsets'], context['precursor_mz'], context['norms'], context['prefix'], index['mz'],
+        index['mz_spectrum'], index['loss'], index['loss_spectrum'], context['mz_tol'], context['min_score'])
+    if len(rows) == 0:
+        return float('nan'), 0
+    # Candidate pairs are sorted and unique (output of lsh_candidate_pairs())
+    keys = np.minimum(rows, neighbours) * n_spectra + np.maximum(rows, neighbours)
+    candidate_keys = idx_1 * n_spectra + idx_2
+    position = np.minimum(np.searchsorted(candidate_keys, keys), max(len(candidate_keys) - 1, 0))
+    found = candidate_keys[position] == keys if len(candidate_keys) else np.zeros(len(keys), dtype=bool)
+    return float(found.mean()), len(keys)
+
+
+def approximate_top_n_neighbours(spectra, mz_tol, top_n, min_score=0.0, n_jobs=1, lsh_bands=128, lsh_rows=2,
+                                 recall_sample_size=1000, chunk_size=100000):
+    """Find approximately the top_n neighbours of each spectrum by modified cosine score
+
+    Only the candidate pairs found by locality-sensitive hashing of the spectra (see spectrum_lsh.lsh_candidate_pairs()) \
+        are scored, with the exact modified cosine. Pairs of similar spectra can be missed: the share of the pairs \
+        scoring >= min_score that are candidates is estimated on a random sample of spectra, whose pairs are found exactly.
+
+    Args:
+        spectra (list): A list of matchms spectra objects
+        mz_tol (float): Tolerance in Da for MS/MS fragments matching
+        top_n (int): Number of neighbours kept per spectrum
+        min_score (float, optional): Minimal score of the neighbours kept. Defaults to 0.0.
+        n_jobs (int, optional): Number of processes scoring candidate pairs concurrently. The workers are forked \
+            and share the peak arrays. Defaults to 1.
+        lsh_bands (int, optional): Number of hash tables. More bands find more pairs. Defaults to 128.
+        lsh_rows (int, optional): Number of hash functions per table. More rows give fewer, more similar pairs. Defaults to 2.
+        recall_sample_size (int, optional): Number of spectra sampled to estimate the recall. Defaults to 1000.
+        chunk_size (int, optional): Number of candidate pairs scored together (and per worker task). Defaults to 100000.
+
+    Returns:
+        tuple: (n_spectra, top_n) indices (np.ndarray, -1 for empty slots) and scores (np.ndarray) of the neighbours \
+            of each spectrum, estimated recall (float) and number of sampled pairs it was estimated on (int)
+    """
+
+    mz, intensities, offsets = spectra_to_peak_arrays(spectra)
+    n_spectra = len(spectra)
+    norms = np.sqrt(np.bincount(np.repeat(np.arange(n_spectra), np.diff(offsets)), weights=intensities ** 2,
+                                minlength=n_spectra))
+    precursor_mz = np.array([s.get('precursor_mz') for s in spectra], dtype=np.float64)
+    top_idx = np.full((n_spectra, top_n), -1, dtype=np.int64)
+    top_scores = np.zeros((n_spectra, top_n), dtype=np.float64)
+    idx_1, idx_2 = lsh_candidate_pairs(mz, intensities, offsets, precursor_mz, n_bands=lsh_bands, n_rows=lsh_rows,
+                                       bin_width=max(0.1, 2 * float(mz_tol)))
+    chunks = [(idx_1[start:start + chunk_size], idx_2[start:start + chunk_size]) for start in range(0, len(idx_1), chunk_size)]
+
+    _networking_context.update({'mz': mz, 'intensities': intensities, 'offsets': offsets, 'norms': norms,
+        'precursor_mz': precursor_mz, 'prefix': prefix_peaks(intensities, offsets, norms, float(min_score)),
+        'mz_tol': float(mz_tol), 'min_score': float(min_score)})
+    if int(n_jobs) > 1 and len(chunks) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        # The kernel is compiled on an empty chunk first, so that the workers do not each compile it
+        _score_pairs((idx_1[:0], idx_2[:0]))
+        executor = ProcessPoolExecutor(max_workers=min(int(n_jobs), len(chunks)),
+                                       mp_context=multiprocessing.get_context('fork'))
+        results = executor.map(_score_pairs, chunks)
+    else:
+        executor = None
+        results = map(_score_pairs, chunks)
+    try:
+        for kept_1, kept_2, scores in results:
+            keep_top_n_pairs(top_idx, top_scores, kept_1, kept_2, scores)
+        recall, n_sampled_pairs = _candidate_recall(idx_1, idx_2, recall_sample_size)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        _networking_context.clear()
+    return top_idx, top_scores, recall, n_sampled_pairs
+
+
+def mutual_top_n_links(top_idx, top_scores, score_cutoff, max_links):
+    """Links of the molecular network of the spectra, from their top_n neighbours
+
+    Same rule as matchms SimilarityNetwork(link_method='mutual'): each spectrum is linked to its best neighbours \
+        scoring >= score_cutoff (at most max_links of them), provided it is itself among the top_n neighbours \
+        of the other spectrum.
+
+    Args:
+        top_idx (np.ndarray): Indices of the top_n neighbours of each spectrum (output of top_n_neighbours())
+        top_scores (np.ndarray): Scores of these neighbours
+        score_cutoff (float): Minimal score for edge creation
+        max_links (int): Maximum number of links to add per node
+
+    Returns:
+        tuple: Indices of the two spectra (np.ndarray, np.ndarray) and score (np.ndarray) of each link. \
+            A link found from both of its spectra is listed twice.
+    """
+
+    if top_idx.shape[1] < max_links:
+        raise ValueError('mn_top_n must be >= mn_max_links')
+    # Neighbours by decreasing score
+    order = np.lexsort((top_idx, top_scores), axis=1)[:, ::-1]
+    neighbours = np.take_along_axis(top_idx, order, axis=1)
+    scores = np.take_along_axis(top_scores, order, axis=1)
+    links = (neighbours >= 0) & (scores >= score_cutoff)
+    links &= np.cumsum(links, axis=1) <= max_links
+    rows, cols = np.nonzero(links)
+    targets = neighbours[rows, cols]
+    mutual = (top_idx[targets] == rows[:, None]).any(axis=1)
+    return rows[mutual], targets[mutual], scores[rows, cols][mutual]
+
+
+def component_ids(n_nodes, idx_1, idx_2):
+    """Label the connected components of a network, from the largest to the smallest
+
+    Components are numbered from 1, components of equal size in the order of their first node. \
+        Nodes without links get -1.
+
+    Args:
+        n_nodes (int): Number of nodes
+        idx_1, idx_2 (np.ndarray): Indices of the two nodes of each link
+
+    Returns:
+        np.ndarray: Component id of each node
+    """
+
+    adjacency = sparse.coo_matrix((np.ones(len(idx_1), dtype=np.int8), (idx_1, idx_2)), shape=(n_nodes, n_nodes))
+    # Labels are given in the order of the first node of each component
+    _, labels = connected_components(adjacency, directed=False)
+    sizes = np.bincount(labels)
+    rank = np.empty(len(sizes), dtype=np.int64)
+    rank[np.argsort(-sizes, kind='stable')] = np.arange(1, len(sizes) + 1)
+    return np.where(sizes[labels] > 1, rank[labels], -1)
+
+
+def generate_mn(spectra_query, mn_graphml_ouput_path, mn_ci_ouput_path, mn_msms_mz_tol, mn_score_cutoff, mn_top_n, mn_max_links, query_groups=None, table_format='tsv', n_jobs=1,
+                approximate=False, lsh_bands=128, lsh_rows=2):
     """Generate a Molecular Network from MS/MS spectra using the modified cosine score
 
+    Only the top_n neighbours of each spectrum are kept while the pairs are scored (see top_n_neighbours()), \
+        so that memory scales with the number of spectra and large sets of spectra can be networked. Pairs that \
+        cannot score >= mn_score_cutoff are not scored: they could neither be linked nor outrank a linked \
+        spectrum in the top_n of the other one, so the network is unchanged.
+
     Args:
         spectra_query (list): A list of matchms spectra objects
         mn_graphml_ouput_path (str): Path to export the .graphml MN file
@@ -27,26 +293,57 @@ def generate_mn(spectra_query, mn_graphml_ouput_path, mn_ci_ouput_path, mn_msms_
             (link_method="single"), or into top_n for spectrumA and spectrumB (link_method="mutual"). From those potential links, \
             only max_links will be kept, so top_n must be >= max_links.
         mn_max_links (int): Maximum number of links to add per node.
+        query_groups (DataFrame, optional): Groups of near-identical spectra (output of group_query_spectra()). \
+            Only their representatives are networked, the other spectra of a group are linked to their representative \
+            (weight is their cosine score) and so share its component. Defaults to None (all spectra are networked).
+        table_format (str, optional): Write the MN metadata in 'tsv', 'parquet' (same path with the .parquet extension) \
+            or 'both'. Defaults to 'tsv'.
+        n_jobs (int, optional): Number of processes scoring the pairs of spectra concurrently. Defaults to 1.
+        approximate (bool, optional): Only score the candidate pairs found by locality-sensitive hashing \
+            (see approximate_top_n_neighbours()), for very large sets of spectra. Some links can be missed, \
+            the estimated share of the pairs found is printed. Defaults to False.
+        lsh_bands (int, optional): Number of hash tables of the approximate mode. Defaults to 128.
+        lsh_rows (int, optional): Number of hash functions per table of the approximate mode. Defaults to 2.
     """    
-    score = ModifiedCosine(tolerance=float(mn_msms_mz_tol))
-    scores = calculate_scores(spectra_query, spectra_query, score, is_symmetric=True)
-    ms_network = SimilarityNetwork(identifier_key="scans", score_cutoff = mn_score_cutoff, top_n = mn_top_n, max_links = mn_max_links, link_method = 'mutual')
-    ms_network.create_network(scores, score_name="ModifiedCosine_score")
+    if query_groups is not None:
+        spectra_network = representative_spectra(spectra_query, query_groups)
+    else:
+        spectra_network = spectra_query
+    if approximate:
+        top_idx, top_scores, recall, n_sampled_pairs = approximate_top_n_neighbours(spectra_network, mn_msms_mz_tol, mn_top_n,
+            min_score=mn_score_cutoff, n_jobs=n_jobs, lsh_bands=lsh_bands, lsh_rows=lsh_rows)
+        if np.isnan(recall):
+            print('Approximate molecular network: no pair of the sampled spectra reaches the score cutoff, recall not estimated')
+        else:
+            print(f'Approximate molecular network: an estimated {recall:.1%} of the pairs scoring >= {mn_score_cutoff} were scored '
+                  f'(on {n_sampled_pairs} pairs of sampled spectra)')
+    else:
+        top_idx, top_scores = top_n_neighbours(spectra_network, mn_msms_mz_tol, mn_top_n, min_score=mn_score_cutoff, n_jobs=n_jobs)
+    idx_1, idx_2, weights = mutual_top_n_links(top_idx, top_scores, mn_score_cutoff, mn_max_links)
+    # Nodes are the networked spectra, then the other spectra of the groups, linked to their representative
+    spectra_nodes = list(spectra_network)
+    if query_groups is not None:
+        spectra_by_scans = {int(s.metadata['scans']): s for s in spectra_query}
+        node_index = {int(s.metadata['scans']): i for i, s in enumerate(spectra_nodes)}
+        members = query_groups[query_groups['feature_id'] != query_groups['representative_id']]
+        member_idx = np.arange(len(spectra_nodes), len(spectra_nodes) + len(members))
+        spectra_nodes += [spectra_by_scans[member] for member in members['feature_id']]
+        representative_idx = np.array([node_index[representative] for representative in members['representative_id']], dtype=np.int64)
+        idx_1 = np.concatenate([idx_1, member_idx])
+        idx_2 = np.concatenate([idx_2, representative_idx])
+        weights = np.concatenate([weights, members['dedup_score'].to_numpy(dtype=np.float64)])
+    ids = [s.get('scans') for s in spectra_nodes]
+    graph = nx.Graph()
+    graph.add_nodes_from(ids)
+    graph.add_weighted_edges_from((ids[i], ids[j], weight) for i, j, weight in zip(idx_1.tolist(), idx_2.tolist(), weights.tolist()))
     os.makedirs(os.path.dirname(mn_graphml_ouput_path), exist_ok=True)
-    ms_network.export_to_graphml(mn_graphml_ouput_path)
-    # Here we use the sorted_connected_component_subgraphs in ordere to make sure that components are sequentially labelled from the largest to the smallest
-    components = sorted_connected_component_subgraphs(ms_network.graph)
-    # We also increment the key by one to start the numbering at one.
-    comp_dict = {idx + 1 : comp.nodes() for idx, comp in enumerate(components)}
-    attr = {n: {'component_id' : comp_id} for comp_id, nodes in comp_dict.items() for n in nodes}
-    comp = pd.DataFrame.from_dict(attr, orient = 'index')
-    comp.reset_index(inplace = True)
-    comp.rename(columns={'index': 'feature_id'}, inplace=True)
-    count = comp.groupby('component_id').count()
-    count['new_ci'] = np.where(count['feature_id'] > 1, count.index, -1)
-    new_ci = pd.Series(count.new_ci.values,index=count.index).to_dict()
-    comp['component_id'] = comp['component_id'].map(new_ci)
-    spectra_query_metadata_df = pd.DataFrame(s.metadata for s in spectra_query)
-    comp = comp.merge(spectra_query_metadata_df[['feature_id', 'precursor_mz']], how='left')
+    nx.write_graphml_lxml(graph, mn_graphml_ouput_path)
+    # Components are labelled from the largest to the smallest, starting at one, singletons get -1
+    component_id = component_ids(len(ids), idx_1, idx_2)
+    # Rows by component, singletons last
+    order = np.lexsort((np.arange(len(ids)), component_id, component_id == -1))
+    # feature_id are the scans numbers, typed as in the spectral matching results
+    comp = pd.DataFrame({'feature_id': np.array(ids, dtype=np.int64)[order], 'component_id': component_id[order],
+                         'precursor_mz': np.array([s.get('precursor_mz') for s in spectra_nodes], dtype=np.float64)[order]})
     os.makedirs(os.path.dirname(mn_ci_ouput_path), exist_ok=True)
-    comp.to_csv(mn_ci_ouput_path, sep = '\t', index = False)
\ No newline at end of file
+    write_table(comp, mn_ci_ouput_path, table_format, index=False)
\ No newline at end of file
@@ -1,24 +1,39 @@
 import pandas as pd
+import numpy as np
 import glob
 import os
+import sys
 import yaml
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import git
 from pathlib import Path
 
-from matchms.importing import load_from_mgf
-from matchms.filtering import add_precursor_mz
-from matchms.filtering.require_minimum_number_of_peaks  import require_minimum_number_of_peaks 
 
 from spectral_db_loader import load_spectral_db
 from spectral_db_loader import load_clean_spectral_db
 from spectral_db_loader import save_spectral_db
+from spectral_db_loader import spectral_db_to_arrays
+from spectral_db_loader import spectral_db_structure_ids
+from spectral_db_loader import spectral_db_tail
+from spectral_db_loader import columnar_spectral_db_history
 from spectral_lib_matcher import spectral_matching
+from library_shards import is_sharded_spectral_db, load_sharded_spectral_db, sharded_spectral_matching, merge_shard_hits
+from precursor_index import build_precursor_index
+from fragment_index import build_fragment_index
+from prescreen import binned_vectors
 from molecular_networking import generate_mn
+from query_dedup import group_query_spectra
 from ms1_matcher import ms1_matcher
 from reweighting_functions import taxonomical_reponderator, chemical_reponderator
 from helpers import top_N_slicer, annotation_table_formatter_taxo, annotation_table_formatter_no_taxo
 from plotter import plotter_count, plotter_intensity
+from matching_cache import file_hash, spectral_db_hash, cache_key, is_cached, write_cache_key, cached_library_version
 from formatters import feature_intensity_table_formatter
+sys.path.append(os.path.join(Path(__file__).parents[2], 'src'))
+from table_io import table_paths, read_table, write_table
+from spectrum_cache import load_spectrum_arrays, spectra_from_arrays
+from peak_preprocessing import query_spectrum_arrays
 
 pd.options.mode.chained_assignment = None
 
@@ -35,7 +50,17 @@ with open (r'../params/user.yml') as file:
 params_list = params_list_full['isdb']
 
 recompute = params_list_full['isdb']['general_params']['recompute']
+use_cache = params_list_full['isdb']['general_params'].get('use_cache', True)
+table_format = params_list_full['isdb']['general_params'].get('table_format', 'tsv')
+if table_format not in ['tsv', 'parquet', 'both']:
+    raise ValueError('table_format parameter must be tsv, parquet or both')
 ionization_mode = params_list_full['general']['polarity']
+if ionization_mode == 'both':
+    ionization_modes = ['pos', 'neg']
+elif ionization_mode in ['pos', 'neg']:
+    ionization_modes = [ionization_mode]
+else:
+    raise ValueError('ionization_mode parameter must be pos, neg or both')
 
 repository_path = os.path.normpath(params_list_full['general']['treated_data_path'])
 taxo_db_metadata_path = params_list_full['isdb']['paths']['taxo_db_metadata_path']
@@ -48,11 +73,27 @@ parent_mz_tol = params_list_full['isdb']['spectral_match_params']['parent_mz_tol
 msms_mz_tol = params_list_full['isdb']['spectral_match_params']['msms_mz_tol']
 min_score = params_list_full['isdb']['spectral_match_params']['min_score']
 min_peaks = params_list_full['isdb']['spectral_match_params']['min_peaks']
+matching_backend = params_list_full['isdb']['spectral_match_params'].get('matching_backend', 'cosine')
+analog_search = params_list_full['isdb']['spectral_match_params'].get('analog_search', False)
+prescreen = params_list_full['isdb']['spectral_match_params'].get('prescreen', False)
+n_jobs = params_list_full['isdb']['spectral_match_params'].get('n_jobs', 1)
+top_k = params_list_full['isdb']['spectral_match_params'].get('top_k', None)
+collapse_structures = params_list_full['isdb']['spectral_match_params'].get('collapse_structures', False)
+shards = params_list_full['isdb']['spectral_match_params'].get('shards', None)
+prescreen_threshold = params_list_full['isdb']['spectral_match_params'].get('prescreen_threshold', min_score)
 
 mn_msms_mz_tol = params_list_full['isdb']['networking_params']['mn_msms_mz_tol']
 mn_score_cutoff = params_list_full['isdb']['networking_params']['mn_score_cutoff']
 mn_max_links = params_list_full['isdb']['networking_params']['mn_max_links']
 mn_top_n = params_list_full['isdb']['networking_params']['mn_top_n']
+mn_approximate = params_list_full['isdb']['networking_params'].get('mn_approximate', False)
+mn_lsh_bands = params_list_full['isdb']['networking_params'].get('mn_lsh_bands', 128)
+mn_lsh_rows = params_list_full['isdb']['networking_params'].get('mn_lsh_rows', 2)
+
+query_dedup_params = params_list_full['isdb'].get('query_dedup_params', {})
+dedup_queries = query_dedup_params.get('dedup_queries', False)
+dedup_parent_mz_tol = query_dedup_params.get('dedup_parent_mz_tol', 0.01)
+dedup_min_cosine = query_dedup_params.get('dedup_min_cosine', 0.95)
 
 top_to_output= params_list_full['isdb']['reweighting_params']['top_to_output']
 ppm_tol_ms1 = params_list_full['isdb']['reweighting_params']['ppm_tol_ms1']
@@ -81,6 +122,8 @@ params_list['version_info'] = {
 samples_dir = [directory for directory in os.listdir(repository_path)]
 print(f'{len(samples_dir)} directories were detected in the input directory. They will be checked for minimal requirements.')
 
+# Ionization modes to process for each sample, both modes are checked in the same pass
+samples_modes = {}
 for sample_dir in samples_dir[:]:
     # if sample_dir != ".DS_Store":
     try:
@@ -101,51 +144,71 @@ for sample_dir in samples_dir[:]:
         samples_dir.remove(sample_dir)
         continue
 
-    # Check if MS/MS spectra are present 
-    if os.path.isfile(os.path.join(repository_path,sample_dir, ionization_mode, sample_dir + '_features_ms2_' + ionization_mode + '.mgf')):
-        pass
-    else:
-        print(sample_dir + " has no MSMS data, it is removed from the processing list.")
+    samples_modes[sample_dir] = []
+    for mode in ionization_modes:
+        # Check if MS/MS spectra are present 
+        if not os.path.isfile(os.path.join(repository_path,sample_dir, mode, sample_dir + '_features_ms2_' + mode + '.mgf')):
+            print(sample_dir + " has no " + mode + " MSMS data, it is removed from the " + mode + " processing list.")
+            continue
+
+        # Check if features intensity table is present
+        if not os.path.isfile(os.path.join(repository_path,sample_dir, mode, sample_dir + '_features_quant_' + mode + '.csv')):
+            print(sample_dir + " has no " + mode + " feature intensity table, it is removed from the " + mode + " processing list.")
+            continue
+        if recompute == False :
+            if os.path.isfile(os.path.join(repository_path, sample_dir, mode, 'isdb/config.yaml')):
+                print(sample_dir + " has already been annotated through the ISDB in " + mode + " mode, since the recompute option (user.yaml) is set to False it will be removed from the " + mode + " processing list.")
+                continue
+        samples_modes[sample_dir].append(mode)
+    if len(samples_modes[sample_dir]) == 0:
+        del samples_modes[sample_dir]
         samples_dir.remove(sample_dir)
-        continue
-
-    # Check if features intensity table is present
-    if os.path.isfile(os.path.join(repository_path,sample_dir, ionization_mode, sample_dir + '_features_quant_' + ionization_mode + '.csv')):
-        pass
-    else:
-        print(sample_dir + " has no feature intensity table, it is removed from the processing list.")
-        samples_dir.remove(sample_dir)
-        continue
-    if recompute == False :
-        if os.path.isfile(os.path.join(repository_path, sample_dir, ionization_mode, 'isdb/config.yaml')):
-            print(sample_dir + " has already been annotated through the ISDB, since the recompute option (user.yaml) is set to False it will be removed from the processing list.")
-            samples_dir.remove(sample_dir)
-    # else:
-    #     continue
 
 print(f'{len(samples_dir)} samples folder were found to be complete and will be processed.')
 
 # if input("Do you wish to continue and process samples? (y/n)") != ("y"):
 #     exit()
     
-# Load spectral DB
-if ionization_mode == 'pos':
-    spectral_db = load_clean_spectral_db(spectral_db_pos_path)
-elif ionization_mode == 'neg':
-    spectral_db = load_clean_spectral_db(spectral_db_neg_path)
-
-# Calculate min and max m/z value using user's tolerance for adducts search
-if ionization_mode == 'pos':
-    adducts_df = pd.read_csv(adducts_pos_path, compression='gzip', sep='\t')
-elif ionization_mode == 'neg':
-    adducts_df = pd.read_csv(adducts_neg_path, compression='gzip', sep='\t')
-else:
-    raise ValueError('ionization_mode parameter must be pos or neg')
-
-adducts_df['min'] = adducts_df['adduct_mass'] - \
-    int(ppm_tol_ms1) * (adducts_df['adduct_mass'] / 1000000)
-adducts_df['max'] = adducts_df['adduct_mass'] + \
-    int(ppm_tol_ms1) * (adducts_df['adduct_mass'] / 1000000)
+# Load the spectral DB and the adducts of each ionization mode, they are shared by all samples
+spectral_db_paths = {'pos': spectral_db_pos_path, 'neg': spectral_db_neg_path}
+adducts_paths = {'pos': adducts_pos_path, 'neg': adducts_neg_path}
+if not prescreen:
+    prescreen_threshold = None
+
+libraries = {}
+adducts = {}
+for mode in ionization_modes:
+    # Sharded spectral db are matched one shard at a time, only their manifest is loaded here
+    if is_sharded_spectral_db(spectral_db_paths[mode]):
+        libraries[mode] = {
+            'sharded_db': load_sharded_spectral_db(spectral_db_paths[mode]),
+            'content_hash': spectral_db_hash(spectral_db_paths[mode]),
+        }
+    else:
+        spectral_db = load_clean_spectral_db(spectral_db_paths[mode])
+
+        # Convert the library to peak arrays (columnar spectral db are already memory-mapped arrays)
+        # and index its precursor m/z once
+        if not isinstance(spectral_db, dict):
+            spectral_db = spectral_db_to_arrays(spectral_db)
+        libraries[mode] = {
+            'sharded_db': None,
+            'spectral_db': spectral_db,
+            'content_hash': spectral_db_hash(spectral_db_paths[mode]),
+            'history': columnar_spectral_db_history(spectral_db_paths[mode]),
+            'precursor_index': build_precursor_index(spectral_db['precursor_mz']),
+            'fragment_index': build_fragment_index(spectral_db) if matching_backend == 'fragment_index' else None,
+            'structure_ids': spectral_db_structure_ids(spectral_db) if collapse_structures else None,
+            'library_vectors': binned_vectors(spectral_db['mz'], spectral_db['intensities'], spectral_db['offsets'], float(msms_mz_tol)) if prescreen else None,
+        }
+
+    # Calculate min and max m/z value using user's tolerance for adducts search
+    adducts_df = pd.read_csv(adducts_paths[mode], compression='gzip', sep='\t')
+    adducts_df['min'] = adducts_df['adduct_mass'] - \
+        int(ppm_tol_ms1) * (adducts_df['adduct_mass'] / 1000000)
+    adducts_df['max'] = adducts_df['adduct_mass'] + \
+        int(ppm_tol_ms1) * (adducts_df['adduct_mass'] / 1000000)
+    adducts[mode] = adducts_df
 
 # Load structures taxonomical data
 if taxo_db_metadata_path.endswith('.csv.gz'):
@@ -157,8 +220,16 @@ db_metadata['short_inchikey'] = db_metadata.structure_inchikey.str.split(
 db_metadata.reset_index(inplace=True)
     
 # Processing
-for sample_dir in samples_dir:
-    
+def process_sample(sample_dir, ionization_mode):
+    """Run the molecular networking, spectral matching and reweighting of one sample in one ionization mode
+
+    Args:
+        sample_dir (str): Sample directory name
+        ionization_mode (str): 'pos' or 'neg'
+    """
+
+    library = libraries[ionization_mode]
+    adducts_df = adducts[ionization_mode]
     metadata_file_path = os.path.join(repository_path, sample_dir, sample_dir + '_metadata.tsv')
     metadata = pd.read_csv(metadata_file_path, sep='\t')   
     spectra_file_path = os.path.join(repository_path,sample_dir, ionization_mode, sample_dir + '_features_ms2_' + ionization_mode + '.mgf')       
@@ -178,10 +249,11 @@ for sample_dir in samples_dir:
         taxo_metadata = None
 
     print('''
-    Treating file: ''' + sample_dir
+    Treating file: ''' + sample_dir + ' (' + ionization_mode + ')'
     )
 
     isdb_results_path = os.path.normpath(f'{repository_path}/{sample_dir}/{ionization_mode}/isdb/{sample_dir}_isdb_{ionization_mode}.tsv')
+    isdb_candidates_path = os.path.normpath(f'{repository_path}/{sample_dir}/{ionization_mode}/isdb/{sample_dir}_isdb_candidates_{ionization_mode}.tsv')
     mn_ci_ouput_path = os.path.normpath(f'{repository_path}/{sample_dir}/{ionization_mode}/molecular_network/{sample_dir}_mn_metadata_{ionization_mode}.tsv')
     repond_table_path = os.path.normpath(f'{repository_path}/{sample_dir}/{ionization_mode}/isdb/{sample_dir}_isdb_reweighted_{ionization_mode}.tsv')
     repond_table_flat_path = os.path.normpath(f'{repository_path}/{sample_dir}/{ionization_mode}/isdb/{sample_dir}_isdb_reweighted_flat_{ionization_mode}.tsv')
@@ -192,51 +264,127 @@ for sample_dir in samples_dir:
     mn_config_path = os.path.normpath(f'{repository_path}/{sample_dir}/{ionization_mode}/molecular_network/config.yaml')
     isdb_folder_path = os.path.normpath(f'{repository_path}/{sample_dir}/{ionization_mode}/isdb/')
     mn_folder_path = os.path.normpath(f'{repository_path}/{sample_dir}/{ionization_mode}/molecular_network/')
-    
+    isdb_cache_path = os.path.normpath(f'{repository_path}/{sample_dir}/{ionization_mode}/isdb/matching_cache.json')
+    isdb_shards_folder_path = os.path.normpath(f'{repository_path}/{sample_dir}/{ionization_mode}/isdb/shards/')
+    mn_cache_path = os.path.normpath(f'{repository_path}/{sample_dir}/{ionization_mode}/molecular_network/networking_cache.json')
+
+    # Spectral matching and networking results are reused when their inputs and parameters did not change,
+    # so that changing only the reweighting parameters does not recompute them
+    spectra_file_hash = file_hash(spectra_file_path)
+    dedup_params = dict(dedup_parent_mz_tol=dedup_parent_mz_tol, dedup_min_cosine=dedup_min_cosine, dedup_msms_mz_tol=msms_mz_tol) if dedup_queries else None
+    mn_key = cache_key(spectra_file_hash=spectra_file_hash, mn_msms_mz_tol=mn_msms_mz_tol, mn_score_cutoff=mn_score_cutoff,
+                       mn_top_n=mn_top_n, mn_max_links=mn_max_links, mn_approximate=mn_approximate,
+                       mn_lsh_bands=mn_lsh_bands, mn_lsh_rows=mn_lsh_rows, dedup_params=dedup_params)
+    isdb_key = cache_key(spectra_file_hash=spectra_file_hash, spectral_db_hash=library['content_hash'],
+                         parent_mz_tol=parent_mz_tol, msms_mz_tol=msms_mz_tol, min_score=min_score, min_peaks=min_peaks,
+                         matching_backend=matching_backend, analog_search=analog_search,
+                         prescreen_threshold=prescreen_threshold, top_k=top_k, collapse_structures=collapse_structures,
+                         dedup_params=dedup_params)
+    mn_cached = use_cache and is_cached([mn_graphml_ouput_path] + table_paths(mn_ci_ouput_path, table_format), mn_cache_path, mn_key)
+    isdb_cached = use_cache and is_cached(table_paths(isdb_results_path, table_format), isdb_cache_path, isdb_key)
+    # Results computed against a previous version of a growing library only need the appended spectra to be matched
+    isdb_library_version = None
+    if use_cache and not isdb_cached and library['sharded_db'] is None:
+        isdb_library_version = cached_library_version(table_paths(isdb_results_path, table_format), isdb_cache_path,
+                                                      isdb_key, library['history'])
+
     # Import query spectra
-    spectra_query = list(load_from_mgf(spectra_file_path))
-    spectra_query = [require_minimum_number_of_peaks(s, n_required=1) for s in spectra_query]
-    spectra_query = [add_precursor_mz(s) for s in spectra_query if s]
+    if not (mn_cached and isdb_cached):
+        # Spectra without peaks are dropped and the precursor m/z set on the arrays of the sidecar,
+        # matchms spectra are only built for the molecular networking
+        query_arrays = query_spectrum_arrays(load_spectrum_arrays(spectra_file_path), n_required=1)
+
+        # Near-identical spectra are scored once, through the representative of their group
+        if dedup_queries:
+            query_groups = group_query_spectra(query_arrays, dedup_parent_mz_tol, msms_mz_tol, dedup_min_cosine)
+            print(f"{len(query_arrays['scans'])} spectra were grouped into {query_groups['representative_id'].nunique()} representatives.")
+        else:
+            query_groups = None
 
     # Molecular networking
-    print('''
+    if mn_cached:
+        print('''
+    Molecular networking results are up to date, they are reused
+    ''')
+    else:
+        print('''
     Molecular networking 
     ''')
-    
-    generate_mn(spectra_query, mn_graphml_ouput_path, mn_ci_ouput_path, mn_msms_mz_tol, mn_score_cutoff, mn_top_n, mn_max_links)
-    with open(mn_config_path, "w") as f:
-        yaml.dump(params_list, f)
-    
-    print('''
+        
+        spectra_query = [spectrum.to_matchms() for spectrum in spectra_from_arrays(query_arrays)]
+        generate_mn(spectra_query, mn_graphml_ouput_path, mn_ci_ouput_path, mn_msms_mz_tol, mn_score_cutoff, mn_top_n, mn_max_links,
+                    query_groups=query_groups, table_format=table_format, n_jobs=n_jobs,
+                    approximate=mn_approximate, lsh_bands=mn_lsh_bands, lsh_rows=mn_lsh_rows)
+        write_cache_key(mn_cache_path, mn_key)
+        with open(mn_config_path, "w") as f:
+            yaml.dump(params_list, f)
+        
+        print('''
     Molecular Networking done
     ''')
 
     # ISDB
     #if ionization_mode == 'pos':
     # Spectral matching
-    print('''
+    if isdb_cached:
+        print('''
+    Spectral matching results are up to date, they are reused
+    ''')
+    else:
+        print('''
     Spectral matching
     ''')
-    
-    spectral_matching(spectra_query, spectral_db, parent_mz_tol,
-        msms_mz_tol, min_score, min_peaks, isdb_results_path)
-    
-    print('''
+        
+        if library['sharded_db'] is not None:
+            # Each shard is cached on its own content hash, shards matched by other runs are reused
+            shard_key_parts = {key: value for key, value in isdb_key['parts'].items() if key != 'spectral_db_hash'}
+            complete = sharded_spectral_matching(query_arrays, library['sharded_db'], parent_mz_tol,
+                msms_mz_tol, min_score, min_peaks, isdb_results_path, isdb_shards_folder_path, shards=shards,
+                cache_key_parts=shard_key_parts, use_cache=use_cache, table_format=table_format, backend=matching_backend, analog_search=analog_search,
+                prescreen_threshold=prescreen_threshold, n_jobs=n_jobs, top_k=top_k,
+                query_groups=query_groups, collapse_structures=collapse_structures)
+            if not complete:
+                print('''
+    Some shards of the spectral library are left to other runs, the sample will be completed once they are matched
+    ''')
+                return
+        elif isdb_library_version is not None:
+            n_spectra = len(library['spectral_db']['precursor_mz'])
+            print(f'Matching the {n_spectra - isdb_library_version} spectra added to the spectral library since the last run')
+            update_results_path = os.path.join(isdb_folder_path, 'library_update.tsv')
+            spectral_matching(query_arrays, spectral_db_tail(library['spectral_db'], isdb_library_version), parent_mz_tol,
+                msms_mz_tol, min_score, min_peaks, update_results_path, backend=matching_backend, analog_search=analog_search,
+                prescreen_threshold=prescreen_threshold, n_jobs=n_jobs, top_k=top_k, query_groups=query_groups,
+                collapse_structures=collapse_structures, reference_ids=np.arange(isdb_library_version, n_spectra) + 1)
+            if os.path.exists(update_results_path):
+                merge_shard_hits([isdb_results_path, update_results_path], isdb_results_path, top_k=top_k,
+                                 collapse_structures=collapse_structures, table_format=table_format)
+                os.remove(update_results_path)
+        else:
+            spectral_matching(query_arrays, library['spectral_db'], parent_mz_tol,
+                msms_mz_tol, min_score, min_peaks, isdb_results_path, precursor_index=library['precursor_index'],
+                backend=matching_backend, fragment_index=library['fragment_index'], analog_search=analog_search,
+                prescreen_threshold=prescreen_threshold, library_vectors=library['library_vectors'], n_jobs=n_jobs, top_k=top_k,
+                query_groups=query_groups, collapse_structures=collapse_structures, structure_ids=library['structure_ids'],
+                table_format=table_format)
+        write_cache_key(isdb_cache_path, isdb_key)
+        
+        print('''
     Spectral matching done
     ''')
     
     try:
-        dt_isdb_results = pd.read_csv(isdb_results_path, sep='\t', \
-            usecols=['msms_score', 'feature_id', 'reference_id', 'short_inchikey'], on_bad_lines='skip', low_memory=True)
+        dt_isdb_results = read_table(isdb_results_path, \
+            columns=['msms_score', 'feature_id', 'reference_id', 'short_inchikey'], on_bad_lines='skip', low_memory=True)
     except ValueError:   
         with open(isdb_config_path, "w") as f:
             yaml.dump(params_list, f)
-        continue
+        return
     # Add 'libname' column and rename msms_score column
     dt_isdb_results['libname'] = 'ISDB'
 
     # Load MN metadata
-    clusterinfo_summary = pd.read_csv(mn_ci_ouput_path, sep='\t', usecols=['feature_id', 'precursor_mz', 'component_id'], \
+    clusterinfo_summary = read_table(mn_ci_ouput_path, columns=['feature_id', 'precursor_mz', 'component_id'], \
         on_bad_lines='skip', low_memory=True)
     clusterinfo_summary.rename(columns={'precursor_mz': 'mz'}, inplace=True)
 
@@ -287,6 +435,15 @@ for sample_dir in samples_dir:
     dt_isdb_results = pd.merge(
         left=dt_isdb_results, right=db_metadata[cols_to_use], left_on='short_inchikey', right_on='short_inchikey', how='outer')
     dt_isdb_results.dropna(subset=['feature_id'], inplace=True)
+
+    if taxo_metadata is not None:
+        cols_att = ['query_otol_domain', 'query_otol_kingdom', 'query_otol_phylum', 'query_otol_class',
+                'query_otol_order', 'query_otol_family', 'query_otol_genus', 'query_otol_species']
+        for col in cols_att:
+            dt_isdb_results[col] = taxo_metadata[col][0]
+
+    # Candidates before reweighting, reweighting_sweep.py evaluates other reweighting parameters on them
+    write_table(dt_isdb_results, isdb_candidates_path, table_format)
             
     if taxo_metadata is not None:        
         print('''
@@ -295,10 +452,6 @@ for sample_dir in samples_dir:
             
         # If valid taxonomy is present for sample, proceed to taxonomical reweighting
         taxo_reweight = True
-        cols_att = ['query_otol_domain', 'query_otol_kingdom', 'query_otol_phylum', 'query_otol_class',
-                'query_otol_order', 'query_otol_family', 'query_otol_genus', 'query_otol_species']
-        for col in cols_att:
-            dt_isdb_results[col] = taxo_metadata[col][0]
         dt_isdb_results = taxonomical_reponderator(dt_isdb_results, min_score_taxo_ms1)
 
         print('''
@@ -349,8 +502,8 @@ for sample_dir in samples_dir:
         # Export
         if not os.path.exists(isdb_folder_path):
             os.makedirs(isdb_folder_path)
-        df_flat.to_csv(repond_table_flat_path, sep='\t')
-        df_for_cyto.to_csv(repond_table_path, sep='\t')
+        write_table(df_flat, repond_table_flat_path, table_format)
+        write_table(df_for_cyto, repond_table_path, table_format)
             
         #Plotting
         feature_intensity_table_formatted = feature_intensity_table_formatter(feature_table)
@@ -376,5 +529,18 @@ for sample_dir in samples_dir:
         )
                 
     print('''
-    Finished file: ''' + sample_dir
-    )
\ No newline at end of file
+    Finished file: ''' + sample_dir + ' (' + ionization_mode + ')'
+    )
+
+
+samples_dir_tasks = [sample_dir for sample_dir in samples_dir for mode in samples_modes[sample_dir]]
+modes_tasks = [mode for sample_dir in samples_dir for mode in samples_modes[sample_dir]]
+if len(ionization_modes) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+    # The pos and neg passes of a sample run concurrently. Forked workers share the libraries,
+    # the adducts and db_metadata loaded above.
+    with ProcessPoolExecutor(max_workers=len(ionization_modes), mp_context=multiprocessing.get_context('fork')) as executor:
+        for _ in executor.map(process_sample, samples_dir_tasks, modes_tasks):
+            pass
+else:
+    for sample_dir, mode in zip(samples_dir_tasks, modes_tasks):
+        process_sample(sample_dir, mode)
\ No newline at end of file
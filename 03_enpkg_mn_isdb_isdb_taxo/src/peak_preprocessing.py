@@ -0,0 +1,131 @@
+import numpy as np
+from matchms import Spectrum
+from matchms.filtering import add_precursor_mz
+from matchms.filtering import interpret_pepmass
+from similarity_kernels import spectra_to_peak_arrays
+
+
+def spectra_precursor_mz(spectra):
+    """Precursor m/z of a list of spectra, as set by matchms default_filters()
+
+    Args:
+        spectra (list): List of matchms spectra objects
+
+    Returns:
+        np.ndarray: Precursor m/z of each spectrum (nan if missing)
+    """
+
+    precursor_mz = []
+    for s in spectra:
+        # The m/z of pepmass comes first, as with interpret_pepmass(). The filters themselves
+        # (which copy the spectrum) are only run for values that are not plain numbers.
+        pepmass = s.get('pepmass')
+        if pepmass is None:
+            value = s.get('precursor_mz')
+        else:
+            value = pepmass[0] if isinstance(pepmass, (tuple, list)) else None
+        if not isinstance(value, (float, int)):
+            value = add_precursor_mz(interpret_pepmass(s)).get('precursor_mz')
+        precursor_mz.append(np.nan if value is None else float(value))
+    return np.array(precursor_mz, dtype=np.float64)
+
+
+def query_spectrum_arrays(spectrum_arrays, n_required=1):
+    """Query spectra of a .mgf file, from the arrays of its binary sidecar
+
+    Keeps the same spectra, with the same precursor m/z, as loading them as matchms spectra and running \
+        require_minimum_number_of_peaks() and add_precursor_mz() on each of them, but without building \
+        a matchms spectrum per spectrum.
+
+    Args:
+        spectrum_arrays (dict): Spectra of the .mgf file (output of spectrum_cache.load_spectrum_arrays())
+        n_required (int, optional): Minimal number of peaks of the spectra kept. Defaults to 1.
+
+    Returns:
+        dict: 'mz', 'intensities', 'offsets', 'precursor_mz' (nan if missing), 'scans' (np.int64) and 'metadata' \
+            of the kept spectra
+    """
+
+    keep = np.diff(spectrum_arrays['offsets']) >= n_required
+    # The sidecar holds the m/z of pepmass, which comes first in matchms. Other parameters are only
+    # interpreted by matchms for the spectra without pepmass.
+    precursor_mz = np.array(spectrum_arrays['precursor_mz'], dtype=np.float64)
+    missing = np.flatnonzero(np.isnan(precursor_mz) & keep)
+    if len(missing):
+        precursor_mz[missing] = spectra_precursor_mz([Spectrum(mz=np.zeros(0), intensities=np.zeros(0),
+                                                               metadata=dict(spectrum_arrays['metadata'][i])) for i in missing])
+    query_arrays = {'mz': np.asarray(spectrum_arrays['mz'], dtype=np.float64),
+                    'intensities': np.asarray(spectrum_arrays['intensities'], dtype=np.float64),
+                    'offsets': np.asarray(spectrum_arrays['offsets'], dtype=np.int64),
+                    'precursor_mz': precursor_mz,
+                    'scans': np.zeros(len(keep), dtype=np.int64),
+                    'metadata': spectrum_arrays['metadata']}
+    query_arrays['scans'][keep] = np.asarray(spectrum_arrays['scans'])[keep].astype(np.int64)
+    return select_spectra(query_arrays, keep)
+
+
+def spectra_to_query_arrays(spectra):
+    """Query arrays (see query_spectrum_arrays()) of a list of matchms spectra
+
+    Args:
+        spectra (list): List of matchms spectra objects
+
+    Returns:
+        dict: 'mz', 'intensities', 'offsets', 'precursor_mz', 'scans' and 'metadata' of the spectra
+    """
+
+    mz, intensities, offsets = spectra_to_peak_arrays(spectra)
+    return {'mz': mz, 'intensities': intensities, 'offsets': offsets, 'precursor_mz': spectra_precursor_mz(spectra),
+            'scans': np.array([int(s.metadata['scans']) for s in spectra], dtype=np.int64),
+            'metadata': [s.metadata for s in spectra]}
+
+
+def select_spectra(query_arrays, mask):
+    """Query arrays (see query_spectrum_arrays()) of the spectra selected by a boolean mask"""
+    mask = np.asarray(mask, dtype=bool)
+    peaks = np.repeat(mask, np.diff(query_arrays['offsets']))
+    offsets = np.zeros(mask.sum() + 1, dtype=np.int64)
+    np.cumsum(np.diff(query_arrays['offsets'])[mask], out=offsets[1:])
+    return {'mz': query_arrays['mz'][peaks], 'intensities': query_arrays['intensities'][peaks], 'offsets': offsets,
+            'precursor_mz': query_arrays['precursor_mz'][mask], 'scans': query_arrays['scans'][mask],
+            'metadata': [metadata for metadata, selected in zip(query_arrays['metadata'], mask) if selected]}
+
+
+def preprocess_peak_arrays(mz, intensities, offsets, intensity_from=0.01, intensity_to=200.0, mz_from=10.0, mz_to=1000.0):
+    """Normalize and select the peaks of all spectra at once
+
+    Applies matchms normalize_intensities, select_by_intensity and select_by_mz on concatenated peak arrays, \
+        with the same results as running them one spectrum at a time (see spectral_lib_matcher.peak_processing()).
+
+    Args:
+        mz, intensities, offsets (np.ndarray): Peak arrays of the spectra (see spectra_to_peak_arrays())
+        intensity_from (float, optional): Lowest normalized intensity kept. Defaults to 0.01.
+        intensity_to (float, optional): Highest normalized intensity kept. Defaults to 200.0.
+        mz_from (float, optional): Lowest m/z kept. Defaults to 10.0.
+        mz_to (float, optional): Highest m/z kept. Defaults to 1000.0.
+
+    Returns:
+        tuple: m/z, intensities and offsets of the processed spectra, and a mask of the input spectra they come from. \
+            As with normalize_intensities, spectra whose intensities are all <= 0 are removed.
+    """
+
+    mz = np.asarray(mz, dtype=np.float64)
+    intensities = np.asarray(intensities, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_peaks = np.diff(offsets)
+    rows = np.repeat(np.arange(len(n_peaks)), n_peaks)
+
+    # Maximum intensity of each spectrum, empty spectra are left as they are
+    not_empty = n_peaks > 0
+    max_intensity = np.ones(len(n_peaks), dtype=np.float64)
+    if not_empty.any():
+        max_intensity[not_empty] = np.maximum.reduceat(intensities, offsets[:-1][not_empty])
+    kept = max_intensity > 0
+    max_intensity[~kept] = 1.0
+
+    normalized = intensities / max_intensity[rows]
+    keep = kept[rows] & (intensity_from <= normalized) & (normalized <= intensity_to) & (mz_from <= mz) & (mz <= mz_to)
+
+    new_offsets = np.zeros(kept.sum() + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[keep], minlength=len(n_peaks))[kept], out=new_offsets[1:])
+    return mz[keep], normalized[keep], new_offsets, kept
@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def build_precursor_index(precursors_mz):
+    """Build a precursor m/z index over a spectral library
+
+    The library precursor m/z are sorted once so that the candidates of any query
+    can then be retrieved with a binary search instead of a query x library comparison.
+
+    Args:
+        precursors_mz (array-like): Precursor m/z of the library spectra, in library order
+
+    Returns:
+        tuple: Sorted precursor m/z (np.ndarray) and the library indices in that order (np.ndarray)
+    """
+
+    precursors_mz = np.asarray(precursors_mz, dtype=np.float64)
+    order = np.argsort(precursors_mz, kind='stable')
+    return precursors_mz[order], order
+
+
+def query_precursor_index(precursor_index, query_precursors_mz, tolerance):
+    """Find the library spectra within a precursor m/z tolerance of each query
+
+    Args:
+        precursor_index (tuple): Output of build_precursor_index()
+        query_precursors_mz (array-like): Precursor m/z of the query spectra
+        tolerance (float): Precursor m/z tolerance in Da
+
+    Returns:
+        tuple: Query indices (np.ndarray) and library indices (np.ndarray) of the candidate pairs,
+            ordered by query then by library index
+    """
+
+    sorted_mz, order = precursor_index
+    query_precursors_mz = np.asarray(query_precursors_mz, dtype=np.float64)
+    tolerance = float(tolerance)
+
+    # The window is slightly widened and then filtered with the exact |delta| <= tolerance test
+    # used by matchms.similarity.PrecursorMzMatch, so that rounding cannot change the candidates
+    margin = 1e-6
+    low = np.searchsorted(sorted_mz, query_precursors_mz - tolerance - margin, side='left')
+    high = np.searchsorted(sorted_mz, query_precursors_mz + tolerance + margin, side='right')
+    counts = high - low
+
+    idx_query = np.repeat(np.arange(len(query_precursors_mz)), counts)
+    starts = np.repeat(low - np.cumsum(counts) + counts, counts)
+    positions = starts + np.arange(counts.sum())
+
+    keep = np.abs(sorted_mz[positions] - query_precursors_mz[idx_query]) <= tolerance
+    idx_query = idx_query[keep]
+    idx_library = order[positions[keep]]
+
+    sorting = np.lexsort((idx_library, idx_query))
+    return idx_query[sorting], idx_library[sorting]
@@ -0,0 +1,68 @@
+import numpy as np
+from scipy import sparse
+
+
+def binned_vectors(mz, intensities, offsets, bin_width, spread=False):
+    """Bin spectra into sparse vectors normalized to unit length
+
+    Args:
+        mz, intensities, offsets (np.ndarray): Peak arrays of the spectra (see spectra_to_peak_arrays())
+        bin_width (float): Width of the m/z bins in Da
+        spread (bool, optional): Also add each peak to the two neighbouring bins. Defaults to False.
+
+    Returns:
+        scipy.sparse.csr_matrix: One row per spectrum, one column per m/z bin
+    """
+
+    mz = np.asarray(mz, dtype=np.float64)
+    intensities = np.asarray(intensities, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_spectra = len(offsets) - 1
+    rows = np.repeat(np.arange(n_spectra), np.diff(offsets))
+    norms = np.sqrt(np.bincount(rows, weights=intensities ** 2, minlength=n_spectra))
+    values = intensities / norms[rows]
+    cols = np.floor(mz / bin_width).astype(np.int64)
+    n_bins = int(cols.max()) + 2 if len(cols) else 1
+
+    if spread:
+        rows = np.concatenate((rows, rows, rows))
+        values = np.concatenate((values, values, values))
+        cols = np.concatenate((cols - 1, cols, cols + 1))
+        keep = cols >= 0
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+
+    vectors = sparse.csr_matrix((values, (rows, cols)), shape=(n_spectra, n_bins))
+    vectors.sum_duplicates()
+    return vectors
+
+
+def prescreen_pairs(query_vectors, library_vectors, idx_row, idx_col):
+    """Approximate cosine scores of candidate pairs from their binned vectors
+
+    Query vectors binned with spread=True and library vectors binned with the same bin width, at least the \
+        fragment tolerance, give an upper bound of the greedy cosine score of every pair: each pair of peaks \
+        matched within the tolerance falls in neighbouring bins and is counted in the dot product.
+
+    Args:
+        query_vectors (scipy.sparse.csr_matrix): Binned query spectra (output of binned_vectors(..., spread=True))
+        library_vectors (scipy.sparse.csr_matrix): Binned library spectra (output of binned_vectors())
+        idx_row (np.ndarray): Query index of each candidate pair
+        idx_col (np.ndarray): Library index of each candidate pair
+
+    Returns:
+        np.ndarray: Approximate score of each candidate pair
+    """
+
+    if len(idx_row) == 0:
+        return np.zeros(0, dtype=np.float64)
+    n_bins = library_vectors.shape[1]
+    if query_vectors.shape[1] > n_bins:
+        # Bins above the last library bin cannot contribute to any score
+        query_vectors = query_vectors[:, :n_bins]
+    else:
+        query_vectors = sparse.hstack((query_vectors, sparse.csr_matrix((query_vectors.shape[0], n_bins - query_vectors.shape[1])))).tocsr()
+
+    # One sparse product between the chunk and the library spectra it has candidates with
+    library_idx, col_in_product = np.unique(idx_col, return_inverse=True)
+    product = (query_vectors @ library_vectors[library_idx].T).tocsr()
+    return np.asarray(product[idx_row, col_in_product]).ravel()
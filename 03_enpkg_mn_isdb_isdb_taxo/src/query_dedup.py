@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+from precursor_index import build_precursor_index, query_precursor_index
+from similarity_kernels import cosine_greedy_pairs
+from peak_preprocessing import spectra_to_query_arrays, select_spectra
+
+
+def group_query_spectra(spectra_query, parent_mz_tol, msms_mz_tol, min_cosine):
+    """Group near-identical query spectra (split chromatographic peaks, repeated scans) around a representative
+
+    Spectra are taken by decreasing number of peaks: a spectrum not yet grouped becomes a representative \
+        and takes all ungrouped spectra with a precursor m/z within parent_mz_tol and a cosine score of at \
+        least min_cosine with it.
+
+    Args:
+        spectra_query (list or dict): A list of matchms spectra objects, or their array representation \
+            (output of query_spectrum_arrays())
+        parent_mz_tol (float): Precursor m/z tolerance in Da for grouping
+        msms_mz_tol (float): Tolerance in Da for MS/MS fragments matching
+        min_cosine (float): Minimal cosine score between a spectrum and its representative
+
+    Returns:
+        DataFrame: feature_id, representative_id and dedup_score (cosine score with the representative) of each spectrum
+    """
+
+    if not isinstance(spectra_query, dict):
+        spectra_query = spectra_to_query_arrays(spectra_query)
+    feature_id, precursor_mz = spectra_query['scans'], spectra_query['precursor_mz']
+    mz, intensities, offsets = spectra_query['mz'], spectra_query['intensities'], spectra_query['offsets']
+
+    # All pairs within the precursor window are scored in one compiled call
+    idx_1, idx_2 = query_precursor_index(build_precursor_index(precursor_mz), precursor_mz, parent_mz_tol)
+    upper = idx_1 < idx_2
+    idx_1, idx_2 = idx_1[upper], idx_2[upper]
+    scores, _ = cosine_greedy_pairs(mz, intensities, offsets, mz, intensities, offsets, idx_1, idx_2, float(msms_mz_tol))
+    similar = scores >= min_cosine
+
+    # Neighbours of each spectrum, as a CSR adjacency
+    source = np.concatenate((idx_1[similar], idx_2[similar]))
+    target = np.concatenate((idx_2[similar], idx_1[similar]))
+    target_score = np.concatenate((scores[similar], scores[similar]))
+    order = np.argsort(source, kind='stable')
+    target, target_score = target[order], target_score[order]
+    neighbours = np.searchsorted(source[order], np.arange(len(feature_id) + 1))
+
+    representative = np.full(len(feature_id), -1, dtype=np.int64)
+    dedup_score = np.ones(len(feature_id), dtype=np.float64)
+    for i in np.lexsort((np.arange(len(feature_id)), -np.diff(offsets))):
+        if representative[i] >= 0:
+            continue
+        representative[i] = i
+        for k in range(neighbours[i], neighbours[i + 1]):
+            if representative[target[k]] < 0:
+                representative[target[k]] = i
+                dedup_score[target[k]] = target_score[k]
+
+    return pd.DataFrame({'feature_id': feature_id,
+                         'representative_id': feature_id[representative],
+                         'dedup_score': dedup_score})
+
+
+def representative_spectra(spectra_query, query_groups):
+    """Keep the representative spectra of the groups
+
+    Args:
+        spectra_query (list or dict): A list of matchms spectra objects, or their array representation \
+            (output of query_spectrum_arrays())
+        query_groups (DataFrame): Output of group_query_spectra()
+
+    Returns:
+        list or dict: The representative matchms spectra objects, or their array representation
+    """
+
+    representatives = set(query_groups['representative_id'])
+    if isinstance(spectra_query, dict):
+        return select_spectra(spectra_query, np.isin(spectra_query['scans'], list(representatives)))
+    return [s for s in spectra_query if int(s.metadata['scans']) in representatives]
+
+
+def fan_out_hits(df, query_groups):
+    """Copy the spectral hits of each representative to all the spectra of its group
+
+    Args:
+        df (DataFrame): Spectral hits with a feature_id column holding representatives
+        query_groups (DataFrame): Output of group_query_spectra()
+
+    Returns:
+        DataFrame: The hits of every feature_id
+    """
+
+    if len(df) == 0:
+        return df
+    members = query_groups[['feature_id', 'representative_id']].rename(columns={'feature_id': 'member_id'})
+    df = df.merge(members, left_on='feature_id', right_on='representative_id')
+    df['feature_id'] = df['member_id']
+    df = df.drop(columns=['member_id', 'representative_id'])
+    return df.sort_values('feature_id', kind='stable').reset_index(drop=True)
@@ -156,3 +156,87 @@ def chemical_reponderator(clusterinfo_summary_file, dt_isdb_results, top_N_chemi
     return dt_isdb_results
 
 
+
+
+def taxonomical_scores(dt_isdb_results):
+    """Taxonomical consistency score of each candidate annotation, as computed by taxonomical_reponderator()
+
+    Args:
+        dt_isdb_results (DataFrame): An annotation table with the query_otol_* columns of the sample
+
+    Returns:
+        np.ndarray: Number of taxonomical levels shared by the candidate source organism and the sample
+    """
+
+    cols_ref = ['organism_taxonomy_01domain', 'organism_taxonomy_02kingdom',  'organism_taxonomy_03phylum', 'organism_taxonomy_04class',
+                'organism_taxonomy_05order', 'organism_taxonomy_06family', 'organism_taxonomy_08genus', 'organism_taxonomy_09species']
+
+    cols_att = ['query_otol_domain', 'query_otol_kingdom', 'query_otol_phylum', 'query_otol_class',
+                'query_otol_order', 'query_otol_family', 'query_otol_genus', 'query_otol_species']
+
+    score_taxo = np.zeros(len(dt_isdb_results), dtype=np.int64)
+    for col_ref, col_att in zip(cols_ref, cols_att):
+        score_taxo += (dt_isdb_results[col_ref].fillna('Unknown') == dt_isdb_results[col_att]).to_numpy()
+    return score_taxo
+
+
+def chemical_consistency_scores(clusterinfo_summary_file, dt_isdb_results, top_N_chemical_consistency):
+    """Cluster chemical consistency score of each candidate annotation, as computed by chemical_reponderator()
+
+    Args:
+        clusterinfo_summary_file (DataFrame): The MN metadata file
+        dt_isdb_results (DataFrame): An annotation table with its rank_spec_taxo column, sorted by feature_id and rank_spec_taxo
+        top_N_chemical_consistency (int): Top N candidates to consider for cluster chemical consistency determination
+
+    Returns:
+        np.ndarray: The score_max_consistency of each candidate
+    """
+
+    cluster_count = cluster_counter(clusterinfo_summary_file)
+    score_max_consistency = np.zeros(len(dt_isdb_results), dtype=np.int64)
+
+    for weight, col in zip([1, 2, 3], ['structure_taxonomy_npclassifier_01pathway', 'structure_taxonomy_npclassifier_02superclass',
+                                       'structure_taxonomy_npclassifier_03class']):
+
+        df = dt_isdb_results.drop_duplicates(subset=['feature_id', col])
+        df = df[df["component_id"] != -1]
+        df = df[df.rank_spec_taxo <= top_N_chemical_consistency]
+        df = df.groupby(
+            ["component_id", col]
+        ).agg({'feature_id': 'count',
+               'rank_spec_taxo': 'mean'}
+              ).reset_index(
+        ).merge(cluster_count, on='component_id', how='left')
+        df['score'] = df['feature_id'] / df['ci_count'] / (df['rank_spec_taxo']**(0.5))
+        consensus = df.sort_values('score', ascending=False).drop_duplicates(['component_id']).set_index('component_id')[col]
+
+        matched = (dt_isdb_results[col] == dt_isdb_results['component_id'].map(consensus)).to_numpy()
+        score_max_consistency = np.maximum(score_max_consistency, weight * matched)
+
+    return score_max_consistency
+
+
+def reweighting_grid(dt_isdb_results, msms_weights, taxo_weights, chemo_weights):
+    """Final scores and ranks of the candidate annotations for many weight settings at once
+
+    Args:
+        dt_isdb_results (DataFrame): An annotation table with score_input, score_taxo and score_max_consistency columns
+        msms_weights (np.ndarray): The msms_weight of each setting
+        taxo_weights (np.ndarray): The taxo_weight of each setting
+        chemo_weights (np.ndarray): The chemo_weight of each setting
+
+    Returns:
+        tuple: final_score (np.ndarray) and rank_final (np.ndarray), one column per setting
+    """
+
+    # score_input is a float32 column in the pipeline, its products are computed in float32 as well
+    # so that ties, and therefore ranks, are the same as with chemical_reponderator()
+    score_input = dt_isdb_results['score_input'].to_numpy(dtype=np.float32)
+    final_score = (score_input[:, None] * np.asarray(msms_weights, dtype=np.float32)[None, :]).astype(np.float64) + \
+        dt_isdb_results['score_taxo'].to_numpy(dtype=np.float64)[:, None] * np.asarray(taxo_weights, dtype=np.float64)[None, :] + \
+        dt_isdb_results['score_max_consistency'].to_numpy(dtype=np.float64)[:, None] * np.asarray(chemo_weights, dtype=np.float64)[None, :]
+
+    rank_final = pd.DataFrame(final_score).groupby(
+        dt_isdb_results['feature_id'].to_numpy()).rank(method='dense', ascending=False).to_numpy()
+
+    return final_score, rank_final
@@ -0,0 +1,182 @@
+import os
+import sys
+import argparse
+import textwrap
+import itertools
+import yaml
+import pandas as pd
+from pathlib import Path
+from tqdm import tqdm
+
+from reweighting_functions import taxonomical_scores, chemical_consistency_scores, reweighting_grid
+sys.path.append(os.path.join(Path(__file__).parents[2], 'src'))
+from table_io import table_exists, read_table
+
+pd.options.mode.chained_assignment = None
+
+p = Path(__file__).parents[1]
+os.chdir(p)
+
+with open (r'../params/user.yml') as file:
+    params_list_full = yaml.load(file, Loader=yaml.FullLoader)
+
+ionization_mode = params_list_full['general']['polarity']
+repository_path = os.path.normpath(params_list_full['general']['treated_data_path'])
+reweighting_params = params_list_full['isdb']['reweighting_params']
+
+""" Argument parser """
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description=textwrap.dedent('''\
+        This script evaluates a grid of reweighting parameters on the candidate annotations saved by nb_indifile.py
+        (<sample>_isdb_candidates_<polarity>.tsv), without running the pipeline again.
+        Every combination of the given values is evaluated, parameters not given are read from user.yml.
+         --------------------------------
+            Outputs (in the output directory):
+            - reweighting_sweep_summary.tsv: metrics of each configuration, summed over the samples
+            - reweighting_sweep_samples.tsv: metrics of each configuration for each sample
+            - reweighting_sweep_top1.tsv (--save_top1): rank 1 annotations of each configuration
+            Metrics are computed on the annotations nb_indifile.py would output (top_to_output, min_score_chemo_ms1).
+            With a reference table (sample_id, feature_id, short_inchikey of known annotations), the number of
+            features annotated with their reference structure at rank 1 and within the output is reported.
+        '''))
+parser.add_argument('--msms_weight', nargs='+', type=float, default=[reweighting_params['msms_weight']],
+                    help='Values of the weight attributed to the spectral score')
+parser.add_argument('--taxo_weight', nargs='+', type=float, default=[reweighting_params['taxo_weight']],
+                    help='Values of the weight attributed to the taxonomical score')
+parser.add_argument('--chemo_weight', nargs='+', type=float, default=[reweighting_params['chemo_weight']],
+                    help='Values of the weight attributed to the chemical consistency score')
+parser.add_argument('--min_score_taxo_ms1', nargs='+', type=int, default=[reweighting_params['min_score_taxo_ms1']],
+                    help='Values of the minimal taxonomical score for MS1-only candidates')
+parser.add_argument('--min_score_chemo_ms1', nargs='+', type=int, default=[reweighting_params['min_score_chemo_ms1']],
+                    help='Values of the minimal chemical consistency score for MS1-only candidates')
+parser.add_argument('-r', '--reference', required=False,
+                    help='Optional tsv of known annotations (sample_id, feature_id, short_inchikey columns)')
+parser.add_argument('-o', '--output_path', required=True,
+                    help='The path to the directory where the sweep results are written')
+parser.add_argument('--save_top1', action='store_true',
+                    help='Also write the rank 1 annotations of each configuration')
+
+args = parser.parse_args()
+output_path = os.path.normpath(args.output_path)
+top_to_output = int(reweighting_params['top_to_output'])
+top_N_chemical_consistency = reweighting_params['top_N_chemical_consistency']
+
+weights = pd.DataFrame(list(itertools.product(args.msms_weight, args.taxo_weight, args.chemo_weight)),
+                       columns=['msms_weight', 'taxo_weight', 'chemo_weight'])
+print(f'{len(weights) * len(args.min_score_taxo_ms1) * len(args.min_score_chemo_ms1)} configurations will be evaluated.')
+
+if args.reference is not None:
+    reference = pd.read_csv(args.reference, sep='\t', usecols=['sample_id', 'feature_id', 'short_inchikey'])
+    reference['sample_id'] = reference['sample_id'].astype(str)
+else:
+    reference = None
+
+cols_att = ['query_otol_domain', 'query_otol_kingdom', 'query_otol_phylum', 'query_otol_class',
+            'query_otol_order', 'query_otol_family', 'query_otol_genus', 'query_otol_species']
+cols_ref = ['organism_taxonomy_01domain', 'organism_taxonomy_02kingdom',  'organism_taxonomy_03phylum', 'organism_taxonomy_04class',
+            'organism_taxonomy_05order', 'organism_taxonomy_06family', 'organism_taxonomy_08genus', 'organism_taxonomy_09species']
+cols_npc = ['structure_taxonomy_npclassifier_01pathway', 'structure_taxonomy_npclassifier_02superclass', 'structure_taxonomy_npclassifier_03class']
+cols_to_use = ['feature_id', 'component_id', 'score_input', 'rank_spec', 'libname', 'short_inchikey'] + cols_npc + cols_ref + cols_att
+
+
+def sweep_metrics(candidates, rank_final, final_score, min_score_taxo_ms1, min_score_chemo_ms1, sample_reference):
+    """Metrics of the annotations output for one reweighting configuration
+
+    Args:
+        candidates (DataFrame): Reweighted candidate annotations of a sample
+        rank_final (np.ndarray): Final rank of each candidate
+        final_score (np.ndarray): Final score of each candidate
+        min_score_taxo_ms1 (int): Minimal taxonomical score for MS1 annotations
+        min_score_chemo_ms1 (int): Minimal cluster chemical consistency score for MS1 annotations
+        sample_reference (DataFrame): Known annotations of the sample (feature_id, short_inchikey), or None
+
+    Returns:
+        tuple: Metrics (dict) and rank 1 annotations (DataFrame)
+    """
+
+    # Same selection as top_N_slicer() and annotation_table_formatter_taxo()
+    df = candidates.assign(rank_final=rank_final, final_score=final_score)
+    df = df[df['rank_final'] <= top_to_output]
+    df = df.sort_values(['feature_id', 'rank_final'], kind='stable').drop_duplicates(subset=['feature_id', 'short_inchikey'], keep='first')
+    df = df[((df['score_taxo'] >= min_score_taxo_ms1) & (df['score_max_consistency'] >= min_score_chemo_ms1)) | (
+        df['libname'] == 'ISDB')]
+
+    top1 = df[df['rank_final'] == 1]
+    # Features whose rank 1 annotations do not include the best spectral match
+    reranked = top1.groupby('feature_id')['rank_spec'].min() > 1
+    metrics = {'n_annotations': len(df),
+               'n_annotated_features': df['feature_id'].nunique(),
+               'n_top1_isdb_features': top1.loc[top1['libname'] == 'ISDB', 'feature_id'].nunique(),
+               'n_top1_ms1_features': top1.loc[top1['libname'] != 'ISDB', 'feature_id'].nunique(),
+               'n_top1_reranked_features': int(reranked.sum()),
+               'sum_top1_final_score': top1.groupby('feature_id')['final_score'].max().sum()}
+    if sample_reference is not None:
+        found = df.merge(sample_reference, on=['feature_id', 'short_inchikey'])
+        metrics['n_reference_features'] = sample_reference['feature_id'].nunique()
+        metrics['n_reference_top1'] = found.loc[found['rank_final'] == 1, 'feature_id'].nunique()
+        metrics['n_reference_output'] = found['feature_id'].nunique()
+    return metrics, top1[['feature_id', 'short_inchikey', 'libname', 'final_score']]
+
+
+""" Process """
+
+samples_dir = [directory for directory in os.listdir(repository_path)]
+samples_metrics = []
+samples_top1 = []
+
+for sample_dir in tqdm(samples_dir):
+    isdb_candidates_path = os.path.join(repository_path, sample_dir, ionization_mode, 'isdb', sample_dir + '_isdb_candidates_' + ionization_mode + '.tsv')
+    mn_ci_ouput_path = os.path.join(repository_path, sample_dir, ionization_mode, 'molecular_network', sample_dir + '_mn_metadata_' + ionization_mode + '.tsv')
+    if not (table_exists(isdb_candidates_path) and table_exists(mn_ci_ouput_path)):
+        continue
+
+    candidates = read_table(isdb_candidates_path, columns=lambda c: c in cols_to_use, low_memory=False)
+    if len(candidates) == 0:
+        continue
+    clusterinfo_summary = read_table(mn_ci_ouput_path, columns=['feature_id', 'component_id'], on_bad_lines='skip', low_memory=True)
+    candidates["score_input"] = pd.to_numeric(candidates["score_input"], downcast="float")
+    taxo_reweight = all(col in candidates.columns for col in cols_att)
+    candidates['score_taxo'] = taxonomical_scores(candidates) if taxo_reweight else 0
+    if reference is not None:
+        sample_reference = reference.loc[reference['sample_id'] == sample_dir, ['feature_id', 'short_inchikey']]
+    else:
+        sample_reference = None
+
+    # The taxonomical filter of MS1 annotations changes the ranks used for the cluster chemical consistency,
+    # which is computed once per min_score_taxo_ms1 value. All weight settings are then scored at once.
+    for min_score_taxo_ms1 in args.min_score_taxo_ms1:
+        if taxo_reweight:
+            df = candidates[(candidates['score_taxo'] >= min_score_taxo_ms1) | (candidates['libname'] == 'ISDB')]
+        else:
+            df = candidates.copy()
+        if len(df) == 0:
+            continue
+        df['score_input_taxo'] = df['score_taxo'] + df['score_input']
+        df['rank_spec_taxo'] = df.groupby('feature_id')['score_input_taxo'].rank(method='dense', ascending=False)
+        df = df.sort_values(['feature_id', 'rank_spec_taxo'], kind='stable').reset_index(drop=True)
+        df['score_max_consistency'] = chemical_consistency_scores(clusterinfo_summary, df, top_N_chemical_consistency)
+
+        final_score, rank_final = reweighting_grid(df, weights['msms_weight'], weights['taxo_weight'], weights['chemo_weight'])
+
+        for min_score_chemo_ms1 in args.min_score_chemo_ms1:
+            for i, config in weights.iterrows():
+                metrics, top1 = sweep_metrics(df, rank_final[:, i], final_score[:, i], min_score_taxo_ms1, min_score_chemo_ms1, sample_reference)
+                config = {'sample_id': sample_dir, **config.to_dict(), 'min_score_taxo_ms1': min_score_taxo_ms1, 'min_score_chemo_ms1': min_score_chemo_ms1}
+                samples_metrics.append({**config, **metrics})
+                if args.save_top1:
+                    samples_top1.append(top1.assign(**config))
+
+if len(samples_metrics) == 0:
+    print('No candidate annotations were found, run nb_indifile.py first.')
+else:
+    os.makedirs(output_path, exist_ok=True)
+    config_cols = ['msms_weight', 'taxo_weight', 'chemo_weight', 'min_score_taxo_ms1', 'min_score_chemo_ms1']
+    samples_metrics = pd.DataFrame(samples_metrics)
+    samples_metrics.to_csv(os.path.join(output_path, 'reweighting_sweep_samples.tsv'), sep='\t', index=False)
+    summary = samples_metrics.drop(columns='sample_id').groupby(config_cols).sum().reset_index()
+    summary.insert(len(config_cols), 'n_samples', samples_metrics.groupby(config_cols).size().to_numpy())
+    summary.to_csv(os.path.join(output_path, 'reweighting_sweep_summary.tsv'), sep='\t', index=False)
+    if args.save_top1:
+        pd.concat(samples_top1).to_csv(os.path.join(output_path, 'reweighting_sweep_top1.tsv'), sep='\t', index=False)
+    print(f'Results of the sweep were written in {output_path}')
@@ -0,0 +1,457 @@
+import numba
+import numpy as np
+
+
+def spectra_to_peak_arrays(spectra):
+    """Concatenate the peaks of a list of spectra into flat arrays
+
+    Args:
+        spectra (list): List of matchms spectra objects
+
+    Returns:
+        tuple: m/z (np.ndarray), intensities (np.ndarray) and offsets (np.ndarray) arrays. \
+            The peaks of spectrum i are mz[offsets[i]:offsets[i+1]].
+    """
+
+    n_peaks = np.array([len(s.peaks.mz) for s in spectra], dtype=np.int64)
+    offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    np.cumsum(n_peaks, out=offsets[1:])
+    if len(spectra) == 0:
+        return np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.float64), offsets
+    mz = np.concatenate([s.peaks.mz for s in spectra]).astype(np.float64)
+    intensities = np.concatenate([s.peaks.intensities for s in spectra]).astype(np.float64)
+    return mz, intensities, offsets
+
+
+@numba.njit(nogil=True)
+def _collect_matches(mz1, int1, mz2, int2, tolerance, shift, buffer_1, buffer_2, buffer_prod, n_found):
+    """Append the peak pairs of two sorted spectra within tolerance to the buffers (as matchms find_matches)"""
+    lowest_idx = 0
+    for peak1_idx in range(mz1.shape[0]):
+        low_bound = mz1[peak1_idx] - tolerance
+        high_bound = mz1[peak1_idx] + tolerance
+        for peak2_idx in range(lowest_idx, mz2.shape[0]):
+            mz = mz2[peak2_idx] + shift
+            if mz > high_bound:
+                break
+            if mz < low_bound:
+                lowest_idx = peak2_idx
+            else:
+                if n_found == buffer_1.shape[0]:
+                    return -1
+                buffer_1[n_found] = peak1_idx
+                buffer_2[n_found] = peak2_idx
+                buffer_prod[n_found] = int1[peak1_idx] * int2[peak2_idx]
+                n_found += 1
+    return n_found
+
+
+@numba.njit(nogil=True)
+def _score_greedy(buffer_1, buffer_2, buffer_prod, n_found, n1, n2, norm):
+    """Greedy assignment of the collected peak pairs, by decreasing intensity product
+
+    Ties are taken in the order the pairs were collected (stable sort), whereas matchms takes them in the order \
+        of numpy's unstable argsort, which depends on the CPU.
+    """
+    if n_found == 0:
+        return 0.0, 0
+    order = np.argsort(-buffer_prod[:n_found], kind='mergesort')
+    used_1 = np.zeros(n1, dtype=np.bool_)
+    used_2 = np.zeros(n2, dtype=np.bool_)
+    score = 0.0
+    n_matches = 0
+    for k in order:
+        if not used_1[buffer_1[k]] and not used_2[buffer_2[k]]:
+            score += buffer_prod[k]
+            used_1[buffer_1[k]] = True
+            used_2[buffer_2[k]] = True
+            n_matches += 1
+    return score / norm, n_matches
+
+
+@numba.njit(nogil=True)
+def cosine_greedy_pairs(mz_1, intensities_1, offsets_1, mz_2, intensities_2, offsets_2,
+                        idx_1, idx_2, tolerance):
+    """Greedy cosine score for a batch of spectrum pairs
+
+    Gives the same scores and matched peaks as matchms CosineGreedy(tolerance=tolerance).pair() \
+        with its default mz_power=0 and intensity_power=1, except that peak pairs with equal intensity \
+        products are assigned in a fixed order (see _score_greedy()). When such ties compete for the \
+        same peak, matchms may keep another pair and give a slightly different result.
+
+    Args:
+        mz_1, intensities_1, offsets_1 (np.ndarray): Peak arrays of the first set of spectra (see spectra_to_peak_arrays())
+        mz_2, intensities_2, offsets_2 (np.ndarray): Peak arrays of the second set of spectra
+        idx_1 (np.ndarray): Index in the first set of each pair
+        idx_2 (np.ndarray): Index in the second set of each pair
+        tolerance (float): Peaks will be considered a match when <= tolerance apart
+
+    Returns:
+        tuple: Scores (np.ndarray) and numbers of matched peaks (np.ndarray), one per pair
+    """
+
+    n_pairs = idx_1.shape[0]
+    scores = np.zeros(n_pairs, dtype=np.float64)
+    matches = np.zeros(n_pairs, dtype=np.int64)
+
+    buffer_size = 1024
+    buffer_1 = np.empty(buffer_size, dtype=np.int64)
+    buffer_2 = np.empty(buffer_size, dtype=np.int64)
+    buffer_prod = np.empty(buffer_size, dtype=np.float64)
+
+    for p in range(n_pairs):
+        start_1, end_1 = offsets_1[idx_1[p]], offsets_1[idx_1[p] + 1]
+        start_2, end_2 = offsets_2[idx_2[p]], offsets_2[idx_2[p] + 1]
+        n_found = _collect_matches(mz_1[start_1:end_1], intensities_1[start_1:end_1],
+                                   mz_2[start_2:end_2], intensities_2[start_2:end_2],
+                                   tolerance, 0.0, buffer_1, buffer_2, buffer_prod, 0)
+        while n_found < 0:
+            buffer_size *= 2
+            buffer_1 = np.empty(buffer_size, dtype=np.int64)
+            buffer_2 = np.empty(buffer_size, dtype=np.int64)
+            buffer_prod = np.empty(buffer_size, dtype=np.float64)
+            n_found = _collect_matches(mz_1[start_1:end_1], intensities_1[start_1:end_1],
+                                       mz_2[start_2:end_2], intensities_2[start_2:end_2],
+                                       tolerance, 0.0, buffer_1, buffer_2, buffer_prod, 0)
+        norm = np.sqrt(np.sum(intensities_1[start_1:end_1] ** 2)) * np.sqrt(np.sum(intensities_2[start_2:end_2] ** 2))
+        scores[p], matches[p] = _score_greedy(buffer_1, buffer_2, buffer_prod, n_found,
+                                              end_1 - start_1, end_2 - start_2, norm)
+    return scores, matches
+
+
+@numba.njit(nogil=True)
+def _count_peaks_with_partner(mz_1, mz_2, tolerance):
+    """Number of peaks of mz_1 with at least one peak of mz_2 within tolerance (both sorted)"""
+    n_found = 0
+    j = 0
+    for i in range(mz_1.shape[0]):
+        while j < mz_2.shape[0] and mz_2[j] < mz_1[i] - tolerance:
+            j += 1
+        if j < mz_2.shape[0] and mz_2[j] <= mz_1[i] + tolerance:
+            n_found += 1
+    return n_found
+
+
+@numba.njit(nogil=True)
+def _count_partnered_peaks(mz_1, mz_2, tolerance):
+    """Number of peaks of mz_2 with at least one peak of mz_1 within tolerance (both sorted)"""
+    n_found = 0
+    i = 0
+    for j in range(mz_2.shape[0]):
+        while i < mz_1.shape[0] and mz_1[i] + tolerance < mz_2[j]:
+            i += 1
+        if i < mz_1.shape[0] and mz_1[i] - tolerance <= mz_2[j]:
+            n_found += 1
+    return n_found
+
+
+@numba.njit(nogil=True)
+def matched_peaks_upper_bound(mz_1, offsets_1, mz_2, offsets_2, idx_1, idx_2, tolerance):
+    """Upper bound of the number of matched peaks of the greedy cosine for a batch of spectrum pairs
+
+    Matched peaks are disjoint pairs of peaks within tolerance, so there cannot be more of them than peaks \
+        of either spectrum having a partner in the other one. Both counts only need a linear merge of the \
+        sorted m/z arrays.
+
+    Args:
+        mz_1, offsets_1 (np.ndarray): Peak m/z and offsets of the first set of spectra (see spectra_to_peak_arrays())
+        mz_2, offsets_2 (np.ndarray): Peak m/z and offsets of the second set of spectra
+        idx_1 (np.ndarray): Index in the first set of each pair
+        idx_2 (np.ndarray): Index in the second set of each pair
+        tolerance (float): Peaks will be considered a match when <= tolerance apart
+
+    Returns:
+        np.ndarray: Upper bound of the number of matched peaks of each pair
+    """
+
+    n_pairs = idx_1.shape[0]
+    bounds = np.zeros(n_pairs, dtype=np.int64)
+    for p in range(n_pairs):
+        peaks_1 = mz_1[offsets_1[idx_1[p]]:offsets_1[idx_1[p] + 1]]
+        peaks_2 = mz_2[offsets_2[idx_2[p]]:offsets_2[idx_2[p] + 1]]
+        bound = _count_peaks_with_partner(peaks_1, peaks_2, tolerance)
+        if bound > 0:
+            bound = min(bound, _count_partnered_peaks(peaks_1, peaks_2, tolerance))
+        bounds[p] = bound
+    return bounds
+
+
+@numba.njit(nogil=True)
+def _collect_modified_matches(mz1, int1, mz2, int2, tolerance, shift, buffer_1, buffer_2, buffer_prod):
+    """Collect the peak pairs of two sorted spectra matching without and with the precursor shift (as matchms ModifiedCosine)"""
+    n_found = _collect_matches(mz1, int1, mz2, int2, tolerance, 0.0, buffer_1, buffer_2, buffer_prod, 0)
+    if n_found < 0:
+        return n_found
+    return _collect_matches(mz1, int1, mz2, int2, tolerance, shift, buffer_1, buffer_2, buffer_prod, n_found)
+
+
+@numba.njit(nogil=True)
+def _keep_top_n(top_idx, top_scores, row, idx, score):
+    """Keep (idx, score) in the top_n neighbours of row if it ranks among them (ties go to the highest index)"""
+    worst = 0
+    for k in range(1, top_idx.shape[1]):
+        if top_scores[row, k] < top_scores[row, worst] or \
+                (top_scores[row, k] == top_scores[row, worst] and top_idx[row, k] < top_idx[row, worst]):
+            worst = k
+    if score > top_scores[row, worst] or (score == top_scores[row, worst] and idx > top_idx[row, worst]):
+        top_idx[row, worst] = idx
+        top_scores[row, worst] = score
+
+
+@numba.njit(nogil=True)
+def prefix_peaks(intensities, offsets, norms, min_score):
+    """Mark the peaks of each spectrum that any pair scoring >= min_score has to match
+
+    By Cauchy-Schwarz, the modified cosine is at most the square root of the share of the squared norm \
+        held by the matched peaks of each spectrum. The matched peaks of a pair scoring >= min_score so hold \
+        at least min_score ** 2 of it, and cannot all be among the weakest peaks holding less than that: \
+        at least one of the other (marked) peaks is matched.
+
+    Args:
+        intensities, offsets (np.ndarray): Peak intensities and offsets of the spectra (see spectra_to_peak_arrays())
+        norms (np.ndarray): Euclidean norm of the intensities of each spectrum
+        min_score (float): Minimal score of the pairs
+
+    Returns:
+        np.ndarray: Boolean mask of the marked peaks
+    """
+
+    prefix = np.ones(intensities.shape[0], dtype=np.bool_)
+    # The margin keeps rounding errors on the safe side
+    max_tail = min_score ** 2 - 1e-9
+    for s in range(offsets.shape[0] - 1):
+        start = offsets[s]
+        peaks = intensities[start:offsets[s + 1]]
+        tail = 0.0
+        for k in np.argsort(peaks):
+            tail += (peaks[k] / norms[s]) ** 2
+            if not tail < max_tail:
+                break
+            prefix[start + k] = False
+    return prefix
+
+
+@numba.njit(nogil=True)
+def _add_spectra_in_range(index_values, index_spectrum, low, high, first, exclude, col_start, stamp, stamp_value,
+                          candidates, n_candidates):
+    """Add the spectra >= first (but exclude) of the index entries within [low, high] to the candidates, once each"""
+    k = np.searchsorted(index_values, low)
+    while k < index_values.shape[0] and index_values[k] <= high:
+        j = index_spectrum[k]
+        if j >= first and j != exclude and stamp[j - col_start] != stamp_value:
+            stamp[j - col_start] = stamp_value
+            candidates[n_candidates] = j
+            n_candidates += 1
+        k += 1
+    return n_candidates
+
+
+@numba.njit(nogil=True)
+def _prefix_candidates(i, mz, offsets, precursor_mz, prefix, index_mz, index_mz_spectrum, index_loss, index_loss_spectrum,
+                       first, col_start, tolerance, stamp, candidates):
+    """Spectra >= first of the index sharing a fragment or a neutral loss with a marked peak of spectrum i
+
+    Returns:
+        int: Number of candidates, written at the start of candidates
+    """
+
+    # Matches with shifted peaks are found on the neutral losses, computed with a different rounding
+    margin = tolerance + 1e-6
+    n_candidates = 0
+    for p in range(offsets[i], offsets[i + 1]):
+        if prefix[p]:
+            n_candidates = _add_spectra_in_range(index_mz, index_mz_spectrum, mz[p] - margin, mz[p] + margin,
+                                                 first, i, col_start, stamp, i, candidates, n_candidates)
+            loss = precursor_mz[i] - mz[p]
+            n_candidates = _add_spectra_in_range(index_loss, index_loss_spectrum, loss - margin, loss + margin,
+                                                 first, i, col_start, stamp, i, candidates, n_candidates)
+    return n_candidates
+
+
+@numba.njit(nogil=True)
+def _mark_partners(mz1, mz2, tolerance, shift, partners_1, partners_2):
+    """Mark the peaks of two sorted spectra having a partner within tolerance in the other one (as _collect_matches)"""
+    lowest_idx = 0
+    for peak1_idx in range(mz1.shape[0]):
+        low_bound = mz1[peak1_idx] - tolerance
+        high_bound = mz1[peak1_idx] + tolerance
+        for peak2_idx in range(lowest_idx, mz2.shape[0]):
+            mz = mz2[peak2_idx] + shift
+            if mz > high_bound:
+                break
+            if mz < low_bound:
+                lowest_idx = peak2_idx
+            else:
+                partners_1[peak1_idx] = True
+                partners_2[peak2_idx] = True
+
+
+@numba.njit(nogil=True)
+def _modified_cosine_bound(mz1, int1, norm1, mz2, int2, norm2, tolerance, shift, partners_1, partners_2):
+    """Cauchy-Schwarz upper bound of the modified cosine of two spectra: the product of the norms of their \
+        peaks having a partner, over the product of their norms"""
+    partners_1[:mz1.shape[0]] = False
+    partners_2[:mz2.shape[0]] = False
+    _mark_partners(mz1, mz2, tolerance, 0.0, partners_1, partners_2)
+    _mark_partners(mz1, mz2, tolerance, shift, partners_1, partners_2)
+    energy_1 = 0.0
+    for k in range(mz1.shape[0]):
+        if partners_1[k]:
+            energy_1 += int1[k] ** 2
+    energy_2 = 0.0
+    for k in range(mz2.shape[0]):
+        if partners_2[k]:
+            energy_2 += int2[k] ** 2
+    return np.sqrt(energy_1) * np.sqrt(energy_2) / (norm1 * norm2)
+
+
+@numba.njit(nogil=True)
+def _new_buffers(buffer_size, max_peaks):
+    """Peak pair and partner buffers of _modified_cosine_pair()"""
+    return (np.empty(buffer_size, dtype=np.int64), np.empty(buffer_size, dtype=np.int64),
+            np.empty(buffer_size, dtype=np.float64), np.empty(max_peaks, dtype=np.bool_), np.empty(max_peaks, dtype=np.bool_))
+
+
+@numba.njit(nogil=True)
+def _modified_cosine_pair(mz, intensities, offsets, precursor_mz, norms, i, j, tolerance, min_score, buffers):
+    """Modified cosine score of the spectra i and j, 0 if its Cauchy-Schwarz bound is below min_score > 0
+
+    Returns:
+        tuple: Score and the buffers (output of _new_buffers()), grown if they were too small
+    """
+
+    buffer_1, buffer_2, buffer_prod, partners_1, partners_2 = buffers
+    mz_i, int_i = mz[offsets[i]:offsets[i + 1]], intensities[offsets[i]:offsets[i + 1]]
+    mz_j, int_j = mz[offsets[j]:offsets[j + 1]], intensities[offsets[j]:offsets[j + 1]]
+    shift = precursor_mz[i] - precursor_mz[j]
+    if min_score > 0:
+        if max(mz_i.shape[0], mz_j.shape[0]) > partners_1.shape[0]:
+            partners_1 = np.empty(max(mz_i.shape[0], mz_j.shape[0]), dtype=np.bool_)
+            partners_2 = np.empty(max(mz_i.shape[0], mz_j.shape[0]), dtype=np.bool_)
+        if _modified_cosine_bound(mz_i, int_i, norms[i], mz_j, int_j, norms[j], tolerance, shift,
+                                  partners_1, partners_2) + 1e-9 < min_score:
+            return 0.0, (buffer_1, buffer_2, buffer_prod, partners_1, partners_2)
+    n_found = _collect_modified_matches(mz_i, int_i, mz_j, int_j, tolerance, shift, buffer_1, buffer_2, buffer_prod)
+    while n_found < 0:
+        buffer_1 = np.empty(2 * buffer_1.shape[0], dtype=np.int64)
+        buffer_2 = np.empty(2 * buffer_2.shape[0], dtype=np.int64)
+        buffer_prod = np.empty(2 * buffer_prod.shape[0], dtype=np.float64)
+        n_found = _collect_modified_matches(mz_i, int_i, mz_j, int_j, tolerance, shift, buffer_1, buffer_2, buffer_prod)
+    score, _ = _score_greedy(buffer_1, buffer_2, buffer_prod, n_found, mz_i.shape[0], mz_j.shape[0], norms[i] * norms[j])
+    return score, (buffer_1, buffer_2, buffer_prod, partners_1, partners_2)
+
+
+@numba.njit(nogil=True)
+def modified_cosine_top_n(mz, intensities, offsets, precursor_mz, norms, prefix,
+                          index_mz, index_mz_spectrum, index_loss, index_loss_spectrum,
+                          row_start, row_end, col_start, col_end, tolerance, min_score, top_idx, top_scores):
+    """Modified cosine scores of a tile of the upper triangle of the pairs, keeping only the top_n neighbours \
+        of each spectrum of the tile
+
+    Scores are the same as matchms ModifiedCosine(tolerance=tolerance).pair(spectrum_i, spectrum_j) for i < j, \
+        with its default mz_power=0 and intensity_power=1, up to the order of tied peak pairs (see _score_greedy()). The pairs (i, j) with row_start <= i < row_end, \
+        col_start <= j < col_end and i < j which may score >= min_score are scored once and offered to the \
+        neighbours of both spectra. Only the spectra j sharing a fragment or a neutral loss with a marked peak of i \
+        (see prefix_peaks()) are candidates, and their exact score is only computed when its Cauchy-Schwarz bound \
+        reaches min_score, so that the skipped pairs are exactly those that could not.
+
+    Args:
+        mz, intensities, offsets (np.ndarray): Peak arrays of the spectra (see spectra_to_peak_arrays())
+        precursor_mz (np.ndarray): Precursor m/z of each spectrum
+        norms (np.ndarray): Euclidean norm of the intensities of each spectrum
+        prefix (np.ndarray): Peaks one of which any pair scoring >= min_score matches (output of prefix_peaks())
+        index_mz, index_mz_spectrum (np.ndarray): Sorted fragment m/z of the spectra col_start:col_end, \
+            and their spectrum (see fragment_index.build_network_index())
+        index_loss, index_loss_spectrum (np.ndarray): Sorted neutral losses of these spectra, and their spectrum
+        row_start, row_end (int): Range of the spectra i of the tile
+        col_start, col_end (int): Range of the spectra j of the tile, either the same as the rows or after them
+        tolerance (float): Peaks will be considered a match when <= tolerance apart
+        min_score (float): Minimal score of the neighbours kept, scores of 0 are never kept
+        top_idx (np.ndarray): (n_tile_spectra, top_n) indices of the best neighbours of the rows, then of the columns \
+            if they are not the rows, -1 for empty slots. Updated in place.
+        top_scores (np.ndarray): (n_tile_spectra, top_n) scores of these neighbours, 0 for empty slots. Updated in place.
+    """
+
+    col_slot = col_start - (row_end - row_start) if col_start != row_start else col_start
+    buffers = _new_buffers(1024, 256)
+    stamp = np.full(col_end - col_start, -1, dtype=np.int64)
+    candidates = np.empty(col_end - col_start, dtype=np.int64)
+
+    for i in range(row_start, row_end):
+        n_candidates = _prefix_candidates(i, mz, offsets, precursor_mz, prefix, index_mz, index_mz_spectrum,
+                                          index_loss, index_loss_spectrum, max(i + 1, col_start), col_start,
+                                          tolerance, stamp, candidates)
+        for j in np.sort(candidates[:n_candidates]):
+            score, buffers = _modified_cosine_pair(mz, intensities, offsets, precursor_mz, norms, i, j,
+                                                   tolerance, min_score, buffers)
+            # Pairs without score are not stored by matchms, and so never ranked
+            if score > 0 and score >= min_score:
+                _keep_top_n(top_idx, top_scores, i - row_start, j, score)
+                _keep_top_n(top_idx, top_scores, j - col_slot, i, score)
+
+
+@numba.njit(nogil=True)
+def modified_cosine_pairs(mz, intensities, offsets, precursor_mz, norms, idx_1, idx_2, tolerance, min_score):
+    """Modified cosine scores of a batch of spectrum pairs, as modified_cosine_top_n()
+
+    Returns:
+        np.ndarray: Score of each pair, 0 for the pairs that cannot score >= min_score
+    """
+
+    scores = np.zeros(idx_1.shape[0], dtype=np.float64)
+    buffers = _new_buffers(1024, 256)
+    for p in range(idx_1.shape[0]):
+        scores[p], buffers = _modified_cosine_pair(mz, intensities, offsets, precursor_mz, norms, idx_1[p], idx_2[p],
+                                                   tolerance, min_score, buffers)
+    return scores
+
+
+@numba.njit(nogil=True)
+def modified_cosine_neighbours(rows, mz, intensities, offsets, precursor_mz, norms, prefix,
+                               index_mz, index_mz_spectrum, index_loss, index_loss_spectrum, tolerance, min_score):
+    """All the neighbours scoring >= min_score (and > 0) of some spectra, as modified_cosine_top_n()
+
+    Args:
+        rows (np.ndarray): Spectra whose neighbours are searched
+        index_mz, index_mz_spectrum, index_loss, index_loss_spectrum (np.ndarray): Index of all the spectra \
+            (see fragment_index.build_network_index())
+        (other arguments as modified_cosine_top_n())
+
+    Returns:
+        tuple: Spectrum (np.ndarray), neighbour (np.ndarray) and score (np.ndarray) of each pair
+    """
+
+    n_spectra = offsets.shape[0] - 1
+    buffers = _new_buffers(1024, 256)
+    stamp = np.full(n_spectra, -1, dtype=np.int64)
+    candidates = np.empty(n_spectra, dtype=np.int64)
+    size = 1024
+    found_1 = np.empty(size, dtype=np.int64)
+    found_2 = np.empty(size, dtype=np.int64)
+    found_scores = np.empty(size, dtype=np.float64)
+    n_found = 0
+    for i in rows:
+        n_candidates = _prefix_candidates(i, mz, offsets, precursor_mz, prefix, index_mz, index_mz_spectrum,
+                                          index_loss, index_loss_spectrum, 0, 0, tolerance, stamp, candidates)
+        for j in np.sort(candidates[:n_candidates]):
+            score, buffers = _modified_cosine_pair(mz, intensities, offsets, precursor_mz, norms, min(i, j), max(i, j),
+                                                   tolerance, min_score, buffers)
+            if score > 0 and score >= min_score:
+                if n_found == size:
+                    found_1 = np.concatenate((found_1, np.empty(size, dtype=np.int64)))
+                    found_2 = np.concatenate((found_2, np.empty(size, dtype=np.int64)))
+                    found_scores = np.concatenate((found_scores, np.empty(size, dtype=np.float64)))
+                    size *= 2
+                found_1[n_found] = i
+                found_2[n_found] = j
+                found_scores[n_found] = score
+                n_found += 1
+    return found_1[:n_found], found_2[:n_found], found_scores[:n_found]
+
+
+@numba.njit(nogil=True)
+def keep_top_n_pairs(top_idx, top_scores, idx_1, idx_2, scores):
+    """Offer scored pairs to the top_n neighbours of both their spectra (see modified_cosine_top_n())"""
+    for p in range(idx_1.shape[0]):
+        _keep_top_n(top_idx, top_scores, idx_1[p], idx_2[p], scores[p])
+        _keep_top_n(top_idx, top_scores, idx_2[p], idx_1[p], scores[p])
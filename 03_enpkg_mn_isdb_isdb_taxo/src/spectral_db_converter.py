@@ -0,0 +1,47 @@
+import os
+import argparse
+import textwrap
+from pathlib import Path
+
+from spectral_db_loader import load_clean_spectral_db
+from spectral_db_loader import spectral_db_to_arrays
+from spectral_db_loader import save_columnar_spectral_db
+from spectral_db_loader import append_columnar_spectral_db
+
+p = Path(__file__).parents[1]
+os.chdir(p)
+
+""" Argument parser """
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description=textwrap.dedent('''\
+        This script converts a spectral database (.pkl or .mgf) into the columnar format, 
+        which is memory-mapped when loaded (set its directory as spectral_db_pos_path / spectral_db_neg_path).
+         --------------------------------
+            Arguments:
+            - Path(s) to the spectral database file(s) to convert (.pkl, or one or several .mgf)
+            - Path to the output directory
+            - With --append, the spectra are appended to the existing columnar spectral database in the output
+              directory. Samples annotated against its previous version then only get the appended spectra matched.
+        '''))
+parser.add_argument('-p', '--spectral_db_path', required=True, nargs='+',
+                    help='The path to the spectral database file(s) to convert')
+parser.add_argument('-o', '--output_path', required=True,
+                    help='The path to the directory where the columnar spectral database is written')
+parser.add_argument('--append', action='store_true',
+                    help='Append the spectra to the existing columnar spectral database in the output directory')
+
+args = parser.parse_args()
+spectral_db_path = [os.path.normpath(path) for path in args.spectral_db_path]
+output_path = os.path.normpath(args.output_path)
+
+""" Process """
+
+if len(spectral_db_path) == 1:
+    spectral_db_path = spectral_db_path[0]
+
+spectral_db = load_clean_spectral_db(spectral_db_path)
+if args.append and os.path.isfile(os.path.join(output_path, 'spectral_db.json')):
+    append_columnar_spectral_db(spectral_db_to_arrays(spectral_db), output_path, source=spectral_db_path)
+else:
+    save_columnar_spectral_db(spectral_db_to_arrays(spectral_db), output_path, source=spectral_db_path)
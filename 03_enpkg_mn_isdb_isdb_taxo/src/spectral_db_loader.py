@@ -1,9 +1,16 @@
+import os
+import json
 import pickle
 
+import numpy as np
+import pandas as pd
 from matchms.importing import load_from_mgf
 from matchms.filtering import default_filters
 from matchms.exporting import save_as_mgf
 
+from similarity_kernels import spectra_to_peak_arrays
+from matching_cache import spectral_db_hash
+
 
 def load_spectral_db(path_to_db):
     """Load and clean metadata from a .mgf spectral database
@@ -29,10 +36,11 @@ def load_clean_spectral_db(path_to_db):
     """Loads metadata from a .mgf spectral database
 
     Args:
-        path_to_db (str): Path to the .mgf file
+        path_to_db (str or list): Path to the .mgf or .pkl file, list of .mgf files \
+            or directory of a columnar spectral database (see save_columnar_spectral_db())
 
     Returns:
-        list: List of matchms spectra object
+        list or dict: List of matchms spectra object, or the memory-mapped arrays for a columnar spectral database
     """    
     
     print('''
@@ -41,8 +49,10 @@ def load_clean_spectral_db(path_to_db):
 
     # Below the loading of external db is modified to accommodate multiple spectral db as input
     
+    if type(path_to_db) is str and os.path.isdir(path_to_db):
+        return load_columnar_spectral_db(path_to_db)
     if type(path_to_db) is str and '.mgf' in path_to_db : 
-        spectrums_db = list(load_from_mgf(db_file_path))
+        spectrums_db = list(load_from_mgf(path_to_db))
     if type(path_to_db) is str and '.pkl' in path_to_db :
         with open(path_to_db, 'rb') as f:
             spectrums_db = pickle.load(f)
@@ -76,4 +86,165 @@ def save_spectral_db(spectrums_db, output_path):
 
     print(f'''
     A total of {len(spectrums_db)} clean spectra were found in the spectral library and saved as {output_path}
-    ''')
\ No newline at end of file
+    ''')
+
+
+def spectral_db_to_arrays(spectrums_db):
+    """Convert a list of matchms spectra into the array representation used for spectral matching
+
+    Args:
+        spectrums_db (list): List of matchms spectra object (e.g. output of load_clean_spectral_db())
+
+    Returns:
+        dict: Peak arrays ('mz', 'intensities', 'offsets'), 'precursor_mz' and 'short_inchikey' of the library spectra
+    """
+
+    mz, intensities, offsets = spectra_to_peak_arrays(spectrums_db)
+    return {'mz': mz,
+            'intensities': intensities,
+            'offsets': offsets,
+            'precursor_mz': np.array([s.get('precursor_mz') for s in spectrums_db], dtype=np.float64),
+            'short_inchikey': np.array([s.get('compound_name') for s in spectrums_db], dtype=object)}
+
+
+def spectral_db_structure_ids(spectral_db_arrays):
+    """Number the structures of the library spectra, so that the spectra of a structure can be grouped
+
+    Args:
+        spectral_db_arrays (dict): Array representation of the spectral db (output of spectral_db_to_arrays())
+
+    Returns:
+        np.ndarray: Structure number of each library spectrum, shared by the spectra with the same short InChIKey. \
+            Spectra without short InChIKey get their own number.
+    """
+
+    short_inchikey = np.asarray(spectral_db_arrays['short_inchikey'], dtype=object)
+    missing = pd.isna(short_inchikey) | (short_inchikey == '')
+    structure_ids, uniques = pd.factorize(np.where(missing, None, short_inchikey))
+    structure_ids[missing] = len(uniques) + np.arange(missing.sum())
+    return structure_ids.astype(np.int64)
+
+
+COLUMNAR_DB_ARRAYS = ['mz', 'intensities', 'offsets', 'precursor_mz', 'short_inchikey']
+
+
+def save_columnar_spectral_db(spectral_db_arrays, output_path, source=None, history=None):
+    """Save a spectral db in the columnar format, one .npy file per array plus a spectral_db.json manifest
+
+    Args:
+        spectral_db_arrays (dict): Array representation of the spectral db (output of spectral_db_to_arrays())
+        output_path (str): Directory to write the columnar spectral db to
+        source (str or list, optional): Spectral db file(s) the arrays were converted from
+        history (list, optional): Previous versions of the spectral db (see append_columnar_spectral_db())
+    """
+
+    os.makedirs(output_path, exist_ok=True)
+    for key in COLUMNAR_DB_ARRAYS:
+        array = spectral_db_arrays[key]
+        if array.dtype == object:
+            array = np.array(['' if x is None else x for x in array], dtype=str)
+        np.save(os.path.join(output_path, key + '.npy'), array)
+    manifest = {'format_version': 1,
+                'n_spectra': int(len(spectral_db_arrays['precursor_mz'])),
+                'n_peaks': int(len(spectral_db_arrays['mz'])),
+                'source': source}
+    if history:
+        manifest['history'] = history
+    with open(os.path.join(output_path, 'spectral_db.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f'''
+    A total of {manifest['n_spectra']} spectra were saved in the columnar spectral library {output_path}
+    ''')
+
+
+def load_columnar_spectral_db(path_to_db):
+    """Open a columnar spectral db with memory mapping
+
+    The arrays are not read into memory: pages are loaded on access and shared through the page cache \
+        between all processes opening the same spectral db.
+
+    Args:
+        path_to_db (str): Directory of the columnar spectral db
+
+    Returns:
+        dict: Memory-mapped arrays of the spectral db (same keys as spectral_db_to_arrays())
+    """
+
+    with open(os.path.join(path_to_db, 'spectral_db.json')) as f:
+        manifest = json.load(f)
+    spectral_db_arrays = {key: np.load(os.path.join(path_to_db, key + '.npy'), mmap_mode='r')
+                          for key in COLUMNAR_DB_ARRAYS}
+
+    print(f'''
+    A total of {manifest['n_spectra']} clean spectra were found in the spectral library
+    ''')
+    return spectral_db_arrays
+
+
+def append_columnar_spectral_db(spectral_db_arrays, path_to_db, source=None):
+    """Append spectra to a columnar spectral db, keeping the history of its versions
+
+    The appended spectra come after the existing ones, whose reference_id do not change. The manifest records \
+        the number of spectra and the content hash of each previous version, so that spectral matching results \
+        computed against a previous version can be completed by matching only the appended spectra.
+
+    Args:
+        spectral_db_arrays (dict): Array representation of the spectra to append (output of spectral_db_to_arrays())
+        path_to_db (str): Directory of the columnar spectral db
+        source (str or list, optional): Spectral db file(s) the appended arrays were converted from
+    """
+
+    with open(os.path.join(path_to_db, 'spectral_db.json')) as f:
+        manifest = json.load(f)
+    history = manifest.get('history', []) + [{'n_spectra': manifest['n_spectra'], 'n_peaks': manifest['n_peaks'],
+                                              'source': manifest['source'], 'spectral_db_hash': spectral_db_hash(path_to_db)}]
+    # Read in memory (not memory-mapped) as the files are overwritten
+    current = {key: np.load(os.path.join(path_to_db, key + '.npy')) for key in COLUMNAR_DB_ARRAYS}
+    appended = {}
+    for key in COLUMNAR_DB_ARRAYS:
+        array = spectral_db_arrays[key]
+        if key == 'offsets':
+            array = np.asarray(array)[1:] + current['offsets'][-1]
+        elif array.dtype == object:
+            array = np.array(['' if x is None else x for x in array], dtype=str)
+        appended[key] = np.concatenate([current[key], array])
+    save_columnar_spectral_db(appended, path_to_db, source=source, history=history)
+
+
+def columnar_spectral_db_history(path_to_db):
+    """Previous versions of a columnar spectral db (see append_columnar_spectral_db())
+
+    Args:
+        path_to_db (str): Path to the spectral db
+
+    Returns:
+        list: 'n_spectra' and 'spectral_db_hash' of each previous version, empty if the spectral db is not \
+            a columnar spectral db or was never appended to
+    """
+
+    manifest_path = os.path.join(path_to_db, 'spectral_db.json') if type(path_to_db) is str else None
+    if manifest_path is None or not os.path.isfile(manifest_path):
+        return []
+    with open(manifest_path) as f:
+        return json.load(f).get('history', [])
+
+
+def spectral_db_tail(spectral_db_arrays, start):
+    """Array representation of the spectra of a spectral db from position start on
+
+    Args:
+        spectral_db_arrays (dict): Array representation of the spectral db (output of spectral_db_to_arrays())
+        start (int): Position of the first spectrum
+
+    Returns:
+        dict: Arrays of the spectra start to the end (views of spectral_db_arrays, memory mapping is kept)
+    """
+
+    offsets = spectral_db_arrays['offsets']
+    first_peak = int(offsets[start])
+    return {'mz': spectral_db_arrays['mz'][first_peak:],
+            'intensities': spectral_db_arrays['intensities'][first_peak:],
+            'offsets': np.asarray(offsets[start:]) - first_peak,
+            'precursor_mz': spectral_db_arrays['precursor_mz'][start:],
+            'short_inchikey': spectral_db_arrays['short_inchikey'][start:]}
@@ -0,0 +1,40 @@
+import os
+import argparse
+import textwrap
+from pathlib import Path
+
+from library_shards import split_spectral_db
+
+p = Path(__file__).parents[1]
+os.chdir(p)
+
+""" Argument parser """
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description=textwrap.dedent('''\
+        This script splits a spectral database (.pkl, .mgf or columnar) into shards of consecutive precursor m/z ranges
+        (set its directory as spectral_db_pos_path / spectral_db_neg_path). Query spectra are then only matched
+        against the shards their precursor m/z window overlaps, and the shards can be matched by separate runs.
+         --------------------------------
+            Arguments:
+            - Path(s) to the spectral database file(s) to split (.pkl, one or several .mgf, or a columnar directory)
+            - Path to the output directory
+            - Number of shards
+        '''))
+parser.add_argument('-p', '--spectral_db_path', required=True, nargs='+',
+                    help='The path to the spectral database file(s) to split')
+parser.add_argument('-o', '--output_path', required=True,
+                    help='The path to the directory where the sharded spectral database is written')
+parser.add_argument('-n', '--n_shards', required=True, type=int,
+                    help='The number of shards, of about the same number of spectra')
+
+args = parser.parse_args()
+spectral_db_path = [os.path.normpath(path) for path in args.spectral_db_path]
+output_path = os.path.normpath(args.output_path)
+
+""" Process """
+
+if len(spectral_db_path) == 1:
+    spectral_db_path = spectral_db_path[0]
+
+split_spectral_db(spectral_db_path, output_path, args.n_shards)
@@ -1,14 +1,25 @@
 import os
+import sys
+from pathlib import Path
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-from tqdm.contrib import tzip
+from tqdm import tqdm
 from matchms.filtering import default_filters
 from matchms.filtering import normalize_intensities
 from matchms.filtering import select_by_intensity
 from matchms.filtering import select_by_mz
-from matchms.similarity import PrecursorMzMatch
-from matchms import calculate_scores
-from matchms.similarity import CosineGreedy
 from matchms.logging_functions import set_matchms_logger_level
+from precursor_index import build_precursor_index, query_precursor_index
+from similarity_kernels import cosine_greedy_pairs, matched_peaks_upper_bound
+from peak_preprocessing import spectra_to_query_arrays, preprocess_peak_arrays
+from spectral_db_loader import spectral_db_to_arrays, spectral_db_structure_ids
+from fragment_index import build_fragment_index, search_fragment_index
+from prescreen import binned_vectors, prescreen_pairs
+from query_dedup import representative_spectra, fan_out_hits
+sys.path.append(os.path.join(Path(__file__).parents[2], 'src'))
+from table_io import parquet_path, write_table
 
 # See https://github.com/matchms/matchms/pull/271
 set_matchms_logger_level("ERROR")
@@ -21,55 +32,205 @@ def peak_processing(spectrum):
     return spectrum
 
 
+# Library, indexes and parameters of the ongoing spectral_matching() call, inherited by the forked workers
+_matching_context = {}
+
+
+def _match_chunk(chunk):
+    """Match one chunk of query spectra against the library of the ongoing spectral_matching() call
+
+    Args:
+        chunk (tuple): Peak arrays (mz, intensities, offsets), precursor m/z and scans id of the query spectra
+
+    Returns:
+        DataFrame: The hits of the chunk
+    """
+
+    ctx = _matching_context
+    db_clean = ctx['db_clean']
+    query_mz, query_intensities, query_offsets, query_precursor_mz, scans_id = chunk
+    if ctx['backend'] == 'cosine':
+        # Candidates are the library spectra within parent_mz_tol of the query precursor m/z
+        idx_row, idx_col = query_precursor_index(ctx['precursor_index'], query_precursor_mz, ctx['parent_mz_tol'])
+    else:
+        # Candidates are the library spectra sharing enough fragments with the query to pass min_cos and min_peaks
+        idx_row, idx_col = search_fragment_index(ctx['fragment_index'], query_mz, query_intensities, query_offsets,
+            query_precursor_mz, ctx['msms_mz_tol'], ctx['min_cos'], ctx['min_peaks'],
+            parent_mz_tol=None if ctx['analog_search'] else ctx['parent_mz_tol'])
+    # Pairs that cannot have more than min_peaks matched peaks are not scored
+    possible = matched_peaks_upper_bound(query_mz, query_offsets, db_clean['mz'], db_clean['offsets'],
+        idx_row, idx_col, ctx['msms_mz_tol']) > ctx['min_peaks']
+    idx_row, idx_col = idx_row[possible], idx_col[possible]
+    if ctx['prescreen_threshold'] is not None:
+        query_vectors = binned_vectors(query_mz, query_intensities, query_offsets, ctx['msms_mz_tol'], spread=True)
+        # Small margin so that rounding cannot discard a pair at the threshold
+        passing = prescreen_pairs(query_vectors, ctx['library_vectors'], idx_row, idx_col) > ctx['prescreen_threshold'] - 1e-9
+        idx_row, idx_col = idx_row[passing], idx_col[passing]
+    # All candidate pairs of the chunk are scored in one compiled call
+    msms_scores, n_matches = cosine_greedy_pairs(query_mz, query_intensities, query_offsets,
+        db_clean['mz'], db_clean['intensities'], db_clean['offsets'], idx_row, idx_col, ctx['msms_mz_tol'])
+    keep = (msms_scores > ctx['min_cos']) & (n_matches > ctx['min_peaks'])
+    if keep.any():
+        df = pd.DataFrame({'msms_score': msms_scores[keep],
+                            'matched_peaks': n_matches[keep],
+                            'feature_id': scans_id[idx_row[keep]],
+                            'reference_id': idx_col[keep] + 1 if ctx['reference_ids'] is None else ctx['reference_ids'][idx_col[keep]],
+                            'short_inchikey': db_clean['short_inchikey'][idx_col[keep]]})
+        if ctx['structure_ids'] is not None:
+            # Only the best hit of each structure is reported for each query
+            df['structure_id'] = ctx['structure_ids'][idx_col[keep]]
+            best = df.sort_values(['feature_id', 'structure_id', 'msms_score', 'reference_id'],
+                                  ascending=[True, True, False, True], kind='stable').drop_duplicates(['feature_id', 'structure_id'])
+            df = df.loc[best.index.sort_values()].drop(columns='structure_id').reset_index(drop=True)
+        if ctx['top_k'] is not None:
+            df = df.sort_values(['feature_id', 'msms_score', 'reference_id'], ascending=[True, False, True], kind='stable')
+            df = df.groupby('feature_id', sort=False).head(ctx['top_k']).reset_index(drop=True)
+        return df
+    return pd.DataFrame()
+
+
+def _retain_top_k(heaps, df, top_k):
+    """Push hits into per feature_id heaps keeping only the top_k best scores
+
+    Args:
+        heaps (dict): feature_id to min-heap of (msms_score, -reference_id, hit), updated in place
+        df (DataFrame): Hits to add
+        top_k (int): Number of hits to keep per feature_id
+    """
+
+    for hit in df.itertuples(index=False):
+        entry = (hit.msms_score, -hit.reference_id, tuple(hit))
+        heap = heaps.setdefault(hit.feature_id, [])
+        if len(heap) < top_k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+
 def spectral_matching(spectrums_query, db_clean, parent_mz_tol,
-        msms_mz_tol, min_cos, min_peaks, output_file_path):
+        msms_mz_tol, min_cos, min_peaks, output_file_path, precursor_index=None,
+        backend='cosine', fragment_index=None, analog_search=False,
+        prescreen_threshold=None, library_vectors=None, n_jobs=1, top_k=None, query_groups=None,
+        collapse_structures=False, structure_ids=None, reference_ids=None, table_format='tsv', chunk_size=1000):
     """Performs spectra matching between query spectra and a database usinge cosine score
 
+    Candidate pairs are selected either on the precursor m/z (backend='cosine') or with the fragment ion \
+        inverted index of the library (backend='fragment_index'), and are then scored with the greedy cosine.
+
     Args:
-        spectrums_query (list): List of matchms spectra objects to query
-        db_clean (list): List of reference matchms spectra objects 
+        spectrums_query (list or dict): List of matchms spectra objects to query, or their array representation \
+            (output of query_spectrum_arrays())
+        db_clean (list or dict): List of reference matchms spectra objects, or their array representation \
+            (output of spectral_db_to_arrays())
         parent_mz_tol (float): Precursor m/z tolerance in Da for matching
         msms_mz_tol (float): m/z tolerance in Da for matching fragments
         min_cos (float): minimal cosine score
         min_peaks (int): minimum number of matching fragments
         output_file_path (str): path to write results
+        precursor_index (tuple, optional): Precursor m/z index of db_clean (output of build_precursor_index()). \
+            Built on the fly if not given, pass it when matching several samples against the same library.
+        backend (str, optional): 'cosine' or 'fragment_index'. Defaults to 'cosine'.
+        fragment_index (dict, optional): Fragment index of db_clean (output of build_fragment_index()). \
+            Built on the fly if not given and backend is 'fragment_index'.
+        analog_search (bool, optional): With backend='fragment_index', search all library spectra \
+            whatever their precursor m/z. Defaults to False.
+        prescreen_threshold (float, optional): If given, candidate pairs are first scored on binned spectra \
+            and only pairs above this threshold are scored with the greedy cosine. The binned score is an upper \
+            bound of the cosine, so a threshold <= min_cos does not change the results. Defaults to None (no prescreen).
+        library_vectors (scipy.sparse.csr_matrix, optional): Binned db_clean spectra for the prescreen \
+            (output of binned_vectors() with bin_width=msms_mz_tol). Built on the fly if not given.
+        n_jobs (int, optional): Number of processes matching query chunks concurrently. The workers are forked \
+            and share the library, results are written in the chunks order. Defaults to 1.
+        top_k (int, optional): Number of best hits to keep per feature_id, the results are then written once \
+            matching is done. Defaults to None (all hits are kept).
+        query_groups (DataFrame, optional): Groups of near-identical query spectra (output of group_query_spectra()). \
+            Only their representatives are matched and the hits are copied to the other spectra of the group. \
+            Defaults to None (all query spectra are matched).
+        collapse_structures (bool, optional): Report only the best hit of each structure (short InChIKey) \
+            for each query, instead of one hit per reference spectrum. Defaults to False.
+        structure_ids (np.ndarray, optional): Structure number of the db_clean spectra for collapse_structures \
+            (output of spectral_db_structure_ids()). Built on the fly if not given.
+        reference_ids (np.ndarray, optional): reference_id reported for the db_clean spectra, when db_clean is \
+            a part of a larger library (see library_shards.py). Defaults to None (position in db_clean, from 1).
+        table_format (str, optional): Write the results in 'tsv', 'parquet' (same path with the .parquet extension) \
+            or 'both'. Defaults to 'tsv'.
+        chunk_size (int, optional): Number of query spectra matched together (and per worker task). Defaults to 1000.
     """    
         
-    if os.path.exists(output_file_path):
-        os.remove(output_file_path)
-
-    spectrums_query = [peak_processing(s) for s in spectrums_query]
-
-    similarity_score = PrecursorMzMatch(tolerance=float(parent_mz_tol), tolerance_type="Dalton")
-    chunks_query = [spectrums_query[x:x+1000] for x in range(0, len(spectrums_query), 1000)]
-
-    for chunk in chunks_query:
-        scores = calculate_scores(chunk, db_clean, similarity_score)
-        # indices = np.where(np.asarray(scores.scores))
-        # idx_row, idx_col = indices
-        # This modification is to handle the Sparse array format (introduced in matchms https://github.com/matchms/matchms/pull/370)
-        idx_row = scores.scores[:,:][0]
-        idx_col = scores.scores[:,:][1]
-        scans_id_map = {}
-        i = 0
-        for s in chunk:
-            scans_id_map[i] = int(s.metadata['scans'])
-            i += 1
-        cosinegreedy = CosineGreedy(tolerance=float(msms_mz_tol))
-        data = []
-        for (x,y) in tzip(idx_row,idx_col):
-            if x<y:
-                msms_score, n_matches = cosinegreedy.pair(chunk[x], db_clean[y])[()]
-                if (msms_score>float(min_cos)) & (n_matches>int(min_peaks)):
-                    feature_id = scans_id_map[x]
-                    data.append({'msms_score':msms_score,
-                                'matched_peaks':n_matches,
-                                'feature_id': feature_id,
-                                'reference_id':y + 1,
-                                'short_inchikey': db_clean[y].get("compound_name")})
-        df = pd.DataFrame(data)
-        os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
-        df.to_csv(output_file_path, mode='a', header=not os.path.exists(output_file_path), sep = '\t')
+    for path in [output_file_path, parquet_path(output_file_path)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    if not isinstance(spectrums_query, dict):
+        spectrums_query = spectra_to_query_arrays(spectrums_query)
+    if query_groups is not None:
+        spectrums_query = representative_spectra(spectrums_query, query_groups)
+    # The query spectra are processed all at once on their peak arrays, with the filters of peak_processing()
+    query_mz, query_intensities, query_offsets, kept = preprocess_peak_arrays(spectrums_query['mz'], spectrums_query['intensities'],
+                                                                              spectrums_query['offsets'])
+    query_precursor_mz = spectrums_query['precursor_mz'][kept]
+    scans_id = spectrums_query['scans'][kept]
+
+    if not isinstance(db_clean, dict):
+        db_clean = spectral_db_to_arrays(db_clean)
+    if backend == 'cosine':
+        if precursor_index is None:
+            precursor_index = build_precursor_index(db_clean['precursor_mz'])
+    elif backend == 'fragment_index':
+        if fragment_index is None:
+            fragment_index = build_fragment_index(db_clean)
+    else:
+        raise ValueError('backend parameter must be cosine or fragment_index')
+    if prescreen_threshold is not None and library_vectors is None:
+        library_vectors = binned_vectors(db_clean['mz'], db_clean['intensities'], db_clean['offsets'], float(msms_mz_tol))
+    if collapse_structures and structure_ids is None:
+        structure_ids = spectral_db_structure_ids(db_clean)
+    chunk_size = int(chunk_size)
+    chunks_query = []
+    for x in range(0, len(scans_id), chunk_size):
+        start, end = query_offsets[x], query_offsets[min(x + chunk_size, len(scans_id))]
+        chunks_query.append((query_mz[start:end], query_intensities[start:end], query_offsets[x:x + chunk_size + 1] - start,
+                             query_precursor_mz[x:x + chunk_size], scans_id[x:x + chunk_size]))
 
+    _matching_context.update({'db_clean': db_clean, 'precursor_index': precursor_index, 'fragment_index': fragment_index,
+        'library_vectors': library_vectors, 'structure_ids': structure_ids if collapse_structures else None, 'reference_ids': reference_ids, 'backend': backend, 'analog_search': analog_search,
+        'parent_mz_tol': float(parent_mz_tol), 'msms_mz_tol': float(msms_mz_tol), 'min_cos': float(min_cos),
+        'min_peaks': int(min_peaks), 'top_k': None if top_k is None else int(top_k), 'prescreen_threshold': None if prescreen_threshold is None else float(prescreen_threshold)})
 
+    if int(n_jobs) > 1 and len(chunks_query) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        # Forked workers inherit _matching_context: the library is shared, not pickled
+        executor = ProcessPoolExecutor(max_workers=min(int(n_jobs), len(chunks_query)),
+                                       mp_context=multiprocessing.get_context('fork'))
+        results = executor.map(_match_chunk, chunks_query)
+    else:
+        executor = None
+        results = map(_match_chunk, chunks_query)
 
+    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+    heaps = {}
+    hits = []
+    columns = ['msms_score', 'matched_peaks', 'feature_id', 'reference_id', 'short_inchikey']
+    try:
+        for df in tqdm(results, total=len(chunks_query)):
+            if top_k is None:
+                if query_groups is not None:
+                    df = fan_out_hits(df, query_groups)
+                if table_format == 'tsv':
+                    df.to_csv(output_file_path, mode='a', header=not os.path.exists(output_file_path), sep = '\t')
+                elif len(df):
+                    # Parquet files are written at once
+                    hits.append(df)
+            else:
+                _retain_top_k(heaps, df, int(top_k))
+        if top_k is not None:
+            data = [entry[2] for heap in heaps.values() for entry in sorted(heap, reverse=True)]
+            df = pd.DataFrame(data, columns=columns) if data else pd.DataFrame()
+            if query_groups is not None:
+                df = fan_out_hits(df, query_groups)
+            write_table(df, output_file_path, table_format)
+        elif table_format != 'tsv':
+            write_table(pd.concat(hits) if hits else pd.DataFrame(), output_file_path, table_format)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        _matching_context.clear()
@@ -0,0 +1,153 @@
+import numba
+import numpy as np
+
+
+def spectrum_features(mz, intensities, offsets, precursor_mz, bin_width, n_peaks):
+    """Binned fragments and neutral losses of the strongest peaks of each spectrum, as sets of integer features
+
+    Each fragment m/z and neutral loss (precursor m/z - fragment m/z) is binned on two grids shifted by half \
+        a bin, so that two values less than bin_width / 2 apart always share a feature.
+
+    Args:
+        mz, intensities, offsets (np.ndarray): Peak arrays of the spectra (see similarity_kernels.spectra_to_peak_arrays())
+        precursor_mz (np.ndarray): Precursor m/z of each spectrum
+        bin_width (float): Width of the bins in Da
+        n_peaks (int): Number of peaks of each spectrum, by decreasing intensity, whose features are kept
+
+    Returns:
+        tuple: Features (np.ndarray) and their offsets (np.ndarray): the features of spectrum i are \
+            features[feature_offsets[i]:feature_offsets[i + 1]]
+    """
+
+    n_spectra = len(offsets) - 1
+    spectrum = np.repeat(np.arange(n_spectra, dtype=np.int64), np.diff(offsets))
+    # Rank of each peak by decreasing intensity within its spectrum
+    order = np.lexsort((-intensities, spectrum))
+    rank = np.empty(len(mz), dtype=np.int64)
+    rank[order] = np.arange(len(mz)) - offsets[spectrum[order]]
+    strongest = rank < n_peaks
+    spectrum, values = spectrum[strongest], mz[strongest]
+    losses = precursor_mz[spectrum] - values
+
+    features = []
+    for kind, value in enumerate([values, losses]):
+        for grid in range(2):
+            bins = np.floor(value / bin_width + grid / 2).astype(np.int64)
+            features.append((spectrum, bins * 4 + kind * 2 + grid))
+    spectrum = np.concatenate([f[0] for f in features])
+    features = np.concatenate([f[1] for f in features])
+    order = np.argsort(spectrum, kind='stable')
+    feature_offsets = np.zeros(n_spectra + 1, dtype=np.int64)
+    np.cumsum(np.bincount(spectrum, minlength=n_spectra), out=feature_offsets[1:])
+    return features[order], feature_offsets
+
+
+@numba.njit(nogil=True)
+def _mix(x):
+    """splitmix64 finalizer, a cheap hash of 64-bit integers"""
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94d049bb133111eb)
+    x ^= x >> np.uint64(31)
+    return x
+
+
+@numba.njit(nogil=True)
+def minhash_band_keys(features, feature_offsets, n_bands, n_rows, seed):
+    """MinHash signatures of the feature sets, combined into one key per band of n_rows hash functions
+
+    Two sets with Jaccard similarity J get the same key in a band with probability J ** n_rows.
+
+    Returns:
+        np.ndarray: (n_spectra, n_bands) keys, -1 for spectra without features
+    """
+
+    n_spectra = feature_offsets.shape[0] - 1
+    keys = np.full((n_spectra, n_bands), -1, dtype=np.int64)
+    for s in range(n_spectra):
+        start, end = feature_offsets[s], feature_offsets[s + 1]
+        if start == end:
+            continue
+        for band in range(n_bands):
+            key = np.uint64(band)
+            for row in range(n_rows):
+                salt = _mix(np.uint64(seed) * np.uint64(1000003) + np.uint64(band * n_rows + row + 1))
+                lowest = np.uint64(0xffffffffffffffff)
+                for k in range(start, end):
+                    value = _mix(np.uint64(features[k]) ^ salt)
+                    if value < lowest:
+                        lowest = value
+                key = _mix(key ^ lowest)
+            # Non-negative, so that -1 stays free for spectra without features
+            keys[s, band] = np.int64(key >> np.uint64(1))
+    return keys
+
+
+@numba.njit(nogil=True)
+def _bucket_pairs(order, sorted_keys, max_bucket_size, count_only, idx_1, idx_2):
+    """Enumerate (or count) the pairs of spectra sharing a key, within groups of at most max_bucket_size spectra"""
+    n_pairs = 0
+    start = 0
+    n = order.shape[0]
+    while start < n:
+        end = start + 1
+        while end < n and sorted_keys[end] == sorted_keys[start]:
+            end += 1
+        if sorted_keys[start] >= 0:
+            for chunk_start in range(start, end, max_bucket_size):
+                chunk_end = min(chunk_start + max_bucket_size, end)
+                for a in range(chunk_start, chunk_end):
+                    for b in range(a + 1, chunk_end):
+                        if not count_only:
+                            idx_1[n_pairs] = min(order[a], order[b])
+                            idx_2[n_pairs] = max(order[a], order[b])
+                        n_pairs += 1
+        start = end
+    return n_pairs
+
+
+def lsh_candidate_pairs(mz, intensities, offsets, precursor_mz, n_bands=128, n_rows=2, bin_width=0.1, n_peaks=10,
+                        max_bucket_size=100, seed=0):
+    """Candidate pairs of similar spectra, by locality-sensitive hashing (MinHash) of their strongest peaks
+
+    Spectra are described by the binned fragments and neutral losses of their strongest peaks (see spectrum_features()). \
+        Two spectra are a candidate pair when their MinHash keys collide in at least one band, which happens with \
+        probability 1 - (1 - J ** n_rows) ** n_bands for feature sets of Jaccard similarity J. Pairs of spectra \
+        sharing none of these features are never candidates, so the candidates are approximate.
+
+    Args:
+        mz, intensities, offsets (np.ndarray): Peak arrays of the spectra (see similarity_kernels.spectra_to_peak_arrays())
+        precursor_mz (np.ndarray): Precursor m/z of each spectrum
+        n_bands (int, optional): Number of bands (hash tables). More bands find more pairs. Defaults to 128.
+        n_rows (int, optional): Number of hash functions per band. More rows give fewer, more similar pairs. Defaults to 2.
+        bin_width (float, optional): Width of the fragment and neutral loss bins in Da. Defaults to 0.1.
+        n_peaks (int, optional): Number of peaks of each spectrum, by decreasing intensity, that are hashed. Defaults to 10.
+        max_bucket_size (int, optional): Spectra sharing a key are paired by groups of at most this size, so that \
+            a few very common keys do not produce most of the pairs. Defaults to 100.
+        seed (int, optional): Seed of the hash functions. Defaults to 0.
+
+    Returns:
+        tuple: Indices of the first (np.ndarray) and second (np.ndarray) spectrum of each candidate pair, first < second
+    """
+
+    n_spectra = len(offsets) - 1
+    features, feature_offsets = spectrum_features(np.asarray(mz, dtype=np.float64), np.asarray(intensities, dtype=np.float64),
+                                                  np.asarray(offsets, dtype=np.int64), np.asarray(precursor_mz, dtype=np.float64),
+                                                  float(bin_width), int(n_peaks))
+    keys = minhash_band_keys(features, feature_offsets, int(n_bands), int(n_rows), int(seed))
+    pairs = np.zeros(0, dtype=np.int64)
+    band_pairs = []
+    for band in range(int(n_bands)):
+        order = np.argsort(keys[:, band], kind='stable')
+        sorted_keys = keys[order, band]
+        empty = np.zeros(0, dtype=np.int64)
+        n_pairs = _bucket_pairs(order, sorted_keys, int(max_bucket_size), True, empty, empty)
+        idx_1, idx_2 = np.empty(n_pairs, dtype=np.int64), np.empty(n_pairs, dtype=np.int64)
+        _bucket_pairs(order, sorted_keys, int(max_bucket_size), False, idx_1, idx_2)
+        band_pairs.append(idx_1 * n_spectra + idx_2)
+        # Pairs found in several bands are kept once
+        if len(band_pairs) == 16 or band == int(n_bands) - 1:
+            pairs = np.unique(np.concatenate([pairs] + band_pairs))
+            band_pairs = []
+    return pairs // max(n_spectra, 1), pairs % max(n_spectra, 1)
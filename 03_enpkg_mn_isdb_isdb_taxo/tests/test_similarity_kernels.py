@@ -0,0 +1,77 @@
+"""Test module checking the numba scoring kernels against matchms."""
+import os
+import sys
+
+import numpy as np
+from matchms import Spectrum
+from matchms.similarity import CosineGreedy, ModifiedCosine
+from matchms.similarity.spectrum_similarity_functions import collect_peak_pairs, score_best_matches
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from similarity_kernels import cosine_greedy_pairs, modified_cosine_pairs, spectra_to_peak_arrays  # noqa: E402
+
+
+def random_spectra(rng, n_spectra, intensity_levels=None):
+    """Random spectra on a narrow m/z range, so that peaks often compete for the same partner."""
+    spectra = []
+    for _ in range(n_spectra):
+        mz = np.unique(np.round(rng.uniform(50, 120, rng.integers(5, 60)), 1))
+        if intensity_levels is None:
+            intensities = rng.uniform(0.01, 1, len(mz))
+        else:
+            intensities = rng.integers(1, intensity_levels + 1, len(mz)) / intensity_levels
+        spectra.append(Spectrum(mz=mz, intensities=intensities,
+                                metadata={'precursor_mz': float(mz[-1] + rng.uniform(0, 30))}))
+    return spectra
+
+
+def score_pairs(spectra_1, spectra_2, tolerance):
+    mz_1, intensities_1, offsets_1 = spectra_to_peak_arrays(spectra_1)
+    mz_2, intensities_2, offsets_2 = spectra_to_peak_arrays(spectra_2)
+    idx = np.arange(len(spectra_1))
+    return cosine_greedy_pairs(mz_1, intensities_1, offsets_1, mz_2, intensities_2, offsets_2, idx, idx, tolerance)
+
+
+def test_cosine_greedy_pairs_matches_matchms():
+    """Without tied intensity products, scores and matched peaks are those of CosineGreedy."""
+    rng = np.random.default_rng(0)
+    spectra_1, spectra_2 = random_spectra(rng, 300), random_spectra(rng, 300)
+    scores, matches = score_pairs(spectra_1, spectra_2, 0.3)
+    cosine_greedy = CosineGreedy(tolerance=0.3)
+    for spectrum_1, spectrum_2, score, n_matches in zip(spectra_1, spectra_2, scores, matches):
+        expected = cosine_greedy.pair(spectrum_1, spectrum_2)
+        assert abs(float(expected['score']) - score) < 1e-12
+        assert int(expected['matches']) == n_matches
+
+
+def test_cosine_greedy_pairs_tied_intensities():
+    """Tied intensity products are assigned in the order matchms collects the peak pairs."""
+    rng = np.random.default_rng(1)
+    spectra_1, spectra_2 = random_spectra(rng, 1000, 3), random_spectra(rng, 1000, 3)
+    scores, matches = score_pairs(spectra_1, spectra_2, 0.3)
+    for spectrum_1, spectrum_2, score, n_matches in zip(spectra_1, spectra_2, scores, matches):
+        peaks_1, peaks_2 = spectrum_1.peaks.to_numpy, spectrum_2.peaks.to_numpy
+        pairs = collect_peak_pairs(peaks_1, peaks_2, 0.3)
+        if pairs is None:
+            assert score == 0 and n_matches == 0
+            continue
+        pairs = pairs[np.argsort(-pairs[:, 2], kind='stable')]
+        expected_score, expected_matches = score_best_matches(pairs, peaks_1, peaks_2)
+        assert abs(expected_score - score) < 1e-12
+        assert expected_matches == n_matches
+
+
+def test_modified_cosine_pairs_matches_matchms():
+    """Without tied intensity products, scores are those of ModifiedCosine (the lower index is the reference)."""
+    rng = np.random.default_rng(2)
+    spectra = random_spectra(rng, 200)
+    mz, intensities, offsets = spectra_to_peak_arrays(spectra)
+    precursor_mz = np.array([s.get('precursor_mz') for s in spectra], dtype=np.float64)
+    norms = np.sqrt(np.add.reduceat(intensities ** 2, offsets[:-1]))
+    idx_1, idx_2 = np.triu_indices(len(spectra), 1)
+    idx_1, idx_2 = idx_1[:2000], idx_2[:2000]
+    scores = modified_cosine_pairs(mz, intensities, offsets, precursor_mz, norms, idx_1, idx_2, 0.3, 0.0)
+    modified_cosine = ModifiedCosine(tolerance=0.3)
+    for i, j, score in zip(idx_1, idx_2, scores):
+        assert abs(float(modified_cosine.pair(spectra[i], spectra[j])['score']) - score) < 1e-12
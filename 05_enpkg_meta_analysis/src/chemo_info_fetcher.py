@@ -5,6 +5,7 @@ import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import os
+import sys
 from json import JSONDecodeError
 from tqdm import tqdm
 import sqlite3
@@ -15,6 +16,8 @@ import textwrap
 from pathlib import Path
 from rdkit.Chem import AllChem
 import yaml
+sys.path.append(os.path.join(Path(__file__).parents[2], 'src'))
+from table_io import read_table
 
 p = Path(__file__).parents[1]
 os.chdir(p)
@@ -174,15 +177,13 @@ for directory in tqdm(samples_dir):
     isdb_annotations_pos = None
     isdb_annotations_neg = None
     try:
-        isdb_annotations_pos = pd.read_csv(isdb_path_pos, sep='\t')\
-            [['short_inchikey','structure_smiles_2D', 'structure_taxonomy_npclassifier_01pathway', 'structure_taxonomy_npclassifier_02superclass', 'structure_taxonomy_npclassifier_03class']]
+        isdb_annotations_pos = read_table(isdb_path_pos, columns=['short_inchikey','structure_smiles_2D', 'structure_taxonomy_npclassifier_01pathway', 'structure_taxonomy_npclassifier_02superclass', 'structure_taxonomy_npclassifier_03class'])
     except FileNotFoundError:
         pass
     except NotADirectoryError:
         pass
     try:
-        isdb_annotations_neg = pd.read_csv(isdb_path_neg, sep='\t')\
-            [['short_inchikey','structure_smiles_2D', 'structure_taxonomy_npclassifier_01pathway', 'structure_taxonomy_npclassifier_02superclass', 'structure_taxonomy_npclassifier_03class']] 
+        isdb_annotations_neg = read_table(isdb_path_neg, columns=['short_inchikey','structure_smiles_2D', 'structure_taxonomy_npclassifier_01pathway', 'structure_taxonomy_npclassifier_02superclass', 'structure_taxonomy_npclassifier_03class'])
     except FileNotFoundError:
         pass
     except NotADirectoryError:
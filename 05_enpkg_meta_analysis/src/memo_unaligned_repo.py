@@ -1,5 +1,5 @@
-import memo_ms as memo
 import os
+import sys
 import argparse
 import datatable as dt
 import pandas as pd
@@ -7,6 +7,16 @@ import numpy as np
 import textwrap
 from pathlib import Path
 import yaml
+from collections import Counter
+from tqdm import tqdm
+from spec2vec import SpectrumDocument
+from matchms.filtering import add_precursor_mz
+from matchms.filtering import add_losses
+from matchms.filtering import normalize_intensities
+from matchms.filtering import require_minimum_number_of_peaks
+from matchms.filtering import select_by_relative_intensity
+sys.path.append(os.path.join(Path(__file__).parents[2], 'src'))
+from spectrum_cache import read_cached_mgf
 
 
 p = Path(__file__).parents[1]
@@ -36,6 +46,43 @@ word_max_occ_blanks = params_list_full['memo']['word_max_occ_blanks']
 output = os.path.normpath(params_list_full['memo']['output'])
 output_path = os.path.normpath(params_list_full['memo']['output_path'])
 
+
+def memo_from_unaligned_samples(path_to_samples_dir, pattern_to_match, min_relative_intensity, max_relative_intensity,
+                                min_peaks_required, losses_from, losses_to, n_decimals):
+    """Generate a MEMO matrix from individual .mgf files, as memo_ms.MemoMatrix().memo_from_unaligned_samples()
+
+    The spectra are read through the binary cache of each .mgf (see spectrum_cache.py), shared with the other stages. \
+        The filters and word counts mirror memo_from_unaligned_samples() and load_and_filter_from_mgf() of memo_ms 0.1.4 \
+        (the version locked in uv.lock): update this copy when memo_ms is upgraded.
+
+    Returns:
+        DataFrame: The MEMO matrix (samples x peak/loss words counts)
+    """
+
+    def apply_filters(spectrum):
+        spectrum = add_precursor_mz(spectrum)
+        spectrum = normalize_intensities(spectrum)
+        spectrum = select_by_relative_intensity(spectrum, intensity_from=min_relative_intensity,
+                                                intensity_to=max_relative_intensity)
+        spectrum = add_precursor_mz(spectrum)
+        spectrum = add_losses(spectrum, loss_mz_from=losses_from, loss_mz_to=losses_to)
+        spectrum = require_minimum_number_of_peaks(spectrum, n_required=min_peaks_required)
+        return spectrum
+
+    mgf_files = []
+    for (root, _, files) in os.walk(path_to_samples_dir, topdown=True):
+        for file in files:
+            if file.endswith(pattern_to_match):
+                mgf_files.append((os.path.join(root, file), file))
+
+    dic_memo = {}
+    for path, file in tqdm(mgf_files):
+        spectra = [apply_filters(s.to_matchms()) for s in read_cached_mgf(path)]
+        documents = [SpectrumDocument(s, n_decimals=n_decimals) for s in spectra if s is not None]
+        dic_memo[file.replace(pattern_to_match, '')] = dict(Counter(word for doc in documents for word in doc.words))
+    return pd.DataFrame.from_dict(dic_memo, orient='index').fillna(0)
+
+
 pattern_to_match2 = None
 if ionization == 'pos':
     pattern_to_match1 = '_features_ms2_pos.mgf'
@@ -59,11 +106,8 @@ for (root, _, files) in os.walk(sample_dir_path, topdown=True):
 
 print(f"Generating MEMO matrix from {i} input files.") 
             
-memo_unaligned = memo.MemoMatrix()
-memo_unaligned.memo_from_unaligned_samples(path_to_samples_dir=sample_dir_path, pattern_to_match=pattern_to_match1,
-                                            min_relative_intensity=min_relative_intensity, max_relative_intensity=max_relative_intensity, min_peaks_required=min_peaks_required, 
-                                            losses_from=losses_from, losses_to=losses_to, n_decimals=n_decimals)    
-table = memo_unaligned.memo_matrix
+table = memo_from_unaligned_samples(sample_dir_path, pattern_to_match1, min_relative_intensity, max_relative_intensity,
+                                    min_peaks_required, losses_from, losses_to, n_decimals)
 if filter_blanks:
     samples_dir = [directory for directory in os.listdir(sample_dir_path)]
     blanks = []
@@ -103,11 +147,8 @@ if pattern_to_match2 is not None:
             if file.endswith(pattern_to_match2):
                 i += 1
     print(f"Generating MEMO matrix from {i} input files.")                 
-    memo_unaligned = memo.MemoMatrix()
-    memo_unaligned.memo_from_unaligned_samples(path_to_samples_dir=sample_dir_path, pattern_to_match=pattern_to_match2,
-                                                min_relative_intensity=min_relative_intensity, max_relative_intensity=max_relative_intensity, min_peaks_required=min_peaks_required, 
-                                                losses_from=losses_from, losses_to=losses_to, n_decimals=n_decimals)    
-    table = memo_unaligned.memo_matrix
+    table = memo_from_unaligned_samples(sample_dir_path, pattern_to_match2, min_relative_intensity, max_relative_intensity,
+                                        min_peaks_required, losses_from, losses_to, n_decimals)
     if filter_blanks:
         samples_dir = [directory for directory in os.listdir(sample_dir_path)]
         blanks = []
@@ -1,11 +1,13 @@
 import pandas as pd
 import os
-from matchms.importing import load_from_mgf
-from matchms.exporting import save_as_mgf
+import sys
 from tqdm import tqdm
 import argparse
 import textwrap
 from pathlib import Path
+sys.path.append(os.path.join(Path(__file__).parents[2], 'src'))
+from mgf_reader import write_mgf_spectrum
+from spectrum_cache import read_cached_mgf
 
 p = Path(__file__).parents[2]
 os.chdir(p)
@@ -37,49 +39,49 @@ output_name = args.output_name
 
 path = os.path.normpath(sample_dir_path)
 samples_dir = [directory for directory in os.listdir(path)]
-spectrums = []
+metadata_list = []
 i = 1
 j = 1
 
+os.makedirs(path + '/001_aggregated_spectra/' , exist_ok=True)
+spec_path = os.path.normpath(path + '/001_aggregated_spectra/' + output_name +'.mgf')
+param_path = os.path.normpath(path + '/001_aggregated_spectra/' + output_name +'_params.csv')
+
+# Spectra are written to the aggregated .mgf one sample at a time, read from the binary cache of each sample .mgf
 n_iter = len(samples_dir)
 treated_samples = []
-for sample_directory in tqdm(samples_dir):
-    if ionization == 'pos':
-        mgf_file_path = os.path.join(path, sample_directory, ionization, sample_directory + '_features_ms2_pos.mgf')
-    elif ionization == 'neg':
-        mgf_file_path = os.path.join(path, sample_directory, ionization, sample_directory + '_features_ms2_neg.mgf')
-    else:
-        raise ValueError('ionization must be pos or neg')
-    metadata_file_path = os.path.join(path, sample_directory, sample_directory + '_metadata.tsv')
-    try:
-        sample_spec = list(load_from_mgf(mgf_file_path))
-        metadata = pd.read_csv(metadata_file_path, sep='\t')
-    except FileNotFoundError:
-        continue
-    except NotADirectoryError:
-        continue
-    if metadata['sample_type'][0] == 'sample':
-        treated_samples.append(sample_directory)
-        for spectrum in sample_spec:
-            usi = 'mzspec:' + metadata['massive_id'][0] + ':' + metadata.sample_id[0] + '_features_ms2_'+ ionization + '.mgf:scan:' + str(spectrum.metadata['scans'])
-            original_feat_id = 'lcms_feature_' + usi 
-            #original_feat_id = sample_directory + '_feature_' + spectrum.metadata['scans'] + '_' + ionization
-            spectrum.set('original_feature_id', original_feat_id)
-            spectrum.set('feature_id', i)
-            spectrum.set('scans', i)
-            i += 1
-        spectrums = spectrums + sample_spec
+with open(spec_path, 'w', encoding='utf-8') as spec_file:
+    for sample_directory in tqdm(samples_dir):
+        if ionization == 'pos':
+            mgf_file_path = os.path.join(path, sample_directory, ionization, sample_directory + '_features_ms2_pos.mgf')
+        elif ionization == 'neg':
+            mgf_file_path = os.path.join(path, sample_directory, ionization, sample_directory + '_features_ms2_neg.mgf')
+        else:
+            raise ValueError('ionization must be pos or neg')
+        metadata_file_path = os.path.join(path, sample_directory, sample_directory + '_metadata.tsv')
+        try:
+            metadata = pd.read_csv(metadata_file_path, sep='\t')
+        except FileNotFoundError:
+            continue
+        except NotADirectoryError:
+            continue
+        if not os.path.isfile(mgf_file_path):
+            continue
+        if metadata['sample_type'][0] == 'sample':
+            treated_samples.append(sample_directory)
+            for spectrum in read_cached_mgf(mgf_file_path):
+                spectrum_metadata = spectrum.matchms_metadata()
+                usi = 'mzspec:' + metadata['massive_id'][0] + ':' + metadata.sample_id[0] + '_features_ms2_'+ ionization + '.mgf:scan:' + str(spectrum_metadata['scans'])
+                original_feat_id = 'lcms_feature_' + usi 
+                #original_feat_id = sample_directory + '_feature_' + spectrum.metadata['scans'] + '_' + ionization
+                spectrum_metadata['original_feature_id'] = original_feat_id
+                spectrum_metadata['feature_id'] = i
+                spectrum_metadata['scans'] = i
+                i += 1
+                write_mgf_spectrum(spec_file, spectrum_metadata, spectrum)
+                metadata_list.append(spectrum_metadata)
 
-metadata_df = pd.DataFrame(s.metadata for s in spectrums)
-
-os.makedirs(path + '/001_aggregated_spectra/' , exist_ok=True)
+metadata_df = pd.DataFrame(metadata_list)
 metadata_df.to_csv(path + '/001_aggregated_spectra/' + output_name + '_metadata.csv', index=False)
 
-spec_path = os.path.normpath(path + '/001_aggregated_spectra/' + output_name +'.mgf')
-param_path = os.path.normpath(path + '/001_aggregated_spectra/' + output_name +'_params.csv')
-if os.path.isfile(spec_path):
-    os.remove(spec_path)   
-    save_as_mgf(spectrums, spec_path)
-else:
-    save_as_mgf(spectrums, spec_path)
 pd.DataFrame(treated_samples, columns=['treated_samples']).to_csv(param_path, index=False)
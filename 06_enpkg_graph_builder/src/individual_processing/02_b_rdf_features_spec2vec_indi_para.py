@@ -8,16 +8,17 @@ import rdflib
 from rdflib import Graph
 from rdflib.namespace import RDF, RDFS, XSD
 from tqdm import tqdm
-from matchms.importing import load_from_mgf
 from matchms.filtering import add_precursor_mz
 from matchms.filtering import add_losses
 from matchms.filtering import normalize_intensities
 from matchms.filtering import reduce_to_number_of_peaks
 from pathlib import Path
 from spec2vec import SpectrumDocument
+import sys
+sys.path.append(os.path.join(Path(__file__).parents[3], 'src'))
+from spectrum_cache import read_cached_mgf
 import yaml
 import git
-import sys
 
 p = Path(__file__).parents[2]
 os.chdir(p)
@@ -58,7 +59,7 @@ def load_and_filter_from_mgf(path) -> list:
         spectrum = add_losses(spectrum, loss_mz_from=10, loss_mz_to=250)
         return spectrum
 
-    spectra_list = [apply_filters(s) for s in load_from_mgf(path)]
+    spectra_list = [apply_filters(s.to_matchms()) for s in read_cached_mgf(path)]
     spectra_list = [s for s in spectra_list if s is not None]
     return spectra_list 
 
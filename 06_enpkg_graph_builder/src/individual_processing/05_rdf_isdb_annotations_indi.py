@@ -13,7 +13,9 @@ import git
 import yaml
 
 sys.path.append(os.path.join(Path(__file__).parents[1], 'functions'))
+sys.path.append(os.path.join(Path(__file__).parents[3], 'src'))
 from hash_functions import get_hash, get_data
+from table_io import read_table
 
 p = Path(__file__).parents[2]
 os.chdir(p)
@@ -60,7 +62,7 @@ for directory in tqdm(samples_dir):
     isdb_path = os.path.join(path, directory, ionization_mode, 'isdb', directory + '_isdb_reweighted_flat_' + ionization_mode + '.tsv')
     metadata_path = os.path.join(path, directory, directory + '_metadata.tsv')
     try:
-        isdb_annotations = pd.read_csv(isdb_path, sep='\t')
+        isdb_annotations = read_table(isdb_path, columns=['feature_id', 'short_inchikey', 'score_input', 'score_taxo', 'score_max_consistency', 'final_score', 'adduct'])
         metadata = pd.read_csv(metadata_path, sep='\t')
         isdb_annotations['adduct'] = isdb_annotations['adduct'].fillna('[M+H]+')
         isdb_annotations.replace({"adduct": adducts_dic},inplace=True)
@@ -15,7 +15,9 @@ from concurrent.futures import ProcessPoolExecutor
 import traceback
 
 sys.path.append(os.path.join(Path(__file__).parents[1], 'functions'))
+sys.path.append(os.path.join(Path(__file__).parents[3], 'src'))
 from hash_functions import get_hash, get_data
+from table_io import read_table
 
 p = Path(__file__).parents[2]
 os.chdir(p)
@@ -68,7 +70,7 @@ def process_directory(directory):
 
 
         try:
-            isdb_annotations = pd.read_csv(isdb_path, sep='\t')
+            isdb_annotations = read_table(isdb_path, columns=['feature_id', 'short_inchikey', 'score_input', 'score_taxo', 'score_max_consistency', 'final_score', 'adduct'])
             isdb_annotations['adduct'] = isdb_annotations['adduct'].fillna('[M+H]+')
             isdb_annotations.replace({"adduct": adducts_dic},inplace=True)
 
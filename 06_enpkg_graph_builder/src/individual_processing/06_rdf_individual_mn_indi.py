@@ -13,7 +13,9 @@ import git
 import yaml
 
 sys.path.append(os.path.join(Path(__file__).parents[1], 'functions'))
+sys.path.append(os.path.join(Path(__file__).parents[3], 'src'))
 from hash_functions import get_hash, get_data
+from table_io import read_table
 
 p = Path(__file__).parents[2]
 os.chdir(p)
@@ -58,7 +60,7 @@ for directory in tqdm(samples_dir):
     try:
         graph = nx.read_graphml(graph_path)
         metadata = pd.read_csv(metadata_path, sep='\t')
-        graph_metadata = pd.read_csv(graph_metadata_path, sep='\t')
+        graph_metadata = read_table(graph_metadata_path, columns=['feature_id', 'precursor_mz', 'component_id'])
     except FileNotFoundError:
         continue
     except NotADirectoryError:
@@ -15,7 +15,9 @@ from concurrent.futures import ProcessPoolExecutor
 import traceback
 
 sys.path.append(os.path.join(Path(__file__).parents[1], 'functions'))
+sys.path.append(os.path.join(Path(__file__).parents[3], 'src'))
 from hash_functions import get_hash, get_data
+from table_io import table_exists, read_table
 
 p = Path(__file__).parents[2]
 os.chdir(p)
@@ -66,12 +68,12 @@ def process_directory(directory):
     elif metadata.sample_type[0] == 'sample':
 
         try:
-            if not os.path.isfile(graph_path) or not os.path.isfile(metadata_path) or not os.path.isfile(graph_metadata_path):
+            if not os.path.isfile(graph_path) or not os.path.isfile(metadata_path) or not table_exists(graph_metadata_path):
                 print(f"Skipping {directory}, missing files.")
                 return f"Skipped {directory} due to missing files."
             
             graph = nx.read_graphml(graph_path)
-            graph_metadata = pd.read_csv(graph_metadata_path, sep='\t')
+            graph_metadata = read_table(graph_metadata_path, columns=['feature_id', 'precursor_mz', 'component_id'])
 
             for node in graph.edges(data=True):
                 s = node[0]
@@ -0,0 +1,152 @@
+import numpy as np
+
+COMMENT_CHARACTERS = ('#', ';', '!', '/')
+
+
+class MgfSpectrum:
+    """One spectrum of a .mgf file, whose peaks are only decoded when first accessed
+
+    Attributes:
+        metadata (dict): Parameters of the spectrum as read by matchms.importing.load_from_mgf() before harmonization: \
+            lowercase keys, string values except pepmass, a (mz, intensity) tuple of floats
+    """
+
+    __slots__ = ('metadata', '_peak_lines', '_mz', '_intensities')
+
+    def __init__(self, metadata, peak_lines=None, mz=None, intensities=None):
+        self.metadata = metadata
+        self._peak_lines = peak_lines
+        self._mz = mz
+        self._intensities = intensities
+
+    def get(self, key, default=None):
+        return self.metadata.get(key, default)
+
+    def _decode_peaks(self):
+        if self._peak_lines is None:
+            raise ValueError('Peaks were not read, use read_mgf(path, peaks=True)')
+        tokens = ' '.join(self._peak_lines).split()
+        if len(tokens) == 2 * len(self._peak_lines):
+            peaks = np.array(tokens, dtype=np.float64).reshape(-1, 2)
+        else:
+            # Peaks with a charge or an annotation column, or lines without intensity (skipped as by pyteomics)
+            peaks = np.array([line.split()[:2] for line in self._peak_lines if len(line.split()) > 1],
+                             dtype=np.float64).reshape(-1, 2)
+        mz, intensities = peaks[:, 0], peaks[:, 1]
+        if not np.all(mz[:-1] <= mz[1:]):
+            order = np.argsort(mz)
+            mz, intensities = mz[order], intensities[order]
+        self._mz, self._intensities = mz, intensities
+
+    @property
+    def mz(self):
+        if self._mz is None:
+            self._decode_peaks()
+        return self._mz
+
+    @property
+    def intensities(self):
+        if self._intensities is None:
+            self._decode_peaks()
+        return self._intensities
+
+    def matchms_metadata(self):
+        """Metadata harmonized as in a matchms spectrum, without decoding the peaks"""
+        from matchms.Metadata import Metadata
+        metadata = Metadata(dict(self.metadata))
+        metadata.harmonize_values()
+        return metadata.data
+
+    def to_matchms(self, metadata_harmonization=True):
+        """Convert to a matchms spectrum, as loaded by matchms.importing.load_from_mgf()"""
+        from matchms import Spectrum
+        return Spectrum(mz=self.mz, intensities=self.intensities, metadata=dict(self.metadata),
+                        metadata_harmonization=metadata_harmonization)
+
+
+def _parse_pepmass(value):
+    """Parse a PEPMASS value into a (mz, intensity) tuple and an optional charge, as pyteomics does"""
+    split = value.split()
+    if len(split) == 3:
+        return tuple(map(float, split[:2])), split[2]
+    pepmass = tuple(map(float, split[:2]))
+    return pepmass + (None,) * (2 - len(pepmass)), None
+
+
+def _finalize_metadata(metadata):
+    if 'pepmass' in metadata:
+        metadata['pepmass'], charge = _parse_pepmass(metadata['pepmass'])
+        if charge is not None:
+            metadata['charge'] = charge
+    return metadata
+
+
+def read_mgf(path, peaks=True):
+    """Stream the spectra of a .mgf file
+
+    The file is read line by line, so that memory stays bounded whatever its size. Parameters (SCANS, FEATURE_ID, \
+        PEPMASS...) are parsed when the spectrum is read, peaks are decoded into numpy arrays on first access \
+        of mz or intensities. Parameters written before the first spectrum apply to all spectra.
+
+    Args:
+        path (str): Path to the .mgf file
+        peaks (bool, optional): Keep the peak lines. Set to False when only the metadata are used \
+            (the peaks of the spectra are then not available). Defaults to True.
+
+    Yields:
+        MgfSpectrum: The spectra, in file order
+    """
+
+    header = {}
+    metadata = None
+    peak_lines = None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(COMMENT_CHARACTERS):
+                continue
+            if line == 'BEGIN IONS':
+                metadata = dict(header)
+                peak_lines = [] if peaks else None
+            elif line == 'END IONS':
+                if metadata is not None:
+                    yield MgfSpectrum(_finalize_metadata(metadata), peak_lines)
+                metadata = None
+            elif '=' in line:
+                key, value = line.split('=', 1)
+                (header if metadata is None else metadata)[key.lower()] = value.strip()
+            elif metadata is not None and peaks:
+                peak_lines.append(line)
+
+
+def load_spectra_from_mgf(path):
+    """Load the spectra of a .mgf file as matchms spectra, as list(matchms.importing.load_from_mgf(path)) does"""
+    return [spectrum.to_matchms() for spectrum in read_mgf(path)]
+
+
+def _format_value(value):
+    if isinstance(value, tuple):
+        return ' '.join(str(v) for v in value if v is not None)
+    return str(value)
+
+
+def write_mgf_spectrum(file, metadata, spectrum):
+    """Write a spectrum in an open .mgf file
+
+    Peaks that were not decoded are written as read, without parsing them.
+
+    Args:
+        file (file): File opened for writing
+        metadata (dict): Parameters of the spectrum, written as uppercase KEY=value lines
+        spectrum (MgfSpectrum): Spectrum whose peaks are written
+    """
+
+    file.write('BEGIN IONS\n')
+    for key, value in metadata.items():
+        if value is not None:
+            file.write(f'{key.upper()}={_format_value(value)}\n')
+    if spectrum._mz is None and spectrum._peak_lines is not None:
+        file.writelines(line + '\n' for line in spectrum._peak_lines)
+    else:
+        file.writelines(f'{mz} {intensity}\n' for mz, intensity in zip(spectrum.mz, spectrum.intensities))
+    file.write('END IONS\n\n')
@@ -0,0 +1,161 @@
+import os
+import json
+import hashlib
+import zipfile
+import numpy as np
+
+from mgf_reader import MgfSpectrum, read_mgf
+
+FORMAT_VERSION = 1
+
+
+def sidecar_path(mgf_path):
+    """Path of the binary spectrum cache of a .mgf file, written next to it"""
+    return os.path.splitext(mgf_path)[0] + '.spectra.npz'
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_sidecar(path, mgf_path):
+    """Open a sidecar if it was built from the current content of mgf_path, else return None"""
+    try:
+        sidecar = np.load(path)
+        source = json.loads(sidecar['source'].tobytes())
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+    stat = os.stat(mgf_path)
+    # The size and mtime spare hashing the .mgf when it was not touched
+    if source.get('format_version') == FORMAT_VERSION and source['size'] == stat.st_size and \
+            (source['mtime_ns'] == stat.st_mtime_ns or source['sha256'] == _file_hash(mgf_path)):
+        return sidecar
+    sidecar.close()
+    return None
+
+
+def build_sidecar(mgf_path):
+    """Parse a .mgf file once and write its spectra in a binary sidecar (see sidecar_path())
+
+    The sidecar is an uncompressed .npz with the concatenated peaks ('mz', 'intensities' and the 'offsets' \
+        of each spectrum), 'precursor_mz', 'scans' and the parameters of each spectrum ('metadata', JSON). \
+        It records the size, mtime and SHA-256 of the .mgf it was built from.
+
+    Args:
+        mgf_path (str): Path to the .mgf file
+
+    Returns:
+        str: Path to the sidecar
+    """
+
+    stat = os.stat(mgf_path)
+    arrays = _arrays_from_spectra(list(read_mgf(mgf_path)), peaks=True)
+    source = {'format_version': FORMAT_VERSION, 'path': os.path.basename(mgf_path), 'size': stat.st_size,
+              'mtime_ns': stat.st_mtime_ns, 'sha256': _file_hash(mgf_path)}
+
+    path = sidecar_path(mgf_path)
+    # Written under a temporary name and renamed, so that concurrent readers never see a partial file
+    tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+    arrays['metadata'] = np.frombuffer(json.dumps(arrays['metadata']).encode(), dtype=np.uint8)
+    try:
+        np.savez(tmp_path, source=np.frombuffer(json.dumps(source).encode(), dtype=np.uint8), **arrays)
+        os.replace(tmp_path, path)
+    finally:
+        # Left behind only if the write or the rename failed (full disk, interrupted build)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+def load_spectrum_arrays(mgf_path, peaks=True):
+    """Load the spectra of a .mgf file from its binary sidecar, built first if missing or outdated
+
+    The .mgf is only parsed when its sidecar does not match its content. If the sidecar cannot be written \
+        (read-only directory), the .mgf is parsed in memory.
+
+    Args:
+        mgf_path (str): Path to the .mgf file
+        peaks (bool, optional): Load the peak arrays. Defaults to True.
+
+    Returns:
+        dict: 'precursor_mz', 'scans' and 'metadata' (list of dict, as MgfSpectrum.metadata) of the spectra, \
+            and if peaks, 'mz', 'intensities' and 'offsets' (the peaks of spectrum i are offsets[i]:offsets[i + 1])
+    """
+
+    keys = ['precursor_mz', 'scans', 'metadata'] + (['mz', 'intensities', 'offsets'] if peaks else [])
+    path = sidecar_path(mgf_path)
+    sidecar = _read_sidecar(path, mgf_path)
+    if sidecar is None:
+        try:
+            path = build_sidecar(mgf_path)
+        except OSError:
+            return _arrays_from_spectra(list(read_mgf(mgf_path, peaks=peaks)), peaks=peaks)
+        sidecar = np.load(path)
+    with sidecar:
+        arrays = {key: sidecar[key] for key in keys}
+    arrays['metadata'] = json.loads(arrays['metadata'].tobytes())
+    for metadata in arrays['metadata']:
+        if 'pepmass' in metadata:
+            metadata['pepmass'] = tuple(metadata['pepmass'])
+    return arrays
+
+
+def _arrays_from_spectra(spectra, peaks=True):
+    """Concatenate MgfSpectrum objects into the arrays of load_spectrum_arrays()"""
+    arrays = {'metadata': [s.metadata for s in spectra],
+              'precursor_mz': np.asarray([s.metadata['pepmass'][0] if 'pepmass' in s.metadata else np.nan for s in spectra],
+                                         dtype=np.float64),
+              'scans': np.asarray([str(s.metadata.get('scans', '')) for s in spectra], dtype=str)}
+    if peaks:
+        arrays['mz'] = np.concatenate([s.mz for s in spectra]) if spectra else np.zeros(0)
+        arrays['intensities'] = np.concatenate([s.intensities for s in spectra]) if spectra else np.zeros(0)
+        arrays['offsets'] = np.cumsum([0] + [len(s.mz) for s in spectra]).astype(np.int64)
+    return arrays
+
+
+def read_cached_mgf(mgf_path, peaks=True):
+    """Read the spectra of a .mgf file through its binary sidecar
+
+    Drop-in replacement of mgf_reader.read_mgf(): the spectra are the same, but the text is only parsed once per file.
+
+    Args:
+        mgf_path (str): Path to the .mgf file
+        peaks (bool, optional): Load the peaks. Defaults to True.
+
+    Returns:
+        list: MgfSpectrum objects, in file order
+    """
+
+    arrays = load_spectrum_arrays(mgf_path, peaks=peaks)
+    if not peaks:
+        return [MgfSpectrum(metadata) for metadata in arrays['metadata']]
+    return spectra_from_arrays(arrays)
+
+
+def spectra_from_arrays(arrays):
+    """Split the arrays of load_spectrum_arrays() (or a subset of them) into MgfSpectrum objects
+
+    Args:
+        arrays (dict): 'metadata' and the peak arrays 'mz', 'intensities' and 'offsets' of the spectra
+
+    Returns:
+        list: MgfSpectrum objects
+    """
+
+    offsets = arrays['offsets']
+    return [MgfSpectrum(metadata, mz=arrays['mz'][start:end], intensities=arrays['intensities'][start:end])
+            for metadata, start, end in zip(arrays['metadata'], offsets[:-1], offsets[1:])]
+
+
+def load_spectra(mgf_path):
+    """Load the spectra of a .mgf file as matchms spectra through its binary sidecar
+
+    Returns:
+        list: matchms spectra objects, as list(matchms.importing.load_from_mgf(mgf_path))
+    """
+
+    return [spectrum.to_matchms() for spectrum in read_cached_mgf(mgf_path)]
@@ -0,0 +1,81 @@
+import os
+import pandas as pd
+
+TABLE_FORMATS = {'tsv': ['tsv'], 'parquet': ['parquet'], 'both': ['tsv', 'parquet']}
+
+
+def parquet_path(tsv_path):
+    """Path of the Parquet version of a .tsv table"""
+    return os.path.splitext(tsv_path)[0] + '.parquet'
+
+
+def table_paths(tsv_path, table_format='tsv'):
+    """Paths of the files written for a table
+
+    Args:
+        tsv_path (str): Path of the table in .tsv
+        table_format (str, optional): 'tsv', 'parquet' or 'both'. Defaults to 'tsv'.
+
+    Returns:
+        list: Paths of the .tsv and/or .parquet files
+    """
+
+    if table_format not in TABLE_FORMATS:
+        raise ValueError('table_format parameter must be tsv, parquet or both')
+    return [tsv_path if fmt == 'tsv' else parquet_path(tsv_path) for fmt in TABLE_FORMATS[table_format]]
+
+
+def table_exists(tsv_path):
+    """Check whether a table was written, in .tsv or in Parquet"""
+    return os.path.isfile(tsv_path) or os.path.isfile(parquet_path(tsv_path))
+
+
+def write_table(df, tsv_path, table_format='tsv', index=True):
+    """Write a table in .tsv and/or Parquet
+
+    The Parquet file (pyarrow required) keeps the column types, is compressed and can be read column by column. \
+        The file of the format that is not written is removed, so that readers do not pick up an outdated table.
+
+    Args:
+        df (DataFrame): Table to write
+        tsv_path (str): Path of the table in .tsv, the Parquet file has the same name with the .parquet extension
+        table_format (str, optional): 'tsv', 'parquet' or 'both'. Defaults to 'tsv'.
+        index (bool, optional): Write the index in the .tsv (the Parquet file never has it). Defaults to True.
+    """
+
+    written = table_paths(tsv_path, table_format)
+    for path in [tsv_path, parquet_path(tsv_path)]:
+        if path not in written and os.path.isfile(path):
+            os.remove(path)
+    if tsv_path in written:
+        df.to_csv(tsv_path, sep='\t', index=index)
+    if parquet_path(tsv_path) in written:
+        df.to_parquet(parquet_path(tsv_path), engine='pyarrow', index=False)
+
+
+def read_table(tsv_path, columns=None, **read_csv_kwargs):
+    """Read a table written by write_table(), from Parquet if available
+
+    Args:
+        tsv_path (str): Path of the table in .tsv
+        columns (list or callable, optional): Columns to load, or a function selecting them from their names \
+            (as usecols of pd.read_csv()). Defaults to None (all columns).
+        **read_csv_kwargs: Other arguments of pd.read_csv(), used when reading the .tsv
+
+    Returns:
+        DataFrame: The table
+    """
+
+    if os.path.isfile(parquet_path(tsv_path)):
+        if columns is not None:
+            # Columns are selected as with usecols: in the order of the file, missing ones raise a ValueError
+            import pyarrow.parquet
+            names = pyarrow.parquet.read_schema(parquet_path(tsv_path)).names
+            if not callable(columns):
+                missing = [c for c in columns if c not in names]
+                if missing:
+                    raise ValueError(f'Columns not found in {parquet_path(tsv_path)}: {missing}')
+                columns = columns.__contains__
+            columns = [c for c in names if columns(c)]
+        return pd.read_parquet(parquet_path(tsv_path), engine='pyarrow', columns=columns)
+    return pd.read_csv(tsv_path, sep='\t', usecols=columns, **read_csv_kwargs)